@@ -0,0 +1,269 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import database
+from metrics import metrics
+from sqlite_dialect import SQLITE_SCHEMA, adapt, row_factory, translate
+from write_queue import assign_ids, follow_up_statements
+
+# Async persistence behind the same calls as database.py, for running the bot
+# without blocking the event loop on database I/O:
+#   'aioodbc'   SQL Server over database.connection_string
+#   'aiosqlite' a local SQLite file (development, tests, benchmarks)
+BACKENDS = ('aioodbc', 'aiosqlite')
+POOL_SIZE = 4
+POOL_TIMEOUT = 30
+SQLITE_PATH = 'signals.db'
+# Prepared statements kept per connection; insert chunks of different sizes
+# are different statements, so this covers the common ones
+STATEMENT_CACHE = 32
+
+# aioodbc connection. pyodbc keeps the last statement executed on a cursor
+# prepared, so each statement gets a cursor of its own and repeats skip the
+# prepare round trip.
+class OdbcConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursors = OrderedDict()
+
+    async def _cursor(self, sql):
+        cursor = self.cursors.get(sql)
+        if cursor is not None:
+            self.cursors.move_to_end(sql)
+            return cursor
+        if len(self.cursors) >= STATEMENT_CACHE:
+            _, oldest = self.cursors.popitem(last=False)
+            await oldest.close()
+        cursor = self.cursors[sql] = await self.conn.cursor()
+        return cursor
+
+    async def execute(self, sql, params=()):
+        cursor = await self._cursor(sql)
+        await cursor.execute(sql, params)
+        return cursor
+
+    async def fetchall(self, sql, params=()):
+        cursor = await self.execute(sql, params)
+        return await cursor.fetchall()
+
+    async def executemany(self, sql, seq_of_params):
+        cursor = await self._cursor(sql)
+        await cursor.executemany(sql, seq_of_params)
+
+    async def commit(self):
+        await self.conn.commit()
+
+    async def rollback(self):
+        await self.conn.rollback()
+
+    async def close(self):
+        self.cursors.clear()
+        await self.conn.close()
+
+
+# aiosqlite connection running database.py's T-SQL through translate().
+# sqlite3 keeps its own per-connection cache of prepared statements.
+class SqliteConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def execute(self, sql, params=()):
+        translated = translate(sql)
+        if translated is None:
+            await self.conn.executescript(SQLITE_SCHEMA)
+            return None
+        return await self.conn.execute(translated, [adapt(value) for value in params])
+
+    async def fetchall(self, sql, params=()):
+        cursor = await self.execute(sql, params)
+        try:
+            return await cursor.fetchall()
+        finally:
+            await cursor.close()
+
+    async def executemany(self, sql, seq_of_params):
+        await self.conn.executemany(translate(sql), [[adapt(value) for value in params] for params in seq_of_params])
+
+    async def commit(self):
+        await self.conn.commit()
+
+    async def rollback(self):
+        await self.conn.rollback()
+
+    async def close(self):
+        await self.conn.close()
+
+
+async def connect_odbc():
+    import aioodbc
+    return OdbcConnection(await aioodbc.connect(dsn=database.connection_string, autocommit=False))
+
+
+async def connect_sqlite(path):
+    import aiosqlite
+    conn = await aiosqlite.connect(path, timeout=POOL_TIMEOUT, cached_statements=STATEMENT_CACHE * 4)
+    conn.row_factory = row_factory
+    await conn.execute('PRAGMA journal_mode=WAL')
+    return SqliteConnection(conn)
+
+
+# Async counterpart of database.ConnectionPool: at most size connections,
+# opened on demand and reused most-recently-idle first. A connection that
+# raised one of the driver's errors is closed instead of reused.
+class AsyncConnectionPool:
+    def __init__(self, connect, errors, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.errors = errors
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self):
+        conn = await self.connect()
+        self._open += 1
+        return conn
+
+    # Open connections up to size ahead of use
+    async def fill(self):
+        while self._open < self.size:
+            self._idle.append(await self._connect())
+
+    @asynccontextmanager
+    async def connection(self):
+        await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        try:
+            conn = self._idle.pop() if self._idle else await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        try:
+            yield conn
+        except self.errors:
+            await self._discard(conn)
+            raise
+        except BaseException:
+            await conn.rollback()
+            self._idle.append(conn)
+            raise
+        else:
+            self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    async def _discard(self, conn):
+        self._open -= 1
+        try:
+            await conn.close()
+        except self.errors:
+            pass
+
+    async def close(self):
+        while self._idle:
+            await self._discard(self._idle.pop())
+
+
+# save_signal / update_signal / update_signal_stop_loss / fetch_open_signals /
+# save_message as coroutines, plus write_ops for the write queue. Parameters
+# and SQL come from database.py, so both paths store identical rows.
+class AsyncDatabase:
+    def __init__(self, pool):
+        self.pool = pool
+        self._schema_ready = False
+        self._schema_lock = asyncio.Lock()
+
+    async def ensure_schema(self):
+        if self._schema_ready:
+            return
+        async with self._schema_lock:
+            if not self._schema_ready:
+                async with self.pool.connection() as conn:
+                    for sql in database.SCHEMA_SQL:
+                        await conn.execute(sql)
+                    await conn.commit()
+                self._schema_ready = True
+
+    # Schema check and a full pool, ahead of the first write
+    async def fill(self):
+        await self.ensure_schema()
+        await self.pool.fill()
+
+    async def _write(self, sql, params):
+        async with self.pool.connection() as conn:
+            await conn.execute(sql, params)
+            await conn.commit()
+
+    async def save_signal(self, symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence):
+        await self.ensure_schema()
+        params = database.signal_params(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence)
+        if params is None:
+            return None
+        async with self.pool.connection() as conn:
+            rows = await conn.fetchall(database.INSERT_SIGNAL_SQL, params)
+            await conn.commit()
+        return rows[0][0]
+
+    async def update_signal_stop_loss(self, signal_id, new_stop_loss, timestamp):
+        params = database.stop_loss_params(signal_id, new_stop_loss, timestamp)
+        if params is not None:
+            await self._write(database.UPDATE_STOP_LOSS_SQL, params)
+
+    async def update_signal(self, signal_id, total_profit, is_open, invalidated, timestamp, entry_point=None):
+        await self._write(*database.update_params(signal_id, total_profit, is_open, invalidated, timestamp, entry_point))
+
+    async def fetch_open_signals(self):
+        await self.ensure_schema()
+        async with self.pool.connection() as conn:
+            return await conn.fetchall(database.OPEN_SIGNALS_SQL)
+
+    async def save_message(self, message):
+        await self._write(database.INSERT_MESSAGE_SQL, (message,))
+
+    # write_queue.write_ops on an async connection: inserts first, then the
+    # set-based signal updates and the messages, then one commit, after which
+    # the inserted ids go to their targets
+    async def write_ops(self, ops):
+        await self.ensure_schema()
+        started = time.perf_counter()
+        inserts = [op for op in ops if op.sql is database.INSERT_SIGNAL_SQL]
+        round_trips = 1  # the commit
+        assigned = {}
+        async with self.pool.connection() as conn:
+            for start in range(0, len(inserts), database.INSERT_CHUNK_SIZE):
+                chunk = inserts[start:start + database.INSERT_CHUNK_SIZE]
+                rows = [op.params for op in chunk]
+                outputs = await conn.fetchall(database.insert_signals_sql(len(rows)), [param for row in rows for param in row])
+                for op, signal_id in zip(chunk, database.inserted_ids(rows, outputs)):
+                    if op.target is not None:
+                        assigned[id(op.target)] = (op.target, signal_id)
+                round_trips += 1
+            updates, messages = follow_up_statements(ops, assigned)
+            rows = database.signal_update_rows(updates)
+            for start in range(0, len(rows), database.UPDATE_CHUNK_SIZE):
+                chunk = rows[start:start + database.UPDATE_CHUNK_SIZE]
+                await conn.execute(database.update_signals_sql(len(chunk)), [param for row in chunk for param in row])
+                round_trips += 1
+            for sql, params in database.statement_runs(messages):
+                await conn.executemany(sql, params)
+                round_trips += 1
+            await conn.commit()
+        assign_ids(assigned)
+        metrics.since('db_write', started)
+        metrics.count('db_round_trips', round_trips)
+        metrics.count('db_writes', len(ops))
+
+    async def close(self):
+        await self.pool.close()
+
+
+# An AsyncDatabase for one of BACKENDS; path is the SQLite file for 'aiosqlite'
+def create_backend(name, path=SQLITE_PATH, size=POOL_SIZE):
+    if name == 'aioodbc':
+        import pyodbc
+        return AsyncDatabase(AsyncConnectionPool(connect_odbc, (pyodbc.Error,), size))
+    if name == 'aiosqlite':
+        return AsyncDatabase(AsyncConnectionPool(lambda: connect_sqlite(path), (sqlite3.Error,), size))
+    raise ValueError(f"Unknown database backend {name!r}; expected one of {', '.join(BACKENDS)}")
@@ -0,0 +1,265 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from features import feature_columns, history_features
+from patterns import default_rules
+
+CANDLE_SIZES = [6]
+# Mirrors database.calculate_take_profit: target is 3R with a 0.05 minimum risk
+MIN_RISK = 0.05
+REWARD_MULTIPLE = 3
+# Bars examined per step when walking a trade forward; doubles each step
+SCAN_CHUNK = 256
+
+BAR_COLUMNS = ['symbol', 'timestamp', 'open', 'high', 'low', 'close', 'volume']
+TRADE_COLUMNS = [
+    'symbol', 'candle_size', 'signal_type', 'signal_time', 'entry_point', 'stop_loss',
+    'invalidated_price', 'take_profit', 'volume_confirmed', 'status', 'fill_time',
+    'fill_price', 'exit_time', 'total_profit'
+]
+
+
+# Load minute bars from Parquet or CSV into the BAR_COLUMNS layout with
+# millisecond epoch timestamps, sorted by symbol and time
+def load_bars(path, symbols=None):
+    if path.endswith('.parquet'):
+        bars = pd.read_parquet(path, columns=BAR_COLUMNS)
+    else:
+        bars = pd.read_csv(path, usecols=BAR_COLUMNS)
+    return normalize_bars(bars, symbols)
+
+
+# Load minute bars from the local candle cache (see candle_cache)
+def load_bars_from_cache(symbols=None):
+    import candle_cache
+    return normalize_bars(candle_cache.load_candles(symbols))
+
+
+# Load minute bars from the candlestick_data table
+def load_bars_from_database(symbols=None):
+    import database
+    query = "SELECT [symbol], [timestamp], [open], [high], [low], [close], [volume] FROM [candlestick_data]"
+    params = None
+    if symbols:
+        query += " WHERE [symbol] IN (" + ", ".join("?" * len(symbols)) + ")"
+        params = list(symbols)
+    with database.connection() as conn:
+        bars = pd.read_sql(query, conn, params=params)
+    return normalize_bars(bars)
+
+
+# Load the minute bars a live bot aggregated (live and recovered) from one of
+# its event logs (see event_log), to replay exactly what it saw
+def load_bars_from_events(path, symbols=None):
+    from event_log import read_bars
+    rows = [(bar.symbol, bar.start_timestamp, bar.open, bar.high, bar.low, bar.close, bar.volume) for bar in read_bars(path)]
+    return normalize_bars(pd.DataFrame(rows, columns=BAR_COLUMNS), symbols)
+
+
+def normalize_bars(bars, symbols=None):
+    if symbols:
+        bars = bars[bars['symbol'].isin(symbols)]
+    timestamps = bars['timestamp']
+    if not pd.api.types.is_integer_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps).astype('int64') // 1_000_000
+    bars = bars.assign(timestamp=timestamps.astype('int64'))
+    return bars.sort_values(['symbol', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+MINUTE = 60000
+
+
+# Fold minute bars into wall-clock aligned `size`-minute candles, the way the
+# live CandleEngine does: a candle closes on the bar ending its window or, if
+# that minute is missing, on the first bar of a later window. Returns OHLCV
+# arrays, the candle end time (as CandleEngine's 't') and the index of the bar
+# each candle closed on. timestamps are bar starts in epoch milliseconds; a
+# trailing candle that never closed is dropped.
+def aggregate(timestamps, open_, high, low, close, volume, size):
+    n = len(open_)
+    if n == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty, empty, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    period = size * MINUTE
+    window = timestamps // period
+    starts = np.flatnonzero(np.r_[True, window[1:] != window[:-1]])
+    ends = np.r_[starts[1:] - 1, n - 1]
+    complete = timestamps[ends] + MINUTE >= (window[ends] + 1) * period
+    closed_on = np.where(complete, ends, ends + 1)
+    keep = closed_on < n
+    return (
+        open_[starts][keep],
+        np.maximum.reduceat(high, starts)[keep],
+        np.minimum.reduceat(low, starts)[keep],
+        close[ends][keep],
+        np.add.reduceat(volume, starts)[keep],
+        (timestamps[ends] + MINUTE)[keep],
+        closed_on[keep]
+    )
+
+
+def take_profits(is_long, entry, stop):
+    risk = np.maximum(np.abs(entry - stop), MIN_RISK)
+    return np.where(is_long, entry + REWARD_MULTIPLE * risk, entry - REWARD_MULTIPLE * risk)
+
+
+# Index of the first bar at or after `start` where condition(lo, hi) is true,
+# or -1. Bars are tested in growing chunks so a trade that resolves quickly
+# only looks at a handful of bars.
+def first_hit(condition, start, n):
+    chunk = SCAN_CHUNK
+    while start < n:
+        end = min(n, start + chunk)
+        hits = condition(start, end)
+        if hits.any():
+            return start + int(hits.argmax())
+        start = end
+        chunk *= 2
+    return -1
+
+
+# Replay one signal through the check_and_update_signals state machine,
+# starting with the minute bar that closed its candle. Returns
+# (status, fill_index, fill_price, exit_index, total_profit).
+def simulate(is_long, entry, stop, invalidated, take_profit, start, high, low, close):
+    n = len(close)
+    if is_long:
+        def pending(a, b):
+            return (high[a:b] >= invalidated) | (close[a:b] >= entry)
+    else:
+        def pending(a, b):
+            return (low[a:b] <= invalidated) | (close[a:b] <= entry)
+    i = first_hit(pending, start, n)
+    if i < 0:
+        return 'pending', -1, np.nan, -1, np.nan
+    if (high[i] >= invalidated) if is_long else (low[i] <= invalidated):
+        return 'invalidated', -1, np.nan, i, np.nan
+    fill_index, entry = i, close[i]
+
+    # Open: stop first, then target, then the break-even stop move. Once the
+    # stop sits at the entry only the stop or the target can change anything.
+    risk = abs(entry - stop)
+    break_even = risk > 0
+    if is_long:
+        def open_(a, b):
+            hits = (low[a:b] <= stop) | (close[a:b] >= take_profit)
+            return hits | (close[a:b] - entry >= risk) if break_even else hits
+    else:
+        def open_(a, b):
+            hits = (high[a:b] >= stop) | (close[a:b] <= take_profit)
+            return hits | (entry - close[a:b] >= risk) if break_even else hits
+    while True:
+        i = first_hit(open_, i + 1, n)
+        if i < 0:
+            return 'open', fill_index, entry, -1, np.nan
+        if (low[i] <= stop) if is_long else (high[i] >= stop):
+            profit = stop - entry if is_long else entry - stop
+            return 'stopped', fill_index, entry, i, round(float(profit), 2)
+        if (close[i] >= take_profit) if is_long else (close[i] <= take_profit):
+            profit = take_profit - entry if is_long else entry - take_profit
+            return 'target', fill_index, entry, i, round(float(profit), 2)
+        stop, break_even = entry, False
+
+
+def backtest_symbol(symbol, timestamps, open_, high, low, close, volume, sizes=CANDLE_SIZES):
+    trades = []
+    for size in sizes:
+        o, h, l, c, v, t, closed_on = aggregate(timestamps, open_, high, low, close, volume, size)
+        if len(o) < 2:
+            continue
+        volume_confirmed = v[1:] > v[:-1]
+        prev = {'o': o[:-1], 'h': h[:-1], 'l': l[:-1], 'c': c[:-1], 'v': v[:-1], 't': t[:-1]}
+        cur = {'o': o[1:], 'h': h[1:], 'l': l[1:], 'c': c[1:], 'v': v[1:], 't': t[1:]}
+        # Rolling features as the live FeatureStore serves them at each close
+        rolling = feature_columns(history_features(np.full(len(o), symbol), o, h, l, c, v, t)[1:])
+        for rule, mask, entry, stop, invalidated in default_rules.masks(prev, cur, size, rolling):
+            is_long = rule.signal_type == 'LONG'
+            indices = np.flatnonzero(mask)
+            targets = take_profits(is_long, entry[indices], stop[indices])
+            for index, take_profit in zip(indices, targets):
+                start = closed_on[index + 1]
+                status, fill_index, fill_price, exit_index, profit = simulate(
+                    is_long, entry[index], stop[index], invalidated[index], take_profit, start, high, low, close)
+                trades.append((
+                    symbol, size, rule.signal_type, timestamps[start], entry[index], stop[index],
+                    invalidated[index], take_profit, bool(volume_confirmed[index]), status,
+                    timestamps[fill_index] if fill_index >= 0 else None, fill_price,
+                    timestamps[exit_index] if exit_index >= 0 else None, profit
+                ))
+    # Live signals for one bar are saved in rule order; keep that order in time
+    trades.sort(key=lambda trade: (trade[3], trade[1]))
+    return trades
+
+
+def _backtest_task(args):
+    return backtest_symbol(*args)
+
+
+def run_backtest(bars, sizes=CANDLE_SIZES, workers=None):
+    tasks = []
+    for symbol, group in bars.groupby('symbol', sort=True):
+        tasks.append((
+            symbol,
+            group['timestamp'].to_numpy(dtype=np.int64),
+            group['open'].to_numpy(dtype=np.float64),
+            group['high'].to_numpy(dtype=np.float64),
+            group['low'].to_numpy(dtype=np.float64),
+            group['close'].to_numpy(dtype=np.float64),
+            group['volume'].to_numpy(dtype=np.float64),
+            sizes
+        ))
+    if workers == 1 or len(tasks) <= 1:
+        results = map(_backtest_task, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_backtest_task, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+    trades = [trade for result in results for trade in result]
+    return pd.DataFrame(trades, columns=TRADE_COLUMNS)
+
+
+def summarize(trades):
+    closed = trades[trades['status'].isin(['stopped', 'target'])]
+    wins = (closed['total_profit'] > 0).sum()
+    return {
+        'signals': len(trades),
+        'filled': int(trades['fill_time'].notna().sum()),
+        'closed': len(closed),
+        'win_rate': round(wins / len(closed), 4) if len(closed) else None,
+        'total_profit': round(float(closed['total_profit'].sum()), 2),
+        'by_status': trades['status'].value_counts().to_dict(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay minute bars through the entry rules and exit logic")
+    parser.add_argument('source', help="Parquet or CSV file of minute bars, an event log (.log), 'cache' for the local candle cache, or 'db' for the candlestick_data table")
+    parser.add_argument('--symbols', nargs='*', help="Only test these symbols")
+    parser.add_argument('--sizes', nargs='*', type=int, default=CANDLE_SIZES, help="Candle sizes in minutes")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument('--out', help="Write per-trade results to this CSV or Parquet file")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.source == 'db':
+        bars = load_bars_from_database(args.symbols)
+    elif args.source == 'cache':
+        bars = load_bars_from_cache(args.symbols)
+    elif args.source.endswith('.log'):
+        bars = load_bars_from_events(args.source, args.symbols)
+    else:
+        bars = load_bars(args.source, args.symbols)
+    loaded = time.perf_counter()
+    trades = run_backtest(bars, args.sizes, args.workers)
+    finished = time.perf_counter()
+
+    print(f"Loaded {len(bars)} bars in {loaded - started:.2f}s, backtested in {finished - loaded:.2f}s")
+    print(summarize(trades))
+    if args.out:
+        if args.out.endswith('.parquet'):
+            trades.to_parquet(args.out, index=False)
+        else:
+            trades.to_csv(args.out, index=False)
+        print(f"Trades written to {args.out}")
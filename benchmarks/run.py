@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks import standins
+standins.install_secret()
+
+import numpy as np
+import check_signals
+import inference
+from benchmarks.synthetic import BarGenerator, sample_features, synthetic_forest
+from candle_engine import CandleEngine
+from inference import BatchPredictor
+from metrics import Histogram, metrics
+from pipeline import Pipeline, Stage
+from patterns import candle_arrays, default_rules
+from processor import BarProcessor
+from recovery import GapRecovery
+from signal_book import Signal, book
+from write_queue import writer
+
+CANDLE_SIZES = [6]
+RESULTS_FORMAT = 1
+# Fields compared against a baseline, and whether higher is better
+REGRESSION_CHECKS = (
+    ('bars_per_second', True),
+    ('latency.bar_to_processed.p99_ms', False),
+    ('latency.tick_to_alert.p99_ms', False),
+)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Open signals spread over the symbols, priced around each symbol's first
+# bar so that some of them fill, stop out or hit targets during the run
+def seed_open_signals(first_batch, count, seed):
+    rng = np.random.default_rng(seed + 1)
+    created_at = datetime.now()
+    for signal_id in range(1, count + 1):
+        bar = first_batch[rng.integers(len(first_batch))]
+        signal_type = 'LONG' if rng.random() < 0.5 else 'SHORT'
+        direction = 1 if signal_type == 'LONG' else -1
+        risk = bar.close * rng.uniform(0.002, 0.01)
+        entry_point = bar.close * (1 + direction * rng.uniform(-0.003, 0.003))
+        book.add(Signal(
+            id=signal_id,
+            symbol=bar.symbol,
+            signal_type=signal_type,
+            entry_point=entry_point,
+            stop_loss=entry_point - direction * risk,
+            invalidated_price=entry_point + direction * 2 * risk,
+            take_profit=entry_point + direction * 3 * risk,
+            sentiment=None,
+            is_open=bool(rng.random() < 0.5),
+            invalidated=False,
+            volume_confirmed=False,
+            total_profit=None,
+            created_at=created_at,
+            updated_at=created_at,
+            confidence='0.5'
+        ))
+
+
+# One full pass of the live path: FakeWebSocketClient -> handle_msg ->
+# aggregate/score/signals pipeline -> Dispatcher on a FakeChannel, with
+# database writes going through the write queue into SQLite
+async def run_pipeline(batches, open_signals, args, db_path):
+    standins.install_database(db_path, args.db_latency / 1000)
+    book.clear()
+    seed_open_signals(batches[0], open_signals, args.seed)
+    metrics.reset()
+
+    executor = ThreadPoolExecutor(1)
+    channel = standins.FakeChannel(args.discord_latency / 1000)
+    dispatcher = standins.fake_dispatcher(channel, rate_limited=args.rate_limited)
+    processor = BarProcessor(CandleEngine(CANDLE_SIZES), GapRecovery(), BatchPredictor(inference.model),
+                             dispatcher.send, executor=executor)
+    signal_stage = Stage('signals', processor.signal_batch, maxsize=args.queue_size)
+    score_stage = Stage('score', processor.score_batch, maxsize=args.queue_size, downstream=signal_stage)
+    aggregate_stage = Stage('aggregate', processor.aggregate_batch, maxsize=args.queue_size, downstream=score_stage)
+    pipeline = Pipeline([aggregate_stage, score_stage, signal_stage])
+
+    client = standins.FakeWebSocketClient(batches)
+    client.subscribe('AM.*')
+
+    async def handle_msg(msgs):
+        await pipeline.put((metrics.receive(msgs), msgs))
+
+    # The alert sink is check_signals module state; put back the previous
+    # one once the run is done
+    previous_sink = check_signals.message_sink
+    check_signals.set_message_sink(dispatcher.send)
+    try:
+        writer.start()
+        dispatcher.start()
+        pipeline.start(report_interval=0)
+        started = time.perf_counter()
+        await client.connect(handle_msg)
+        await pipeline.stop()
+        processed = time.perf_counter() - started
+        await dispatcher.drain()
+        await writer.drain()
+        drained = time.perf_counter() - started
+        executor.shutdown()
+    finally:
+        check_signals.set_message_sink(previous_sink)
+
+    bars = sum(len(batch) for batch in batches)
+    snapshot = metrics.snapshot()
+    latency = snapshot['latency']
+    # Synthetic bars are historical, so the feed delay is meaningless here
+    latency.pop('feed_delay', None)
+    return {
+        'bars': bars,
+        'seconds': round(processed, 4),
+        'seconds_with_drain': round(drained, 4),
+        'bars_per_second': round(bars / processed, 1),
+        'latency': latency,
+        'counters': {name: counter['total'] for name, counter in snapshot['counters'].items()},
+        'alerts_delivered': len(channel.sent),
+    }
+
+
+def timed_calls(fn, calls):
+    histogram = Histogram()
+    for call_args in calls:
+        started = time.perf_counter()
+        fn(*call_args)
+        histogram.observe(time.perf_counter() - started)
+    snapshot = histogram.snapshot()
+    snapshot['calls_per_second'] = round(histogram.count / histogram.total, 1) if histogram.total else 0.0
+    return snapshot
+
+
+# Per-call latency of the hot-path pieces in isolation
+def run_micro(args):
+    generator = BarGenerator(args.micro_symbols, args.seed)
+    bars = [bar for batch in generator.batches(args.minutes) for bar in batch]
+    engine = CandleEngine(CANDLE_SIZES)
+    pairs = []
+    last = {}
+
+    def update(bar):
+        for _, candle, previous in engine.update(bar.symbol, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.start_timestamp, bar.end_timestamp):
+            if previous is not None:
+                pairs.append((previous, candle, bar.symbol))
+            last[bar.symbol] = candle
+    results = {'candle_update': timed_calls(update, [(bar,) for bar in bars])}
+
+    def analyze(previous, candle, symbol):
+        default_rules.evaluate(candle_arrays([previous]), candle_arrays([candle]), CANDLE_SIZES[0])
+    results['analyze'] = timed_calls(analyze, pairs)
+    # Every pair at once, as when the whole universe closes a candle together
+    every_pair = (candle_arrays([pair[0] for pair in pairs]), candle_arrays([pair[1] for pair in pairs]), CANDLE_SIZES[0])
+    results[f'analyze_{len(pairs)}'] = timed_calls(default_rules.evaluate, [every_pair] * args.predict_repeats)
+
+    rows = [inference.candle_features(candle) for candle in last.values()]
+    for size in args.predict_sizes:
+        batch = (rows * (size // max(len(rows), 1) + 1))[:size]
+        results[f'predict_{size}'] = timed_calls(inference.score_rows, [(batch,)] * args.predict_repeats)
+    return results
+
+
+def lookup(result, path):
+    for key in path.split('.'):
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+# Regressions of the current results against a baseline results file
+def compare(results, baseline, tolerance):
+    previous = {(run['symbols'], run['open_signals']): run for run in baseline.get('pipeline', [])}
+    regressions = []
+    for run in results['pipeline']:
+        base = previous.get((run['symbols'], run['open_signals']))
+        if base is None:
+            continue
+        for path, higher_is_better in REGRESSION_CHECKS:
+            now, before = lookup(run, path), lookup(base, path)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{run['symbols']} symbols / {run['open_signals']} open signals: {path} {before} -> {now} ({change:+.1%})")
+    return regressions
+
+
+def int_list(value):
+    return [int(part) for part in value.split(',') if part]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the signal pipeline on synthetic market data")
+    parser.add_argument('--symbols', type=int_list, default=[10, 100, 1000], help="Comma-separated symbol counts")
+    parser.add_argument('--open-signals', type=int_list, default=[0, 100, 1000], help="Comma-separated open signal counts")
+    parser.add_argument('--minutes', type=int, default=60, help="Minutes of bars per run")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db-latency', type=float, default=0.0, help="Added per database round trip, in ms")
+    parser.add_argument('--discord-latency', type=float, default=0.0, help="Added per Discord send, in ms")
+    parser.add_argument('--rate-limited', action='store_true', help="Keep Discord's 5 messages / 5 s limit")
+    parser.add_argument('--queue-size', type=int, default=100)
+    parser.add_argument('--trees', type=int, default=100, help="Trees in the synthetic model")
+    parser.add_argument('--depth', type=int, default=10, help="Depth of the synthetic model's trees")
+    parser.add_argument('--micro-symbols', type=int, default=100)
+    parser.add_argument('--predict-sizes', type=int_list, default=[1, 100, 1000])
+    parser.add_argument('--predict-repeats', type=int, default=50)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    inference.model = synthetic_forest(sample_features(seed=args.seed), args.trees, args.depth, args.seed)
+    results = {
+        'format': RESULTS_FORMAT,
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'pipeline': [],
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for symbols in args.symbols:
+            batches = list(BarGenerator(symbols, args.seed).batches(args.minutes))
+            for open_signals in args.open_signals:
+                db_path = os.path.join(workdir, f'bench-{symbols}-{open_signals}.db')
+                # The pipeline prints per candle; keep that cost but not the output
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    run = asyncio.run(run_pipeline(batches, open_signals, args, db_path))
+                run = dict(symbols=symbols, open_signals=open_signals, **run)
+                results['pipeline'].append(run)
+                end_to_end = run['latency'].get('bar_to_processed', {})
+                print(f"{symbols:>6} symbols {open_signals:>6} open signals: {run['bars_per_second']:>10} bars/s, "
+                      f"bar to processed p50 {end_to_end.get('p50_ms')}ms p99 {end_to_end.get('p99_ms')}ms", file=sys.stderr)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results['micro'] = run_micro(args)
+    for name, stats in results['micro'].items():
+        print(f"{name}: p50 {stats['p50_ms']}ms p99 {stats['p99_ms']}ms, {stats['calls_per_second']} calls/s", file=sys.stderr)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import asyncio
+import sqlite3
+import sys
+import threading
+import time
+import types
+from sqlite_dialect import SQLITE_SCHEMA, adapt, row_factory, translate
+
+# Local stand-ins for the bot's external services, so the pipeline can be
+# driven end to end without Polygon, Discord or SQL Server.
+
+
+# Dummy credentials when there is no secret.py; nothing here connects anywhere
+def install_secret():
+    try:
+        import secret  # noqa: F401
+    except ImportError:
+        module = types.ModuleType('secret')
+
+        class Secret:
+            server = database = username = password = token = ''
+            signal_channel_id = 1
+        module.Secret = Secret
+        sys.modules['secret'] = module
+
+
+class SqliteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
+        self.cursor.row_factory = row_factory
+
+    def execute(self, sql, params=()):
+        self.connection.round_trip()
+        translated = translate(sql)
+        if translated is None:
+            self.cursor.executescript(SQLITE_SCHEMA)
+        else:
+            self.cursor.execute(translated, [adapt(value) for value in params])
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.round_trip()
+        self.cursor.executemany(translate(sql), [[adapt(value) for value in params] for params in seq_of_params])
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+# pyodbc-style connection backed by a SQLite file. latency (seconds) is added
+# to every statement and commit to stand in for the SQL Server round trip.
+class SqliteConnection:
+    _lock = threading.Lock()
+
+    def __init__(self, path, latency=0.0):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.latency = latency
+        with self._lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def cursor(self):
+        return SqliteCursor(self)
+
+    def commit(self):
+        self.round_trip()
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+# Point database.py's connection pool at a SQLite file
+def install_database(path, latency=0.0):
+    install_secret()
+    import database
+    database.pool.close()
+    database._schema_ready = False
+    database.create_connection = lambda: SqliteConnection(path, latency)
+
+
+# Discord channel that records what it is sent after an optional delay
+class FakeChannel:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, content):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append(content)
+
+
+# notifier.Dispatcher on a FakeChannel. Unless rate_limited, the per-channel
+# token bucket is opened up so the numbers show the pipeline, not Discord's limit.
+def fake_dispatcher(channel, channel_id=1, rate_limited=False, coalesce_window=None):
+    from notifier import COALESCE_WINDOW, Dispatcher, TokenBucket
+    dispatcher = Dispatcher(lambda _: channel, channel_id,
+                            coalesce_window=COALESCE_WINDOW if coalesce_window is None else coalesce_window)
+    if not rate_limited:
+        dispatcher.buckets[channel_id] = TokenBucket(rate=10 ** 9, period=1.0)
+    return dispatcher
+
+
+# polygon.WebSocketClient stand-in that replays prepared batches of bars.
+# interval paces the batches (0 replays as fast as the handler accepts them).
+class FakeWebSocketClient:
+    def __init__(self, batches, interval=0.0):
+        self.batches = batches
+        self.interval = interval
+        self.subscriptions = set()
+
+    def subscribe(self, *subscriptions):
+        self.subscriptions.update(subscriptions)
+
+    def _wanted(self, bar):
+        return 'AM.*' in self.subscriptions or f'AM.{bar.symbol}' in self.subscriptions
+
+    async def connect(self, processor):
+        for batch in self.batches:
+            await processor([bar for bar in batch if self._wanted(bar)])
+            if self.interval:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,125 @@
+import argparse
+import numpy as np
+import pandas as pd
+from recovery import Bar, MINUTE
+
+# 2024-01-02 09:30 US/Eastern, a regular session open
+SESSION_OPEN = 1704205800000
+SESSION_MINUTES = 390
+SUBSTEPS = 8
+
+
+def symbol_names(n):
+    return [f'SYN{i:05d}' for i in range(n)]
+
+
+# Seeded minute bars for n symbols. Prices follow a geometric random walk
+# with per-symbol volatility, each bar's high/low come from SUBSTEPS intrabar
+# steps, and volume follows the usual U-shaped intraday curve. The same seed
+# always produces the same bars.
+class BarGenerator:
+    def __init__(self, symbols, seed=42, start=SESSION_OPEN, missing=0.0):
+        self.symbols = symbols if isinstance(symbols, list) else symbol_names(symbols)
+        self.rng = np.random.default_rng(seed)
+        n = len(self.symbols)
+        self.price = np.exp(self.rng.uniform(np.log(5), np.log(500), n))
+        self.volatility = self.rng.uniform(0.0005, 0.003, n)
+        self.base_volume = np.exp(self.rng.uniform(np.log(2e3), np.log(2e5), n))
+        self.start = start
+        # Chance that a symbol has no bar in a given minute, as on thin names
+        self.missing = missing
+        self.minute = 0
+
+    def step(self):
+        n = len(self.symbols)
+        shocks = self.rng.standard_normal((n, SUBSTEPS)) * (self.volatility / np.sqrt(SUBSTEPS))[:, None]
+        path = self.price[:, None] * np.exp(np.cumsum(shocks, axis=1))
+        open_ = self.price
+        close = path[:, -1]
+        high = np.maximum(open_, path.max(axis=1))
+        low = np.minimum(open_, path.min(axis=1))
+        session_minute = self.minute % SESSION_MINUTES
+        # U-shaped intraday volume: heavy at the open and close
+        shape = 1 + 2.5 * (((session_minute - SESSION_MINUTES / 2) / (SESSION_MINUTES / 2)) ** 2)
+        volume = np.round(self.base_volume * shape * self.rng.lognormal(0, 0.5, n))
+        self.price = close
+        start = self.start + self.minute * MINUTE
+        self.minute += 1
+        present = self.rng.random(n) >= self.missing if self.missing else np.ones(n, dtype=bool)
+        return start, np.round(open_, 2), np.round(high, 2), np.round(low, 2), np.round(close, 2), volume, present
+
+    # One list of Bars (the shape of a websocket batch) per minute
+    def batches(self, minutes):
+        for _ in range(minutes):
+            start, open_, high, low, close, volume, present = self.step()
+            yield [Bar(self.symbols[i], float(open_[i]), float(high[i]), float(low[i]), float(close[i]), float(volume[i]), start)
+                   for i in np.flatnonzero(present)]
+
+    # The same stream as a DataFrame in backtest.BAR_COLUMNS layout
+    def frame(self, minutes):
+        frames = []
+        for _ in range(minutes):
+            start, open_, high, low, close, volume, present = self.step()
+            frames.append(pd.DataFrame({
+                'symbol': np.asarray(self.symbols)[present], 'timestamp': start,
+                'open': open_[present], 'high': high[present], 'low': low[present],
+                'close': close[present], 'volume': volume[present]
+            }))
+        bars = pd.concat(frames, ignore_index=True)
+        return bars.sort_values(['symbol', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+# Candle feature rows (o, c, h, l, v) for picking model thresholds
+def sample_features(symbols=50, minutes=60, seed=42):
+    bars = BarGenerator(symbols, seed).frame(minutes)
+    return bars[['open', 'close', 'high', 'low', 'volume']].to_numpy(dtype=np.float64)
+
+
+# A random CompactForest shaped like a trained model (full trees of the given
+# depth over the five candle features), so scoring can be benchmarked without
+# a trained model or sklearn
+def synthetic_forest(samples, trees=100, depth=10, seed=42):
+    from model_export import CompactForest
+    rng = np.random.default_rng(seed)
+    nodes = 2 ** (depth + 1) - 1
+    internal = 2 ** depth - 1
+    local = np.arange(nodes)
+    left, right, feature, threshold, proba = [], [], [], [], []
+    for tree in range(trees):
+        offset = tree * nodes
+        is_leaf = local >= internal
+        left.append(np.where(is_leaf, -1, 2 * local + 1 + offset))
+        right.append(np.where(is_leaf, -1, 2 * local + 2 + offset))
+        features = rng.integers(0, samples.shape[1], nodes)
+        feature.append(np.where(is_leaf, 0, features))
+        threshold.append(samples[rng.integers(0, len(samples), nodes), features])
+        positive = rng.beta(2, 2, nodes)
+        proba.append(np.column_stack([1 - positive, positive]))
+    return CompactForest(
+        np.arange(trees, dtype=np.int64) * nodes,
+        np.concatenate(left).astype(np.int64),
+        np.concatenate(right).astype(np.int64),
+        np.concatenate(feature).astype(np.int64),
+        np.concatenate(threshold).astype(np.float64),
+        np.concatenate(proba),
+        np.asarray([0, 1]),
+        depth,
+        samples.shape[1]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write seeded synthetic minute bars (backtest / FileBarSource CSV layout)")
+    parser.add_argument('output')
+    parser.add_argument('--symbols', type=int, default=100)
+    parser.add_argument('--minutes', type=int, default=SESSION_MINUTES)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--missing', type=float, default=0.0, help="Chance a symbol skips a minute")
+    args = parser.parse_args()
+
+    bars = BarGenerator(args.symbols, args.seed, missing=args.missing).frame(args.minutes)
+    if args.output.endswith('.parquet'):
+        bars.to_parquet(args.output, index=False)
+    else:
+        bars.to_csv(args.output, index=False)
+    print(f"Wrote {len(bars)} bars for {args.symbols} symbols to {args.output}")
@@ -0,0 +1,196 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import database
+
+CACHE_DIR = os.environ.get('ZENTRIX_CACHE_DIR', 'data_cache')
+CHUNK_SIZE = 200000
+
+CANDLE_COLUMNS = ['symbol', 'timestamp', 'open', 'high', 'low', 'close', 'volume']
+SIGNAL_COLUMNS = ['id', 'symbol', 'signal_type', 'entry_point', 'stop_loss', 'invalidated_price',
+                  'take_profit', 'is_open', 'invalidated', 'volume_confirmed', 'total_profit',
+                  'created_at', 'updated_at', 'confidence']
+
+
+# Local columnar copy of candlestick_data and trade_signals. Candles are stored
+# as uncompressed Feather (Arrow IPC) files partitioned by symbol and date so
+# they can be memory-mapped; each sync only pulls rows past the stored
+# high-water mark, in chunks.
+def candles_dir(cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, 'candlestick_data')
+
+
+def partition_path(symbol, date, cache_dir=CACHE_DIR):
+    return os.path.join(candles_dir(cache_dir), f'symbol={symbol}', f'date={date}.feather')
+
+
+def state_path(cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, 'state.json')
+
+
+def load_state(cache_dir=CACHE_DIR):
+    try:
+        with open(state_path(cache_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = state_path(cache_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def write_feather(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    feather.write_feather(df, path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+
+
+def read_feather(path, columns=None):
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+
+# Merge new candles into their symbol/date partitions
+def append_candles(chunk, cache_dir=CACHE_DIR):
+    chunk = chunk.assign(timestamp=pd.to_datetime(chunk['timestamp']))
+    dates = chunk['timestamp'].dt.strftime('%Y-%m-%d')
+    for (symbol, date), rows in chunk.groupby([chunk['symbol'], dates], sort=False):
+        path = partition_path(symbol, date, cache_dir)
+        if os.path.exists(path):
+            existing = read_feather(path).to_pandas()
+            rows = pd.concat([existing, rows], ignore_index=True)
+            rows = rows.drop_duplicates(['symbol', 'timestamp'], keep='last')
+        rows = rows.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        write_feather(rows[CANDLE_COLUMNS], path)
+
+
+def sync_candles(cache_dir=CACHE_DIR, chunksize=CHUNK_SIZE):
+    state = load_state(cache_dir)
+    high_water = state.get('candlestick_data')
+    query = "SELECT [symbol], [timestamp], [open], [high], [low], [close], [volume] FROM [candlestick_data]"
+    params = None
+    if high_water:
+        query += " WHERE [timestamp] > ?"
+        params = [pd.Timestamp(high_water).to_pydatetime()]
+    query += " ORDER BY [timestamp]"
+
+    fetched = 0
+    with database.connection() as conn:
+        for chunk in pd.read_sql(query, conn, params=params, chunksize=chunksize):
+            if chunk.empty:
+                continue
+            append_candles(chunk, cache_dir)
+            fetched += len(chunk)
+            # Advance the mark after every chunk so an interrupted sync resumes
+            state['candlestick_data'] = pd.Timestamp(chunk['timestamp'].max()).isoformat()
+            save_state(state, cache_dir)
+    return fetched
+
+
+# trade_signals rows change after insert, so they are pulled by updated_at and
+# upserted by id into a single file
+def sync_signals(cache_dir=CACHE_DIR, chunksize=CHUNK_SIZE):
+    state = load_state(cache_dir)
+    high_water = state.get('trade_signals')
+    query = f"SELECT {', '.join(f'[{column}]' for column in SIGNAL_COLUMNS)} FROM [trade_signals]"
+    params = None
+    if high_water:
+        query += " WHERE [updated_at] > ?"
+        params = [pd.Timestamp(high_water).to_pydatetime()]
+
+    path = os.path.join(cache_dir, 'trade_signals.feather')
+    chunks = []
+    with database.connection() as conn:
+        for chunk in pd.read_sql(query, conn, params=params, chunksize=chunksize):
+            chunks.append(chunk)
+    fetched = sum(len(chunk) for chunk in chunks)
+    if not fetched:
+        return 0
+
+    updates = pd.concat(chunks, ignore_index=True)
+    if os.path.exists(path):
+        existing = read_feather(path).to_pandas()
+        updates = pd.concat([existing, updates], ignore_index=True)
+    signals = updates.drop_duplicates('id', keep='last').sort_values('id').reset_index(drop=True)
+    write_feather(signals, path)
+    state['trade_signals'] = pd.Timestamp(signals['updated_at'].max()).isoformat()
+    save_state(state, cache_dir)
+    return fetched
+
+
+def sync(cache_dir=CACHE_DIR, chunksize=CHUNK_SIZE):
+    candles = sync_candles(cache_dir, chunksize)
+    signals = sync_signals(cache_dir, chunksize)
+    print(f"Cache sync: {candles} new candles, {signals} new or updated signals")
+
+
+def cached_symbols(cache_dir=CACHE_DIR):
+    root = candles_dir(cache_dir)
+    if not os.path.isdir(root):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(root) if name.startswith('symbol='))
+
+
+def partitions(symbol, start=None, end=None, cache_dir=CACHE_DIR):
+    root = os.path.join(candles_dir(cache_dir), f'symbol={symbol}')
+    if not os.path.isdir(root):
+        return []
+    paths = []
+    for name in sorted(os.listdir(root)):
+        if not name.endswith('.feather'):
+            continue
+        date = name[len('date='):-len('.feather')]
+        if (start and date < start) or (end and date > end):
+            continue
+        paths.append(os.path.join(root, name))
+    return paths
+
+
+# Memory-mapped Arrow table of one symbol's candles between two YYYY-MM-DD dates
+def load_symbol_table(symbol, start=None, end=None, columns=None, cache_dir=CACHE_DIR):
+    tables = [read_feather(path, columns) for path in partitions(symbol, start, end, cache_dir)]
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
+
+
+# One symbol's candles as NumPy arrays. With a single partition and no nulls
+# the arrays are views onto the memory-mapped file rather than copies.
+def load_symbol_arrays(symbol, start=None, end=None, columns=('timestamp', 'open', 'high', 'low', 'close', 'volume'), cache_dir=CACHE_DIR):
+    table = load_symbol_table(symbol, start, end, list(columns), cache_dir)
+    if table is None:
+        return None
+    return {column: table.column(column).combine_chunks().to_numpy(zero_copy_only=False) for column in columns}
+
+
+# Cached candles as DataFrames, one symbol at a time, ordered by symbol and
+# timestamp (the order merge_data_streamed expects)
+def iter_candles(symbols=None, start=None, end=None, cache_dir=CACHE_DIR):
+    for symbol in symbols or cached_symbols(cache_dir):
+        table = load_symbol_table(symbol, start, end, CANDLE_COLUMNS, cache_dir)
+        if table is not None:
+            yield table.to_pandas(split_blocks=True)
+
+
+def load_candles(symbols=None, start=None, end=None, cache_dir=CACHE_DIR):
+    frames = list(iter_candles(symbols, start, end, cache_dir))
+    if not frames:
+        return pd.DataFrame(columns=CANDLE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_signals(cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, 'trade_signals.feather')
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=SIGNAL_COLUMNS)
+    return read_feather(path).to_pandas()
+
+
+if __name__ == "__main__":
+    sync()
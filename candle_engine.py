@@ -0,0 +1,163 @@
+import numpy as np
+
+# Column layout of the bar arrays
+OPEN, HIGH, LOW, CLOSE, VOLUME = range(5)
+
+INITIAL_CAPACITY = 64
+HISTORY_DEPTH = 32
+MINUTE = 60000
+# Per-row arrays, as saved by state()
+STATE_ARRAYS = ('count', 'bars', 'bar_end', 'window', 'done', 'done_end', 'completed')
+
+
+def to_candle(values, timestamp):
+    return {
+        'o': float(values[OPEN]),
+        'c': float(values[CLOSE]),
+        'h': float(values[HIGH]),
+        'l': float(values[LOW]),
+        'v': float(values[VOLUME]),
+        't': int(timestamp)
+    }
+
+
+# Running OHLCV aggregation for many symbols and candle sizes at once.
+# State is struct-of-arrays: one row per (size, symbol) for the candle being
+# built, plus a fixed-depth ring of completed candles per row. Minute bars are
+# folded in place, so per-message cost does not depend on the number of
+# symbols or sizes and no message objects are retained.
+#
+# Candles are aligned to wall-clock time: a size-N candle covers the N-minute
+# window of epoch time its bars start in. It closes on the bar that ends the
+# window, or, if that minute never arrives, when a bar from a later window does.
+class CandleEngine:
+    def __init__(self, sizes, capacity=INITIAL_CAPACITY, history=HISTORY_DEPTH):
+        self.sizes = np.asarray(sorted(set(sizes)), dtype=np.int64)
+        self.periods = self.sizes * MINUTE
+        self.history = history
+        self.symbols = {}
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        n_sizes = len(self.sizes)
+        count = np.zeros((n_sizes, capacity), dtype=np.int64)
+        bars = np.zeros((n_sizes, capacity, 5), dtype=np.float64)
+        bar_end = np.zeros((n_sizes, capacity), dtype=np.int64)
+        window = np.full((n_sizes, capacity), -1, dtype=np.int64)
+        done = np.zeros((n_sizes, capacity, self.history, 5), dtype=np.float64)
+        done_end = np.zeros((n_sizes, capacity, self.history), dtype=np.int64)
+        completed = np.zeros((n_sizes, capacity), dtype=np.int64)
+        if self.capacity:
+            old = self.capacity
+            count[:, :old] = self.count
+            bars[:, :old] = self.bars
+            bar_end[:, :old] = self.bar_end
+            window[:, :old] = self.window
+            done[:, :old] = self.done
+            done_end[:, :old] = self.done_end
+            completed[:, :old] = self.completed
+        self.count = count
+        self.bars = bars
+        self.bar_end = bar_end
+        self.window = window
+        self.done = done
+        self.done_end = done_end
+        self.completed = completed
+        self.capacity = capacity
+
+    # The engine's arrays cut to the rows in use, plus the symbols in row order
+    # and the candle sizes, for snapshots
+    def state(self):
+        n = len(self.symbols)
+        state = {name: getattr(self, name)[:, :n].copy() for name in STATE_ARRAYS}
+        state['symbols'] = np.array(list(self.symbols), dtype=str)
+        state['sizes'] = self.sizes.copy()
+        return state
+
+    # Replace the engine's contents with a state() taken with the same candle
+    # sizes and history depth; raises ValueError otherwise
+    def load_state(self, state):
+        if not np.array_equal(state['sizes'], self.sizes) or state['done'].shape[2] != self.history:
+            raise ValueError(f"candle state is for sizes {state['sizes'].tolist()} with history {state['done'].shape[2]}")
+        symbols = [str(symbol) for symbol in state['symbols']]
+        capacity = INITIAL_CAPACITY
+        while capacity < len(symbols):
+            capacity *= 2
+        self.capacity = 0
+        self._allocate(capacity)
+        for name in STATE_ARRAYS:
+            getattr(self, name)[:, :len(symbols)] = state[name]
+        self.symbols = {symbol: row for row, symbol in enumerate(symbols)}
+
+    def row(self, symbol):
+        row = self.symbols.get(symbol)
+        if row is None:
+            row = len(self.symbols)
+            if row >= self.capacity:
+                self._allocate(self.capacity * 2)
+            self.symbols[symbol] = row
+        return row
+
+    # Fold one minute bar into every candle size for the symbol. Returns a
+    # (size, candle, previous_candle) tuple for each candle closed by this bar;
+    # previous_candle is None until a size has closed at least once.
+    def update(self, symbol, open_price, high, low, close, volume, start_timestamp, end_timestamp):
+        row = self.row(symbol)
+        count = self.count[:, row]
+        bars = self.bars[:, row]
+        window = start_timestamp // self.periods
+
+        closed = []
+        # A bar from a later window closes a candle whose last minute never came
+        for index in np.flatnonzero((count > 0) & (self.window[:, row] != window)):
+            closed.append(self._close(index, row))
+
+        bars[count == 0] = (open_price, high, low, close, 0.0)
+        np.maximum(bars[:, HIGH], high, out=bars[:, HIGH])
+        np.minimum(bars[:, LOW], low, out=bars[:, LOW])
+        bars[:, CLOSE] = close
+        bars[:, VOLUME] += volume
+        self.bar_end[:, row] = end_timestamp
+        self.window[:, row] = window
+        count += 1
+
+        for index in np.flatnonzero(end_timestamp >= (window + 1) * self.periods):
+            closed.append(self._close(index, row))
+        return closed
+
+    def _close(self, index, row):
+        candle = to_candle(self.bars[index, row], self.bar_end[index, row])
+        previous = self.last(index, row)
+        slot = self.completed[index, row] % self.history
+        self.done[index, row, slot] = self.bars[index, row]
+        self.done_end[index, row, slot] = self.bar_end[index, row]
+        self.completed[index, row] += 1
+        self.count[index, row] = 0
+        return int(self.sizes[index]), candle, previous
+
+    def last(self, index, row):
+        completed = self.completed[index, row]
+        if not completed:
+            return None
+        slot = (completed - 1) % self.history
+        return to_candle(self.done[index, row, slot], self.done_end[index, row, slot])
+
+    def size_index(self, size):
+        return int(np.searchsorted(self.sizes, size))
+
+    def previous_candle(self, symbol, size):
+        row = self.symbols.get(symbol)
+        if row is None:
+            return None
+        return self.last(self.size_index(size), row)
+
+    # Completed candles for a symbol and size, oldest first, as an (n, 5)
+    # OHLCV array and an (n,) array of end timestamps
+    def recent(self, symbol, size, n=None):
+        row = self.symbols[symbol]
+        index = self.size_index(size)
+        completed = int(self.completed[index, row])
+        n = min(n or self.history, self.history, completed)
+        slots = np.arange(completed - n, completed) % self.history
+        return self.done[index, row, slots], self.done_end[index, row, slots]
@@ -1,26 +1,44 @@
 import asyncio
-from datetime import datetime
-from pytz import timezone
-from database import fetch_open_signals, update_signal, update_signal_stop_loss, save_message
+from signal_book import book, update_signal, update_signal_stop_loss
+from write_queue import writer
+from notifier import MAX_MESSAGE_LENGTH, pack_lines
+from clock import clock
 from secret import Secret
 import discord
 
-utc = timezone('UTC')
-central = timezone('US/Eastern')
-
-async def init_globals(bot):
-    global channel, utc_dt, central_dt, timestamp
-    channel = bot.get_channel(Secret.signal_channel_id)
-    utc_dt = datetime.now(utc)
-    central_dt = utc_dt.astimezone(central)
-    timestamp = central_dt.strftime('%Y-%m-%d %H:%M:%S')
-
-async def check_and_update_signals(bot, candle):
-    await init_globals(bot)  # Initialize global variables
-
-    signals = fetch_open_signals()
+# Coroutine that alerts are handed to; None sends them to the channel directly
+message_sink = None
+# Alert channel for direct sends, looked up once the bot can see it
+channel = None
+
+def set_message_sink(sink):
+    global message_sink
+    message_sink = sink
+
+def signal_channel(bot):
+    global channel
+    # Sharded workers have no bot; their alerts always go through message_sink
+    if channel is None and bot is not None:
+        channel = bot.get_channel(Secret.signal_channel_id)
+    return channel
+
+async def publish(message, bot=None):
+    if message_sink is not None:
+        await message_sink(message)
+    else:
+        await signal_channel(bot).send(message)
+        writer.save_message(message)
+
+# bar_time is the candle's end as a clock.BarTime; the pipeline passes the one
+# shared by every bar of the minute
+async def check_and_update_signals(bot, candle, bar_time=None):
+    signals = book.candidates(candle.symbol, candle.low, candle.high)
+    if not signals:
+        return
     latest_price = candle.close  # Assuming the close price is in the 'c' key
     timestamp = candle.end_timestamp  # Assuming the timestamp is in the 't' key
+    if bar_time is None:
+        bar_time = clock.at(timestamp)
 
     for signal in signals:
         if signal.is_open:
@@ -28,72 +46,84 @@ async def check_and_update_signals(bot, candle):
             if signal.signal_type == 'LONG':
                 if candle.low <= signal.stop_loss:
                     signal.total_profit = round(signal.stop_loss - signal.entry_point, 2)
-                    await send_stoploss_hit_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_stoploss_hit_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
 
                 elif latest_price >= signal.take_profit:
                     signal.total_profit = round(signal.take_profit - signal.entry_point, 2)
-                    await send_take_profit_hit_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_take_profit_hit_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
 
                 elif latest_price - signal.entry_point >= risk:
-                    signal.stop_loss = signal.entry_point  # Move stop loss to break even
-                    update_signal_stop_loss(signal.id, signal.entry_point, timestamp)
+                    update_signal_stop_loss(signal, signal.entry_point, timestamp)  # Move stop loss to break even
             elif signal.signal_type == 'SHORT':
                 if candle.high >= signal.stop_loss:
                     signal.total_profit = round(signal.entry_point - signal.stop_loss, 2)
-                    await send_stoploss_hit_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_stoploss_hit_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
 
                 elif latest_price <= signal.take_profit:
                     signal.total_profit = round(signal.entry_point - signal.take_profit, 2)
-                    await send_take_profit_hit_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_take_profit_hit_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
 
                 elif signal.entry_point - latest_price >= risk:
-                    signal.stop_loss = signal.entry_point  # Move stop loss to break even
-                    update_signal_stop_loss(signal.id, signal.entry_point, timestamp)
+                    update_signal_stop_loss(signal, signal.entry_point, timestamp)  # Move stop loss to break even
         else:
             if signal.signal_type == 'LONG':
                 if candle.high >= signal.invalidated_price:
-                    await send_invalidated_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_invalidated_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
                 elif latest_price >= signal.entry_point:
-                    update_signal(signal.id, signal.total_profit, is_open=True, invalidated=0, timestamp=timestamp, entry_point=latest_price)
+                    update_signal(signal, signal.total_profit, is_open=True, invalidated=0, timestamp=timestamp, entry_point=latest_price)
             elif signal.signal_type == 'SHORT':
                 if candle.low <= signal.invalidated_price:
-                    await send_invalidated_message(signal)
-                    update_signal(signal.id, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
+                    await send_invalidated_message(signal, bar_time, bot)
+                    update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=timestamp)
                 elif latest_price <= signal.entry_point:
-                    update_signal(signal.id, signal.total_profit, is_open=True, invalidated=0, timestamp=timestamp, entry_point=latest_price)
-
-async def send_stoploss_hit_message(signal):
-    message = f"STOPLOSS HIT [{signal.symbol}] at {signal.stop_loss} for total loss of {signal.total_profit:.2f} | {timestamp}"
-    await channel.send(message)
-    save_message(message)
-
-async def send_filled_message(signal):
-    message = f"FILLED {signal.signal_type} [{signal.symbol}] at {signal.entry_point} | {timestamp}"
-    await channel.send(message)
-    save_message(message)
-
-async def send_invalidated_message(signal):
-    message = f"INVALIDATED {signal.signal_type} [{signal.symbol}] at {signal.invalidated_price} | {timestamp}"
-    await channel.send(message)
-    save_message(message)
-
-async def send_take_profit_hit_message(signal):
-    message = f"TAKE PROFIT HIT [{signal.symbol}] at {signal.take_profit} for a total profit of {signal.total_profit:.2f} | {timestamp}"
-    await channel.send(message)
-    save_message(message)
-
-async def send_six_minute_update(bot, latest_price):
-    await init_globals(bot)  # Initialize global variables
-
-    signals = fetch_open_signals()
-    for signal in signals:
+                    update_signal(signal, signal.total_profit, is_open=True, invalidated=0, timestamp=timestamp, entry_point=latest_price)
+
+async def send_stoploss_hit_message(signal, bar_time, bot=None):
+    message = f"STOPLOSS HIT [{signal.symbol}] at {signal.stop_loss} for total loss of {signal.total_profit:.2f} | {bar_time.text}"
+    await publish(message, bot)
+
+async def send_filled_message(signal, bar_time, bot=None):
+    message = f"FILLED {signal.signal_type} [{signal.symbol}] at {signal.entry_point} | {bar_time.text}"
+    await publish(message, bot)
+
+async def send_invalidated_message(signal, bar_time, bot=None):
+    message = f"INVALIDATED {signal.signal_type} [{signal.symbol}] at {signal.invalidated_price} | {bar_time.text}"
+    await publish(message, bot)
+
+async def send_take_profit_hit_message(signal, bar_time, bot=None):
+    message = f"TAKE PROFIT HIT [{signal.symbol}] at {signal.take_profit} for a total profit of {signal.total_profit:.2f} | {bar_time.text}"
+    await publish(message, bot)
+
+# Lines sent under a header line, split into as few messages as fit
+async def publish_summary(header, lines, bot=None):
+    for chunk in pack_lines(lines, MAX_MESSAGE_LENGTH - len(header) - 1):
+        await publish('\n'.join([header] + chunk), bot)
+
+# One summary of every filled signal's P/L at the latest price seen for its
+# symbol (prices maps symbol -> close), instead of a message per signal
+async def send_trade_update(prices, bar_time, bot=None):
+    lines = []
+    for signal in book:
+        latest_price = prices.get(signal.symbol)
+        if not signal.is_open or latest_price is None:
+            continue
         pl = round((latest_price - signal.entry_point), 2) if signal.signal_type == 'LONG' else round((signal.entry_point - latest_price), 2)
-
-        message = f"TRADE UPDATE [{signal.symbol}] {signal.signal_type} P/L: {pl:.2f} | {timestamp}"
-        await channel.send(message)
-        save_message(message)
+        lines.append(f"[{signal.symbol}] {signal.signal_type} P/L: {pl:.2f}")
+    if lines:
+        await publish_summary(f"TRADE UPDATE {len(lines)} open | {bar_time.text}", lines, bot)
+
+# Entries are day orders: signals still waiting for a fill at the end of the
+# session are invalidated, with one summary alert
+async def expire_unfilled_signals(bar_time=None, bot=None):
+    bar_time = bar_time or clock.now()
+    expired = [signal for signal in book if not signal.is_open]
+    for signal in expired:
+        update_signal(signal, signal.total_profit, is_open=False, invalidated=1, timestamp=bar_time.ms)
+    if expired:
+        await publish_summary(f"EXPIRED {len(expired)} unfilled | {bar_time.text}",
+                              [f"[{signal.symbol}] {signal.signal_type} at {signal.entry_point}" for signal in expired], bot)
@@ -0,0 +1,120 @@
+import bisect
+import time
+from datetime import datetime, timedelta, timezone
+from pytz import timezone as zone_info
+
+EASTERN = 'US/Eastern'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+MINUTE = 60000
+DAY = 24 * 60 * MINUTE
+# UTC offset changes are looked up in a table covering these years; anything
+# outside falls back to a full pytz conversion
+FIRST_YEAR = 2000
+LAST_YEAR = 2100
+# Bar times kept converted and formatted. Bars of one minute all share an end
+# timestamp, so this is a few hours of minutes.
+CACHE_SIZE = 4096
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def epoch_ms(year):
+    return int((datetime(year, 1, 1) - EPOCH).total_seconds() * 1000)
+
+
+def utc_offset(zone, ms):
+    return int(datetime.fromtimestamp(ms / 1000, zone).utcoffset().total_seconds() * 1000)
+
+
+# (transitions, offsets): epoch ms at which the zone's UTC offset changes, and
+# the offset (ms) in force before the first transition and after each one.
+# The zone is probed monthly and each change narrowed down to the minute.
+def transition_table(zone, start, end):
+    transitions, offsets = [], [utc_offset(zone, start)]
+    low = start
+    while low < end:
+        high = min(low + 30 * DAY, end)
+        if utc_offset(zone, high) != offsets[-1]:
+            a, b = low, high
+            while b - a > MINUTE:
+                middle = a + (b - a) // MINUTE // 2 * MINUTE
+                if utc_offset(zone, middle) == offsets[-1]:
+                    a = middle
+                else:
+                    b = middle
+            transitions.append(b)
+            offsets.append(utc_offset(zone, b))
+        low = high
+    return transitions, offsets
+
+
+# One bar time, converted once: epoch ms, the Eastern datetime and its
+# TIMESTAMP_FORMAT text as used in alerts
+class BarTime:
+    __slots__ = ('ms', 'eastern', 'text')
+
+    def __init__(self, ms, eastern):
+        self.ms = ms
+        self.eastern = eastern
+        self.text = eastern.strftime(TIMESTAMP_FORMAT)
+
+    def __repr__(self):
+        return f"BarTime({self.ms}, {self.text})"
+
+
+# Epoch-ms -> Eastern time for the hot path. Offsets come from a precomputed
+# DST transition table (a bisect instead of a pytz conversion), and converted
+# times are cached so every signal, update and alert for a bar shares one
+# BarTime.
+class Clock:
+    def __init__(self, zone=EASTERN, first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        self.zone = zone_info(zone)
+        self.start = epoch_ms(first_year)
+        self.end = epoch_ms(last_year + 1)
+        self.transitions, self.offsets = transition_table(self.zone, self.start, self.end)
+        self.fixed = {offset: timezone(timedelta(milliseconds=offset)) for offset in set(self.offsets)}
+        self.cache = {}
+
+    def at(self, ms):
+        bar_time = self.cache.get(ms)
+        if bar_time is None:
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            bar_time = self.cache[ms] = BarTime(ms, self.convert(ms))
+        return bar_time
+
+    # Uncached conversion. Raises OverflowError / OSError / ValueError for
+    # timestamps datetime can't represent, as datetime.fromtimestamp does.
+    def convert(self, ms):
+        if self.start <= ms < self.end:
+            offset = self.offsets[bisect.bisect_right(self.transitions, ms)]
+            return (EPOCH + timedelta(milliseconds=ms + offset)).replace(tzinfo=self.fixed[offset])
+        return datetime.fromtimestamp(ms / 1000, timezone.utc).astimezone(self.zone)
+
+    def to_eastern(self, ms):
+        return self.at(ms).eastern
+
+    # UTC offset (ms) in force at epoch ms
+    def offset(self, ms):
+        if self.start <= ms < self.end:
+            return self.offsets[bisect.bisect_right(self.transitions, ms)]
+        return utc_offset(self.zone, ms)
+
+    # Epoch ms of a naive Eastern wall-clock datetime. Times skipped or
+    # repeated by a DST change resolve to one side of it.
+    def local_ms(self, local):
+        naive = int((local - EPOCH).total_seconds() * 1000)
+        return naive - self.offset(naive - self.offset(naive))
+
+    # Convert every minute in [start, end] ahead of time
+    def prime(self, start, end):
+        for ms in range(start - start % MINUTE, end + 1, MINUTE):
+            self.at(ms)
+
+    # The wall-clock time, not cached
+    def now(self):
+        ms = int(time.time() * 1000)
+        return BarTime(ms, self.convert(ms))
+
+
+clock = Clock()
@@ -1,120 +1,383 @@
 import pyodbc
-from datetime import datetime
-from pytz import timezone
+import queue
+import threading
+from contextlib import contextmanager
+from clock import clock
 from secret import Secret
 
+POOL_SIZE = 4
+POOL_TIMEOUT = 30
+# 11 parameters per signal row; SQL Server allows 2100 per statement
+INSERT_CHUNK_SIZE = 150
+# 8 parameters per row of a set-based update
+UPDATE_CHUNK_SIZE = 250
+
 connection_string = f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={Secret.server};DATABASE={Secret.database};UID={Secret.username};PWD={Secret.password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
 def create_connection():
     return pyodbc.connect(connection_string)
 
+
+class ConnectionPool:
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def fill(self):
+        connections = []
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            try:
+                connections.append(create_connection())
+            except pyodbc.Error:
+                self._discard(None)
+                raise
+        for conn in connections:
+            self._idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return create_connection()
+            except pyodbc.Error:
+                self._discard(None)
+                raise
+        return self._idle.get(timeout=self.timeout)
+
+    def _discard(self, conn):
+        if conn is not None:
+            try:
+                conn.close()
+            except pyodbc.Error:
+                pass
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except pyodbc.Error:
+            # The connection may be broken; don't hand it out again
+            self._discard(conn)
+            raise
+        except BaseException:
+            conn.rollback()
+            self._idle.put(conn)
+            raise
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+pool = ConnectionPool()
+connection = pool.connection
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+INSERT_SIGNAL_SQL = '''
+    INSERT INTO trade_signals (symbol, signal_type, entry_point, stop_loss, invalidated_price, take_profit, sentiment, volume_confirmed, created_at, updated_at, confidence)
+    OUTPUT INSERTED.id
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPDATE_STOP_LOSS_SQL = '''
+    UPDATE trade_signals
+    SET stop_loss = ?, updated_at = ?
+    WHERE id = ?
+'''
+
+UPDATE_SIGNAL_SQL = '''
+    UPDATE trade_signals
+    SET total_profit = ?, is_open = ?, invalidated = ?, updated_at = ?
+    WHERE id = ?
+'''
+
+UPDATE_SIGNAL_ENTRY_SQL = '''
+    UPDATE trade_signals
+    SET total_profit = ?, is_open = ?, invalidated = ?, updated_at = ?, entry_point = ?
+    WHERE id = ?
+'''
+
+CREATE_TABLE_SQL = '''
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='trade_signals' AND xtype='U')
+    CREATE TABLE trade_signals (
+        id INT PRIMARY KEY IDENTITY(1,1),
+        symbol NVARCHAR(50) NOT NULL,
+        signal_type NVARCHAR(10) NOT NULL,
+        entry_point FLOAT NOT NULL,
+        stop_loss FLOAT NOT NULL,
+        invalidated_price FLOAT,
+        take_profit FLOAT,
+        sentiment FLOAT,
+        is_open BIT DEFAULT 0,
+        invalidated BIT DEFAULT 0,
+        volume_confirmed BIT DEFAULT 0,
+        total_profit FLOAT,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        confidence NVARCHAR(10)
+    );
+'''
+
+# Migrations run after CREATE_TABLE_SQL; each one checks whether it is needed
+CREATE_MESSAGES_TABLE_SQL = '''
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='signal_messages' AND xtype='U')
+    CREATE TABLE signal_messages (
+        id INT PRIMARY KEY IDENTITY(1,1),
+        message NVARCHAR(MAX),
+        created_at DATETIME DEFAULT GETDATE()
+    );
+'''
+
+# Filtered, covering index for the open signal load and the state columns
+# every transition touches
+CREATE_OPEN_SIGNALS_INDEX_SQL = '''
+    IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_trade_signals_open' AND object_id=OBJECT_ID('trade_signals'))
+    CREATE NONCLUSTERED INDEX IX_trade_signals_open
+    ON trade_signals (invalidated, is_open, symbol)
+    INCLUDE (signal_type, entry_point, stop_loss, invalidated_price, take_profit, sentiment, volume_confirmed, total_profit, created_at, updated_at, confidence)
+    WHERE invalidated = 0;
+'''
+
+SCHEMA_SQL = (CREATE_TABLE_SQL, CREATE_MESSAGES_TABLE_SQL, CREATE_OPEN_SIGNALS_INDEX_SQL)
+
+SIGNAL_COLUMNS = (
+    'id', 'symbol', 'signal_type', 'entry_point', 'stop_loss', 'invalidated_price',
+    'take_profit', 'sentiment', 'is_open', 'invalidated', 'volume_confirmed',
+    'total_profit', 'created_at', 'updated_at', 'confidence'
+)
+
+# The literal invalidated = 0 lets SQL Server use the filtered index
+OPEN_SIGNALS_SQL = f'''
+    SELECT {', '.join(SIGNAL_COLUMNS)}
+    FROM trade_signals
+    WHERE invalidated = 0
+'''
+
+# Columns a set-based update can change, in update row order. Bit i of a
+# row's `changed` mask says whether column i is set by that row.
+UPDATE_COLUMNS = ('stop_loss', 'total_profit', 'is_open', 'invalidated', 'entry_point', 'updated_at')
+# The columns each single-row update statement sets, in parameter order
+UPDATE_STATEMENT_COLUMNS = {
+    UPDATE_STOP_LOSS_SQL: ('stop_loss', 'updated_at'),
+    UPDATE_SIGNAL_SQL: ('total_profit', 'is_open', 'invalidated', 'updated_at'),
+    UPDATE_SIGNAL_ENTRY_SQL: ('total_profit', 'is_open', 'invalidated', 'updated_at', 'entry_point'),
+}
+
+INSERT_MESSAGE_SQL = '''
+    INSERT INTO signal_messages (message)
+    VALUES (?)
+'''
+
 def create_table():
-    with create_connection() as conn:
+    with connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='trade_signals' AND xtype='U')
-            CREATE TABLE trade_signals (
-                id INT PRIMARY KEY IDENTITY(1,1),
-                symbol NVARCHAR(50) NOT NULL,
-                signal_type NVARCHAR(10) NOT NULL,
-                entry_point FLOAT NOT NULL,
-                stop_loss FLOAT NOT NULL,
-                invalidated_price FLOAT,
-                take_profit FLOAT,
-                sentiment FLOAT,
-                is_open BIT DEFAULT 0,
-                invalidated BIT DEFAULT 0,
-                volume_confirmed BIT DEFAULT 0,
-                total_profit FLOAT,
-                created_at DATETIME NOT NULL,
-                updated_at DATETIME NOT NULL,
-                confidence NVARCHAR(10)
-            );
-        ''')
+        for sql in SCHEMA_SQL:
+            cursor.execute(sql)
         conn.commit()
 
-def save_signal(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence):
-    create_table()  # Ensure the table exists
-    
+# Run the schema check once per process instead of before every statement
+def ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            create_table()
+            _schema_ready = True
+
+# Epoch-ms timestamp -> Eastern datetime, through the shared clock's cache
+def to_eastern(timestamp):
+    return clock.to_eastern(timestamp)
+
+def calculate_take_profit(signal_type, entry_point, stop_loss):
+    # Calculate the profit target (PT), which is 3 times the risk
+    risk = abs(entry_point - stop_loss)
+    if risk < 0.05:
+        risk = 0.05
+    return entry_point + 3 * risk if signal_type == 'LONG' else entry_point - 3 * risk
+
+def signal_params(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence):
     # Convert volume_confirmed to standard Python bool
     volume_confirmed = bool(volume_confirmed)
-    
+
     # Convert the integer timestamp to a datetime object
     try:
-        utc_dt = datetime.fromtimestamp(timestamp / 1000, timezone('UTC'))  # Assuming timestamp is in milliseconds
-        est_time = utc_dt.astimezone(timezone('US/Eastern'))
+        est_time = to_eastern(timestamp)
     except (OSError, OverflowError, ValueError):
         print(f"Invalid timestamp: {timestamp}")
-        return
-    
+        return None
+
     # Convert confidence to string
     confidence = str(confidence)
-    
-    # Calculate the profit target (PT), which is 3 times the risk
-    risk = abs(entry_point - stop_loss)
-    if risk < 0.05:
-        risk = 0.05
-    take_profit = entry_point + 3 * risk if signal_type == 'LONG' else entry_point - 3 * risk
-    
-    with create_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO trade_signals (symbol, signal_type, entry_point, stop_loss, invalidated_price, take_profit, sentiment, volume_confirmed, created_at, updated_at, confidence)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (symbol, signal_type, float(entry_point), float(stop_loss), float(invalidated_price), float(take_profit), float(sentiment) if sentiment is not None else None, volume_confirmed, est_time, est_time, confidence))
-        conn.commit()
 
-def update_signal_stop_loss(signal_id, new_stop_loss, timestamp):
+    take_profit = calculate_take_profit(signal_type, entry_point, stop_loss)
+    return (symbol, signal_type, float(entry_point), float(stop_loss), float(invalidated_price), float(take_profit), float(sentiment) if sentiment is not None else None, volume_confirmed, est_time, est_time, confidence)
+
+def stop_loss_params(signal_id, new_stop_loss, timestamp):
     # Convert the integer timestamp to a datetime object
     try:
-        utc_dt = datetime.fromtimestamp(timestamp / 1000, timezone('UTC'))  # Assuming timestamp is in milliseconds
-        est_time = utc_dt.astimezone(timezone('US/Eastern'))
+        est_time = to_eastern(timestamp)
     except (OSError, OverflowError, ValueError):
         print(f"Invalid timestamp: {timestamp}")
+        return None
+    return (float(new_stop_loss), est_time, signal_id)
+
+def update_params(signal_id, total_profit, is_open, invalidated, timestamp, entry_point=None):
+    cst_time = to_eastern(timestamp)
+    if entry_point is not None:
+        return UPDATE_SIGNAL_ENTRY_SQL, (total_profit, is_open, invalidated, cst_time, entry_point, signal_id)
+    return UPDATE_SIGNAL_SQL, (total_profit, is_open, invalidated, cst_time, signal_id)
+
+def save_signal(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence):
+    ensure_schema()
+    params = signal_params(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence)
+    if params is None:
+        return None
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(INSERT_SIGNAL_SQL, params)
+        signal_id = cursor.fetchone()[0]
+        conn.commit()
+    return signal_id
+
+def update_signal_stop_loss(signal_id, new_stop_loss, timestamp):
+    params = stop_loss_params(signal_id, new_stop_loss, timestamp)
+    if params is None:
         return
-    
-    with create_connection() as conn:
+
+    with connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE trade_signals
-            SET stop_loss = ?, updated_at = ?
-            WHERE id = ?
-        ''', (float(new_stop_loss), est_time, signal_id))
+        cursor.execute(UPDATE_STOP_LOSS_SQL, params)
         conn.commit()
 
 def update_signal(signal_id, total_profit, is_open, invalidated, timestamp, entry_point=None):
-    # Convert timestamp to CST
+    sql, params = update_params(signal_id, total_profit, is_open, invalidated, timestamp, entry_point)
 
-    utc_dt = datetime.fromtimestamp(timestamp / 1000, timezone('UTC'))  # Assuming timestamp is in milliseconds
-    cst_time = utc_dt.astimezone(timezone('US/Eastern'))
-    
-    with create_connection() as conn:
+    with connection() as conn:
         cursor = conn.cursor()
-        if entry_point is not None:
-            cursor.execute('''
-                UPDATE trade_signals
-                SET total_profit = ?, is_open = ?, invalidated = ?, updated_at = ?, entry_point = ?
-                WHERE id = ?
-            ''', (total_profit, is_open, invalidated, cst_time, entry_point, signal_id))
-        else:
-            cursor.execute('''
-                UPDATE trade_signals
-                SET total_profit = ?, is_open = ?, invalidated = ?, updated_at = ?
-                WHERE id = ?
-            ''', (total_profit, is_open, invalidated, cst_time, signal_id))
+        cursor.execute(sql, params)
         conn.commit()
 
 def fetch_open_signals():
-    create_table() 
-    with create_connection() as conn:
+    ensure_schema()
+    with connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM trade_signals WHERE invalidated = 0')
+        cursor.execute(OPEN_SIGNALS_SQL)
         return cursor.fetchall()
 
 def save_message(message):
-    with create_connection() as conn:
+    with connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO signal_messages (message)
-            VALUES (?)
-        ''', (message,))
+        cursor.execute(INSERT_MESSAGE_SQL, (message,))
         conn.commit()
+
+# Multi-row insert of signal parameter tuples in one round trip per chunk.
+# executemany discards OUTPUT rows, so the new ids are matched back to the
+# input rows by their identifying columns and returned in input order.
+def insert_signals(cursor, rows):
+    ids = []
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + INSERT_CHUNK_SIZE]
+        cursor.execute(insert_signals_sql(len(chunk)), [param for row in chunk for param in row])
+        ids.extend(inserted_ids(chunk, cursor.fetchall()))
+    return ids
+
+def insert_signals_sql(count):
+    values = ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'] * count)
+    return f'''
+            INSERT INTO trade_signals (symbol, signal_type, entry_point, stop_loss, invalidated_price, take_profit, sentiment, volume_confirmed, created_at, updated_at, confidence)
+            OUTPUT INSERTED.id, INSERTED.symbol, INSERTED.signal_type, INSERTED.entry_point, INSERTED.stop_loss
+            VALUES {values}
+        '''
+
+# Ids of the OUTPUT rows of one insert_signals_sql statement, in chunk order
+def inserted_ids(chunk, outputs):
+    inserted = {}
+    for output in sorted(outputs, key=lambda output: output[0]):
+        inserted.setdefault(tuple(output[1:]), []).append(output[0])
+    return [inserted[tuple(row[:4])].pop(0) for row in chunk]
+
+# Send (sql, params) statements in order, with consecutive statements that
+# share the same SQL going out as a single executemany. Returns the number of
+# executemany calls made.
+def executemany_runs(cursor, statements):
+    runs = 0
+    for sql, params in statement_runs(statements):
+        cursor.executemany(sql, params)
+        runs += 1
+    return runs
+
+# Consecutive (sql, params) statements grouped as (sql, [params, ...])
+def statement_runs(statements):
+    run_sql, run_params = None, []
+    for sql, params in statements:
+        if sql != run_sql and run_params:
+            yield run_sql, run_params
+            run_params = []
+        run_sql = sql
+        run_params.append(params)
+    if run_params:
+        yield run_sql, run_params
+
+# Collapse single-row updates ((sql, params) with the signal id last) into
+# one row per signal for update_signals_sql: (id, changed, *UPDATE_COLUMNS).
+# Later updates to a signal win column by column, as if run in order.
+def signal_update_rows(updates):
+    merged = {}
+    for sql, params in updates:
+        values = merged.setdefault(params[-1], {})
+        values.update(zip(UPDATE_STATEMENT_COLUMNS[sql], params[:-1]))
+    rows = []
+    for signal_id, values in merged.items():
+        changed = sum(1 << i for i, column in enumerate(UPDATE_COLUMNS) if column in values)
+        rows.append((signal_id, changed) + tuple(values.get(column) for column in UPDATE_COLUMNS))
+    return rows
+
+# One UPDATE joined to a VALUES list of `count` signal_update_rows rows, so
+# every transition in a batch costs a single round trip
+def update_signals_sql(count):
+    values = ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?)'] * count)
+    assignments = ',\n            '.join(
+        f'{column} = CASE WHEN v.changed & {1 << i} = {1 << i} THEN v.{column} ELSE t.{column} END'
+        for i, column in enumerate(UPDATE_COLUMNS))
+    return f'''
+        UPDATE t SET
+            {assignments}
+        FROM trade_signals AS t
+        JOIN (VALUES {values}) AS v (id, changed, {', '.join(UPDATE_COLUMNS)})
+        ON t.id = v.id
+    '''
+
+# Apply single-row updates as set-based statements. Returns the number of
+# round trips made.
+def update_signals(cursor, updates):
+    rows = signal_update_rows(updates)
+    for start in range(0, len(rows), UPDATE_CHUNK_SIZE):
+        chunk = rows[start:start + UPDATE_CHUNK_SIZE]
+        cursor.execute(update_signals_sql(len(chunk)), [param for row in chunk for param in row])
+    return -(-len(rows) // UPDATE_CHUNK_SIZE)
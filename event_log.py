@@ -0,0 +1,473 @@
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+import numpy as np
+from recovery import Bar
+
+EVENT_LOG = 'events.log'
+SNAPSHOT = 'snapshot.npz'
+SNAPSHOT_FORMAT = 1
+# Seconds between snapshots; restarts replay at most this much of the log
+SNAPSHOT_INTERVAL = 60
+# Log files are extended this many bytes at a time
+LOG_GROWTH = 16 * 1024 * 1024
+# Rotated logs kept next to the live one, as events-<log id>.log
+LOG_RETENTION = 5
+# Bars folded per call when replaying the log
+REPLAY_CHUNK = 4096
+
+MAGIC = b'ZXEVLOG1'
+# magic, log id (creation epoch ms), end of the last complete record
+HEADER = struct.Struct('<8sqq')
+# payload length, kind, CRC-32 of the payload
+RECORD = struct.Struct('<IBI')
+BAR_EVENT = 1
+SIGNAL_EVENT = 2
+SAVED_EVENT = 3
+UPDATE_EVENT = 4
+# start, end, open, high, low, close, volume, recovered; the symbol follows
+BAR = struct.Struct('<qq5d?')
+# end timestamp, candle size, entry, stop, invalidated, confidence, volume
+# confirmed; symbol, signal type and rule name follow, NUL-separated
+SIGNAL = struct.Struct('<qH4d?')
+# log id and offset after the record of the signal event whose insert committed
+SAVED = struct.Struct('<qq')
+# log id and offset of the signal event, then the signal's state after a
+# change: timestamp, is open, invalidated, entry, stop, total profit (NaN
+# for none)
+UPDATE = struct.Struct('<qqq??3d')
+
+
+def encode_bar(bar):
+    return BAR.pack(bar.start_timestamp, bar.end_timestamp, bar.open, bar.high, bar.low, bar.close, bar.volume,
+                    getattr(bar, 'recovered', False)) + bar.symbol.encode()
+
+
+def decode_bar(payload):
+    start, end, open_, high, low, close, volume, recovered = BAR.unpack_from(payload)
+    return Bar(bytes(payload[BAR.size:]).decode(), open_, high, low, close, volume, start, end, recovered)
+
+
+def decode_signal(payload):
+    timestamp, size, entry_point, stop_loss, invalidated_price, confidence, volume_confirmed = SIGNAL.unpack_from(payload)
+    symbol, signal_type, rule = bytes(payload[SIGNAL.size:]).decode().split('\0')
+    return {
+        'rule': rule,
+        'symbol': symbol,
+        'size': size,
+        'signal_type': signal_type,
+        'entry_point': entry_point,
+        'stop_loss': stop_loss,
+        'invalidated_price': invalidated_price,
+        'volume_confirmed': volume_confirmed,
+        'timestamp': timestamp,
+        'confidence': confidence,
+    }
+
+
+def decode_saved(payload):
+    return SAVED.unpack_from(payload)
+
+
+# ((log id, offset), update) with update as BotState.record_update builds it
+def decode_update(payload):
+    log_id, offset, timestamp, is_open, invalidated, entry_point, stop_loss, total_profit = UPDATE.unpack_from(payload)
+    return (log_id, offset), {
+        'timestamp': timestamp,
+        'is_open': is_open,
+        'invalidated': invalidated,
+        'entry_point': entry_point,
+        'stop_loss': stop_loss,
+        'total_profit': None if total_profit != total_profit else total_profit,
+    }
+
+
+DECODERS = {BAR_EVENT: decode_bar, SIGNAL_EVENT: decode_signal, SAVED_EVENT: decode_saved, UPDATE_EVENT: decode_update}
+
+
+# (kind, payload, offset after the record) for the records of a log buffer
+# from start, stopping at end or at the first record that is torn or fails
+# its checksum
+def scan(buffer, start, end):
+    offset = start
+    while offset + RECORD.size <= end:
+        length, kind, crc = RECORD.unpack_from(buffer, offset)
+        stop = offset + RECORD.size + length
+        if stop > end:
+            return
+        payload = buffer[offset + RECORD.size:stop]
+        if zlib.crc32(payload) != crc:
+            return
+        yield kind, payload, stop
+        offset = stop
+
+
+# Append-only binary log of the bars the bot aggregated, the signals it
+# emitted and which of those reached the database, in a memory-mapped file. An append is a struct pack and a copy
+# into the map; the header's end offset moves only after the record is in
+# place, so a crash never exposes half a record. Pages reach the disk through
+# the OS (a process crash loses nothing) and are fsynced with every snapshot.
+class EventLog:
+    def __init__(self, path, growth=LOG_GROWTH):
+        self.path = path
+        self.growth = growth
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(growth)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if exists:
+            magic, self.id, self.end = HEADER.unpack_from(self.mm)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an event log")
+        else:
+            self.id, self.end = int(time.time() * 1000), HEADER.size
+            HEADER.pack_into(self.mm, 0, MAGIC, self.id, self.end)
+
+    def append(self, kind, payload):
+        stop = self.end + RECORD.size + len(payload)
+        if stop > len(self.mm):
+            self.mm.resize(max(len(self.mm) + self.growth, stop))
+        RECORD.pack_into(self.mm, self.end, len(payload), kind, zlib.crc32(payload))
+        self.mm[self.end + RECORD.size:stop] = payload
+        self.end = stop
+        HEADER.pack_into(self.mm, 0, MAGIC, self.id, self.end)
+
+    def bars(self, bars):
+        for bar in bars:
+            self.append(BAR_EVENT, encode_bar(bar))
+
+    def signal(self, rule, symbol, size, signal_type, entry_point, stop_loss, invalidated_price, volume_confirmed, timestamp, confidence):
+        self.append(SIGNAL_EVENT, SIGNAL.pack(timestamp, size, entry_point, stop_loss, invalidated_price, confidence, bool(volume_confirmed))
+                    + '\0'.join((symbol, signal_type, rule)).encode())
+
+    def saved(self, log_id, offset):
+        self.append(SAVED_EVENT, SAVED.pack(log_id, offset))
+
+    def update(self, log_id, offset, timestamp, is_open, invalidated, entry_point, stop_loss, total_profit):
+        self.append(UPDATE_EVENT, UPDATE.pack(log_id, offset, timestamp, is_open, invalidated, entry_point, stop_loss,
+                                              float('nan') if total_profit is None else total_profit))
+
+    # Decoded (kind, event, offset after it) from start (default: the first record)
+    def read(self, start=HEADER.size):
+        for kind, payload, offset in scan(self.mm, start, self.end):
+            yield kind, DECODERS[kind](payload), offset
+
+    # Drop everything after offset (a torn or corrupt tail)
+    def truncate(self, offset):
+        self.end = offset
+        HEADER.pack_into(self.mm, 0, MAGIC, self.id, self.end)
+
+    # Safe from any thread: fsync on the descriptor writes back the mapped
+    # pages without holding the GIL the way mmap.flush() does
+    def sync(self):
+        os.fsync(self.file.fileno())
+
+    # Trim the preallocated space and close
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.truncate(self.end)
+        self.file.close()
+
+
+# Decoded (kind, event) records of a log file, without opening it for writing
+def read_events(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, _, end = HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an event log")
+        for kind, payload, _ in scan(mm, HEADER.size, end):
+            yield kind, DECODERS[kind](payload)
+
+
+def read_bars(path):
+    return [event for kind, event in read_events(path) if kind == BAR_EVENT]
+
+
+def write_snapshot(path, arrays):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_snapshot(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def prefixed(state, prefix):
+    return {name[len(prefix):]: array for name, array in state.items() if name.startswith(prefix)}
+
+
+# Durable aggregation state for one BarProcessor, kept in a directory:
+#   events.log          the EventLog of bars and signals since the last rotation
+#   events-<id>.log     rotated logs (LOG_RETENTION of them)
+#   snapshot.npz        the candle engine, rolling features and gap-recovery
+#                       cursor as arrays, the signals not yet in the database,
+#                       and the log id and offset they correspond to
+#
+# The aggregate stage records each batch's bars before folding them and calls
+# after_batch() once it is done, so snapshots are always taken at a point
+# where state and log agree; the arrays are copied there and written on an
+# executor thread. restore() loads the snapshot and folds the log tail back
+# in (no scoring, alerts or writes), so a restarted bot has its partial and
+# previous candles and GapRecovery backfills only the downtime.
+#
+# Saved signals live in the database and SignalBook.load reads them back.
+# A signal still in the write queue is logged as pending until the writer's
+# on_saved hook reports its insert committed (a SAVED_EVENT), and each change
+# to it meanwhile (fill, stop move, close; signal_book's recorder hook) is
+# logged as an UPDATE_EVENT. restore() queues the signals still pending after
+# the snapshot and log tail again with their last logged state, so a crash
+# loses no signal and a filled or closed one does not come back as new (one
+# whose insert committed just before the crash can be saved twice).
+class BotState:
+    def __init__(self, processor, directory, interval=SNAPSHOT_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.processor = processor
+        self.directory = directory
+        self.interval = interval
+        self.log_path = os.path.join(directory, EVENT_LOG)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT)
+        self.log = EventLog(self.log_path)
+        self._last_snapshot = time.monotonic()
+        self._writing = None
+        self._rotate = False
+        # {id(signal): (signal, (log id, offset), event, last update or None)}
+        # of the signals whose insert has not committed yet
+        self.pending = {}
+
+    def record_bars(self, bars):
+        self.log.bars(bars)
+
+    # signal is the signal_book.Signal save_signal returned for the event
+    def record_signal(self, signal, rule, symbol, size, signal_type, entry_point, stop_loss, invalidated_price, volume_confirmed, timestamp, confidence):
+        event = {
+            'rule': rule,
+            'symbol': symbol,
+            'size': int(size),
+            'signal_type': signal_type,
+            'entry_point': float(entry_point),
+            'stop_loss': float(stop_loss),
+            'invalidated_price': float(invalidated_price),
+            'volume_confirmed': bool(volume_confirmed),
+            'timestamp': int(timestamp),
+            'confidence': float(confidence),
+        }
+        self.log.signal(**event)
+        self.pending[id(signal)] = (signal, (self.log.id, self.log.end), event, None)
+
+    # signal_book's recorder hook: signal changed state at timestamp
+    def record_update(self, signal, timestamp):
+        pending = self.pending.get(id(signal))
+        if pending is None:
+            return
+        update = {
+            'timestamp': int(timestamp),
+            'is_open': bool(signal.is_open),
+            'invalidated': bool(signal.invalidated),
+            'entry_point': float(signal.entry_point),
+            'stop_loss': float(signal.stop_loss),
+            'total_profit': None if signal.total_profit is None else float(signal.total_profit),
+        }
+        self.log.update(*pending[1], **update)
+        self.pending[id(signal)] = pending[:3] + (update,)
+
+    # The write queue's on_saved hook: signal's insert has committed
+    def saved(self, signal):
+        pending = self.pending.pop(id(signal), None)
+        if pending is not None:
+            self.log.saved(*pending[1])
+
+    def archive_path(self, log_id):
+        return os.path.join(self.directory, f'events-{log_id}.log')
+
+    def capture(self):
+        processor = self.processor
+        arrays = {f'candles.{name}': array for name, array in processor.candles.state().items()}
+        arrays.update({f'features.{name}': array for name, array in processor.features.state().items()})
+        last_start = processor.recovery.last_start
+        arrays['recovery.symbols'] = np.array(list(last_start), dtype=str)
+        arrays['recovery.last_start'] = np.array(list(last_start.values()), dtype=np.int64)
+        arrays['signals'] = np.array(json.dumps([dict(event, log_id=ref[0], offset=ref[1], update=update)
+                                                 for _, ref, event, update in self.pending.values()]))
+        arrays['meta'] = np.array(json.dumps({
+            'format': SNAPSHOT_FORMAT,
+            'log_id': self.log.id,
+            'log_offset': self.log.end,
+            'created': int(time.time() * 1000),
+        }))
+        return arrays
+
+    def _busy(self):
+        return self._writing is not None and not self._writing.done()
+
+    def after_batch(self):
+        if self._busy():
+            return
+        if self._rotate:
+            self.rotate()
+        elif time.monotonic() - self._last_snapshot >= self.interval:
+            self.snapshot()
+
+    def snapshot(self):
+        self._last_snapshot = time.monotonic()
+        self._writing = asyncio.get_running_loop().run_in_executor(None, self._write, self.log, self.capture())
+
+    def _write(self, log, arrays):
+        started = time.perf_counter()
+        try:
+            log.sync()
+            write_snapshot(self.snapshot_path, arrays)
+        except OSError as e:
+            print(f"Snapshot to {self.snapshot_path} failed: {e}")
+            return
+        print(f"Snapshot at log offset {log.end} written in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    # Rotate the log at the next batch end (e.g. after the close)
+    def request_rotation(self):
+        self._rotate = True
+
+    # Archive the live log, start a new one and snapshot against it
+    def rotate(self):
+        self._rotate = False
+        old = self.log
+        old.close()
+        os.replace(old.path, self.archive_path(old.id))
+        self.log = EventLog(self.log_path)
+        archives = sorted((name for name in os.listdir(self.directory) if name.startswith('events-') and name.endswith('.log')),
+                          key=lambda name: int(name[len('events-'):-len('.log')]))
+        for name in archives[:-LOG_RETENTION or None]:
+            os.remove(os.path.join(self.directory, name))
+        self.snapshot()
+
+    # Load the snapshot, if there is a usable one, fold in the bars logged
+    # after it and queue the signals that never reached the database again.
+    # Returns the number of bars replayed.
+    def restore(self):
+        started = time.perf_counter()
+        processor = self.processor
+        segments = [(self.log_path, HEADER.size)]
+        # {(log id, offset): (event, last update or None)} of the signals not
+        # known to be saved
+        pending = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                state = read_snapshot(self.snapshot_path)
+                meta = json.loads(str(state['meta']))
+                processor.candles.load_state(prefixed(state, 'candles.'))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring snapshot {self.snapshot_path}: {e}")
+            else:
+                try:
+                    processor.features.load_state(prefixed(state, 'features.'))
+                except (ValueError, KeyError) as e:
+                    print(f"Rolling features start over: {e}")
+                processor.recovery.last_start = dict(zip((str(symbol) for symbol in state['recovery.symbols']),
+                                                         state['recovery.last_start'].tolist()))
+                if 'signals' in state:
+                    for event in json.loads(str(state['signals'])):
+                        pending[(event.pop('log_id'), event.pop('offset'))] = (event, event.pop('update', None))
+                if meta['log_id'] == self.log.id:
+                    segments = [(self.log_path, meta['log_offset'])]
+                elif os.path.exists(self.archive_path(meta['log_id'])):
+                    segments.insert(0, (self.archive_path(meta['log_id']), meta['log_offset']))
+
+        replayed = 0
+        for path, start in segments:
+            log = self.log if path == self.log_path else EventLog(path)
+            end = start
+            bars = []
+            for kind, event, end in log.read(start):
+                if kind == BAR_EVENT:
+                    bars.append(event)
+                    if len(bars) >= REPLAY_CHUNK:
+                        replayed += self.replay(bars)
+                        bars = []
+                elif kind == SIGNAL_EVENT:
+                    pending[(log.id, end)] = (event, None)
+                elif kind == SAVED_EVENT:
+                    pending.pop(tuple(event), None)
+                elif kind == UPDATE_EVENT:
+                    ref, update = event
+                    if ref in pending:
+                        pending[ref] = (pending[ref][0], update)
+            replayed += self.replay(bars)
+            if log is not self.log:
+                log.close()
+            elif end < log.end:
+                print(f"Dropping {log.end - end} bytes of torn or corrupt records from {path}")
+                log.truncate(end)
+        self.requeue(pending.values())
+        print(f"Restored aggregation state for {len(processor.candles.symbols)} tickers, replayed {replayed} bars and "
+              f"queued {len(pending)} unsaved signals in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return replayed
+
+    # Queue the (event, last update) signals whose insert never committed
+    # again, log them as pending against the live log and bring them to
+    # their last logged state. No alerts are sent; those went out before the
+    # crash. A closed signal is written to the database and leaves the book.
+    # A change whose alert went out just before the crash, but was never
+    # logged, is lost.
+    def requeue(self, signals):
+        from signal_book import save_signal, update_signal, update_signal_stop_loss
+        for event, update in signals:
+            signal = save_signal(event['symbol'], event['signal_type'], event['entry_point'], event['stop_loss'], event['invalidated_price'],
+                                 None, event['volume_confirmed'], event['timestamp'], event['confidence'])
+            if signal is None:
+                continue
+            self.record_signal(signal, **event)
+            if update is None:
+                continue
+            if update['stop_loss'] != signal.stop_loss:
+                update_signal_stop_loss(signal, update['stop_loss'], update['timestamp'])
+            if update['is_open'] != signal.is_open or update['invalidated'] != signal.invalidated:
+                update_signal(signal, update['total_profit'], update['is_open'], update['invalidated'], update['timestamp'],
+                              entry_point=update['entry_point'] if update['entry_point'] != signal.entry_point else None)
+
+    def replay(self, bars):
+        last_start = self.processor.recovery.last_start
+        self.processor.fold(bars)
+        for bar in bars:
+            last_start[bar.symbol] = bar.start_timestamp
+        return len(bars)
+
+    # Last snapshot and log flush, once the pipeline has stopped
+    async def close(self):
+        if self._writing is not None:
+            await self._writing
+        self._write(self.log, self.capture())
+        self.log.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize an event log; backtest.py replays its bars")
+    parser.add_argument('path', help="Event log, e.g. state/events.log")
+    parser.add_argument('--signals', action='store_true', help="List the signals emitted")
+    args = parser.parse_args()
+
+    bars, symbols, signals, saved = 0, set(), [], 0
+    first = last = None
+    for kind, event in read_events(args.path):
+        if kind == BAR_EVENT:
+            bars += 1
+            symbols.add(event.symbol)
+            first = event.start_timestamp if first is None else min(first, event.start_timestamp)
+            last = event.start_timestamp if last is None else max(last, event.start_timestamp)
+        elif kind == SIGNAL_EVENT:
+            signals.append(event)
+        elif kind == SAVED_EVENT:
+            saved += 1
+    print(f"{bars} bars for {len(symbols)} tickers from {first} to {last}, {len(signals)} signals ({saved} saved)")
+    if args.signals:
+        for signal in signals:
+            print(signal)
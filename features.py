@@ -0,0 +1,189 @@
+import json
+import numpy as np
+
+EMA_FAST = 9
+EMA_SLOW = 21
+ATR_PERIOD = 14
+VOLUME_WINDOW = 20
+RETURN_WINDOW = 5
+# VWAP accumulates over one session; sessions are split on the UTC day, which
+# never falls inside US market hours
+SESSION_LENGTH = 24 * 60 * 60000
+INITIAL_CAPACITY = 64
+
+# Served per candle, in this order, after the candle's own o/h/l/c/v
+FEATURE_NAMES = ('ema_fast', 'ema_slow', 'atr', 'vwap', 'volume_z', 'return_1', 'return_n')
+# Per-key state arrays, as allocated by FeatureStore._allocate
+STATE_ARRAYS = ('count', 'prev_close', 'ema_fast', 'ema_slow', 'atr', 'session', 'session_pv',
+                'session_volume', 'volumes', 'volume_sum', 'volume_squares', 'closes')
+
+
+# Rolling per-key candle features, updated in O(1) per candle from
+# struct-of-arrays state (one row per key, e.g. (ticker, candle size)):
+# EMAs of the close, Wilder ATR, session VWAP, z-score of the volume against
+# the last VOLUME_WINDOW candles, and 1- and RETURN_WINDOW-candle returns.
+# Everything is defined from the first candle on (EMAs and ATR are seeded
+# with it, returns span whatever history there is), so live and training
+# rows never hold NaNs.
+#
+# update() is the only way features are computed: the live pipeline calls it
+# with the candles closed at each bar and history_features() calls it with a
+# whole history, so the two can not diverge.
+class FeatureStore:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.keys = {}
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        state = {
+            'count': np.zeros(capacity, dtype=np.int64),
+            'prev_close': np.zeros(capacity),
+            'ema_fast': np.zeros(capacity),
+            'ema_slow': np.zeros(capacity),
+            'atr': np.zeros(capacity),
+            'session': np.full(capacity, -1, dtype=np.int64),
+            'session_pv': np.zeros(capacity),
+            'session_volume': np.zeros(capacity),
+            'volumes': np.zeros((capacity, VOLUME_WINDOW)),
+            'volume_sum': np.zeros(capacity),
+            'volume_squares': np.zeros(capacity),
+            'closes': np.zeros((capacity, RETURN_WINDOW)),
+        }
+        for name, array in state.items():
+            if self.capacity:
+                array[:self.capacity] = getattr(self, name)
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    # The state arrays cut to the keys in use, plus the keys (JSON, in row
+    # order), for snapshots
+    def state(self):
+        n = len(self.keys)
+        state = {name: getattr(self, name)[:n].copy() for name in STATE_ARRAYS}
+        state['keys'] = np.array(json.dumps(list(self.keys)))
+        return state
+
+    # Replace the store's contents with a state(); raises ValueError if it was
+    # taken with other window lengths. Tuple keys come back as tuples.
+    def load_state(self, state):
+        if state['volumes'].shape[1:] != (VOLUME_WINDOW,) or state['closes'].shape[1:] != (RETURN_WINDOW,):
+            raise ValueError(f"feature state has windows {state['volumes'].shape[1:]} / {state['closes'].shape[1:]}")
+        keys = [tuple(key) if isinstance(key, list) else key for key in json.loads(str(state['keys']))]
+        capacity = INITIAL_CAPACITY
+        while capacity < len(keys):
+            capacity *= 2
+        self.capacity = 0
+        self._allocate(capacity)
+        for name in STATE_ARRAYS:
+            getattr(self, name)[:len(keys)] = state[name]
+        self.keys = {key: row for row, key in enumerate(keys)}
+
+    def row(self, key):
+        row = self.keys.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row >= self.capacity:
+                self._allocate(self.capacity * 2)
+            self.keys[key] = row
+        return row
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    # Fold closed candles into their keys' state and return an (n, features)
+    # array with each candle's features as of its close. Arrays are aligned
+    # with keys; a key may appear more than once, in which case its candles
+    # are applied in the order given.
+    def update(self, keys, open_, high, low, close, volume, timestamps):
+        n = len(keys)
+        features = np.empty((n, len(FEATURE_NAMES)))
+        if not n:
+            return features
+        rows = np.fromiter((self.row(key) for key in keys), dtype=np.int64, count=n)
+        arrays = [np.asarray(values, dtype=np.float64) for values in (open_, high, low, close, volume)]
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+
+        # Candles that share a key go in successive rounds; each round touches
+        # every row at most once and is a handful of array operations
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        starts = np.flatnonzero(np.r_[True, sorted_rows[1:] != sorted_rows[:-1]])
+        occurrence = np.empty(n, dtype=np.int64)
+        occurrence[order] = np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+        by_round = np.argsort(occurrence, kind='stable')
+        bounds = np.r_[np.flatnonzero(np.r_[True, np.diff(occurrence[by_round]) != 0]), n]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            index = by_round[start:end]
+            features[index] = self._step(rows[index], *(values[index] for values in arrays), timestamps[index])
+        return features
+
+    def _step(self, rows, open_, high, low, close, volume, timestamps):
+        count = self.count[rows]
+        first = count == 0
+
+        prev_close = np.where(first, close, self.prev_close[rows])
+        true_range = np.maximum(high, prev_close) - np.minimum(low, prev_close)
+        ema_fast = np.where(first, close, self.ema_fast[rows] + (close - self.ema_fast[rows]) * (2 / (EMA_FAST + 1)))
+        ema_slow = np.where(first, close, self.ema_slow[rows] + (close - self.ema_slow[rows]) * (2 / (EMA_SLOW + 1)))
+        atr = np.where(first, true_range, self.atr[rows] + (true_range - self.atr[rows]) / ATR_PERIOD)
+
+        session = timestamps // SESSION_LENGTH
+        same_session = self.session[rows] == session
+        typical = (high + low + close) / 3
+        session_pv = np.where(same_session, self.session_pv[rows], 0.0) + typical * volume
+        session_volume = np.where(same_session, self.session_volume[rows], 0.0) + volume
+        vwap = np.divide(session_pv, session_volume, out=typical.copy(), where=session_volume > 0)
+
+        # Running sums over a ring of the last VOLUME_WINDOW volumes
+        slot = count % VOLUME_WINDOW
+        dropped = np.where(count >= VOLUME_WINDOW, self.volumes[rows, slot], 0.0)
+        volume_sum = self.volume_sum[rows] - dropped + volume
+        volume_squares = self.volume_squares[rows] - dropped * dropped + volume * volume
+        filled = np.minimum(count + 1, VOLUME_WINDOW)
+        mean = volume_sum / filled
+        std = np.sqrt(np.maximum(volume_squares / filled - mean * mean, 0.0))
+        volume_z = np.divide(volume - mean, std, out=np.zeros_like(std), where=std > mean * 1e-9)
+
+        # The ring slot about to be overwritten holds the close RETURN_WINDOW
+        # candles back
+        close_slot = count % RETURN_WINDOW
+        base = np.where(count >= RETURN_WINDOW, self.closes[rows, close_slot], self.closes[rows, 0])
+        base = np.where(first, close, base)
+        return_1 = np.divide(close, prev_close, out=np.ones_like(close), where=prev_close != 0) - 1
+        return_n = np.divide(close, base, out=np.ones_like(close), where=base != 0) - 1
+
+        self.count[rows] = count + 1
+        self.prev_close[rows] = close
+        self.ema_fast[rows] = ema_fast
+        self.ema_slow[rows] = ema_slow
+        self.atr[rows] = atr
+        self.session[rows] = session
+        self.session_pv[rows] = session_pv
+        self.session_volume[rows] = session_volume
+        self.volumes[rows, slot] = volume
+        self.volume_sum[rows] = volume_sum
+        self.volume_squares[rows] = volume_squares
+        self.closes[rows, close_slot] = close
+        return np.column_stack((ema_fast, ema_slow, atr, vwap, volume_z, return_1, return_n))
+
+
+# Features for a history of candles (any number of keys, rows in any order),
+# computed by feeding it through a FeatureStore in time order per key.
+# Returns an (n, features) array aligned with the input rows. Pass a store
+# to continue from its state instead of starting empty.
+def history_features(keys, open_, high, low, close, volume, timestamps, store=None):
+    store = FeatureStore() if store is None else store
+    keys = np.asarray(keys)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    _, codes = np.unique(keys, return_inverse=True)
+    order = np.lexsort((timestamps, codes.ravel()))
+    features = np.empty((len(keys), len(FEATURE_NAMES)))
+    features[order] = store.update(keys[order].tolist(), *(np.asarray(values, dtype=np.float64)[order]
+                                                            for values in (open_, high, low, close, volume)), timestamps[order])
+    return features
+
+
+# {name: column} for passing feature rows to RuleSet.evaluate
+def feature_columns(features):
+    return {name: features[:, i] for i, name in enumerate(FEATURE_NAMES)}
@@ -0,0 +1,88 @@
+import warnings
+import numpy as np
+import model_export
+
+FEATURE_KEYS = ('o', 'h', 'l', 'c', 'v')
+
+# Model used by score_rows; set directly in-process, or per worker through
+# load_model when scoring runs on a process pool
+model = None
+
+
+# A model input row: the candle's o/h/l/c/v followed by its rolling features
+# (features.FEATURE_NAMES), if any
+def candle_features(candle, rolling=()):
+    return [candle[key] for key in FEATURE_KEYS] + list(rolling)
+
+
+# Prefer the compact export of the model (see model_export) when it was made
+# from the current pickle; it memory-maps in milliseconds and scores without
+# importing sklearn. Falls back to unpickling the model.
+def load_model(path):
+    global model
+    compact = model_export.compact_path(path)
+    if model_export.is_current(compact, path):
+        model = model_export.load_forest(compact)
+    else:
+        import joblib
+        model = joblib.load(path)
+    return model
+
+
+# Returns (predictions, confidences) for an (n, features) array, where
+# confidence is the probability of positive_class. Models trained on fewer
+# columns (such as the original five-value candle model) get the leading ones.
+def predict(model, features, positive_class=1):
+    width = getattr(model, 'n_features_in_', None)
+    if width is not None and features.shape[1] > width:
+        features = features[:, :width]
+    with warnings.catch_warnings():
+        # The model was fitted on a DataFrame; plain arrays are fine here
+        warnings.filterwarnings('ignore', message='X does not have valid feature names')
+        probabilities = model.predict_proba(features)
+
+    classes = model.classes_
+    predictions = classes[probabilities.argmax(axis=1)]
+    positive = np.flatnonzero(classes == positive_class)
+    if len(positive):
+        confidences = probabilities[:, positive[0]]
+    else:
+        confidences = np.zeros(len(features))
+    return predictions.tolist(), confidences.tolist()
+
+
+def score_rows(rows, positive_class=1):
+    return predict(model, np.asarray(rows, dtype=np.float64), positive_class)
+
+
+# Collects the candles completed while handling one websocket batch and scores
+# them with a single predict_proba call on a plain float array, instead of one
+# DataFrame + predict per candle.
+class BatchPredictor:
+    def __init__(self, model, positive_class=1):
+        self.model = model
+        self.positive_class = positive_class
+        self.keys = []
+        self.rows = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, candle, rolling=()):
+        self.keys.append(key)
+        self.rows.append(candle_features(candle, rolling))
+
+    # Hand over the pending batch as (keys, rows) and start a new one
+    def take(self):
+        keys, rows = self.keys, self.rows
+        self.keys = []
+        self.rows = []
+        return keys, rows
+
+    # Returns {key: (prediction, confidence)} for the pending batch
+    def run(self):
+        keys, rows = self.take()
+        if not keys:
+            return {}
+        predictions, confidences = predict(self.model, np.asarray(rows, dtype=np.float64), self.positive_class)
+        return dict(zip(keys, zip(predictions, confidences)))
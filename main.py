@@ -1,5 +1,6 @@
-import joblib
-import pandas as pd
+import time
+startup_marks = [('start', time.perf_counter())]
+
 from datetime import datetime
 from discord.ext import commands
 import discord
@@ -7,202 +8,234 @@ import asyncio
 from polygon import WebSocketClient
 from polygon.websocket.models import WebSocketMessage
 from typing import List
-from pytz import timezone
-from database import save_signal, fetch_open_signals, save_message
-from check_signals import check_and_update_signals
+from signal_book import book, set_recorder
+from candle_engine import CandleEngine
+import inference
+from inference import BatchPredictor
+from pipeline import Pipeline, Stage, make_executor
+from write_queue import writer
+import database
+import async_database
+from notifier import Dispatcher
+from check_signals import expire_unfilled_signals, send_trade_update, set_message_sink
+from features import FEATURE_NAMES
+from event_log import SNAPSHOT_INTERVAL, BotState
+from recovery import GapRecovery, make_source
+from processor import BarProcessor
+from sharding import ShardHub
+from scheduler import SessionScheduler, compact_heap, freeze_heap, prime_clock
+from metrics import metrics
 from secret import Secret
 
-# Load the trained model
-model = joblib.load('VERY_GOOD_MODEL.pkl')
+startup_marks.append(('imports', time.perf_counter()))
 
-# Discord bot setup
-intents = discord.Intents.default()
-intents.messages = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Trained model; the compact export from model_export.py is used if present
+MODEL_PATH = 'VERY_GOOD_MODEL.pkl'
+# Signals are only sent when the model's probability of a profitable trade
+# is at least this high; 0 sends every signal the analysis finds
+MIN_CONFIDENCE = 0.0
 
 # WebSocket client setup
-client = WebSocketClient("KEY")  # replace with your actual API key
-client.subscribe("AM.SPY")
+API_KEY = "KEY"  # replace with your actual API key
+TICKERS = ['SPY']
 
-# Global variables for candle aggregation
+# Candle aggregation
 CANDLE_SIZES = [6]
-aggregate_data = {size: {} for size in CANDLE_SIZES}
-last_data_points = {}
 
+# Minutes missed while the feed was down (no bars at all for
+# recovery.STALE_MINUTES) are fetched from BAR_SOURCE ('polygon' for the REST
+# API, or a CSV path for FileBarSource) and replayed before the bar that
+# revealed the gap
+BAR_SOURCE = 'polygon'
+
+# Pipeline: aggregate -> score -> signals, with alerts handed to the Discord dispatcher.
+# Scoring runs on INFERENCE_EXECUTOR ('thread' or 'process') with
+# INFERENCE_WORKERS workers; every stage queue holds at most PIPELINE_QUEUE_SIZE items.
+INFERENCE_EXECUTOR = 'thread'
+INFERENCE_WORKERS = 1
+PIPELINE_QUEUE_SIZE = 100
+
+# Database driver: 'pyodbc' runs the synchronous driver on executor threads;
+# 'aioodbc' (SQL Server) and 'aiosqlite' (a local file at SQLITE_PATH) are
+# awaited on the event loop instead (see async_database.py)
+DB_BACKEND = 'pyodbc'
+SQLITE_PATH = async_database.SQLITE_PATH
+
+# With SHARDS > 0 the tickers are split across that many worker processes by
+# consistent hash (see sharding.py); this process then only routes bars, sends
+# alerts and writes to the database
+SHARDS = 0
+
+# Aggregation state survives restarts through an event log of received bars
+# and a snapshot every SNAPSHOT_INTERVAL seconds, kept in STATE_DIR (see
+# event_log.py); sharded workers use a subdirectory each. None turns it off.
+STATE_DIR = 'state'
+
+# Session jobs (see scheduler.py): a P/L summary of the filled signals every
+# UPDATE_INTERVAL minutes of the session, warm-up before the open and
+# housekeeping after the close. With EXPIRE_UNFILLED, signals still waiting
+# for their entry at the close are invalidated (backtest.py does not model
+# this, so its fills only match the live bot with it off).
+UPDATE_INTERVAL = 6
+EXPIRE_UNFILLED = False
+
+# Latency histograms and counters are printed every METRICS_INTERVAL seconds;
+# with METRICS_PORT set they are also served as JSON on localhost
+METRICS_INTERVAL = 60
+METRICS_PORT = 0
+
+
+# Pre-market: reload the model (picking up one retrained overnight) and score
+# one row so the first bar of the session doesn't run cold. Process-pool
+# workers keep the model they loaded at startup.
+def warm_model():
+    global model
+    if INFERENCE_EXECUTOR != 'process':
+        model = predictor.model = inference.load_model(MODEL_PATH)
+        inference.score_rows([[0.0] * (len(inference.FEATURE_KEYS) + len(FEATURE_NAMES))])
+
+def fill_database_pool():
+    database.ensure_schema()
+    database.pool.fill()
 
 async def handle_msg(msgs: List[WebSocketMessage]):
-    global last_data_points, aggregate_data
-
-    for equity_agg in msgs:
-        ticker = equity_agg.symbol
-
-        for size in CANDLE_SIZES:
-            if ticker not in aggregate_data[size]:
-                aggregate_data[size][ticker] = []
-
-            aggregate_data[size][ticker].append(equity_agg)
-
-            if len(aggregate_data[size][ticker]) == size:
-                aggregated_candle = aggregate_candles(aggregate_data[size][ticker])
-                print(f"Aggregated candle for size {size}: {aggregated_candle}")
-
-                aggregate_data[size][ticker] = []  # Reset after aggregation
-
-                if ticker in last_data_points and size in last_data_points[ticker]:
-                    previous_candle = last_data_points[ticker][size]
-                    previous_volume = previous_candle['v']
-                    current_volume = aggregated_candle['v']
-                    volume_confirmed = current_volume > previous_volume
-
-                    # Get prediction confidence
-                    confidence = predict_trade_signal_with_model(aggregated_candle)
-                    print(f"Trade signal confidence: {confidence}")
-
-                    if confidence is None:
-                        continue
-                    confidence = 1
-                    # Analysis logic
-                    analysis_result_short = analyze_for_shorts(previous_candle, aggregated_candle, ticker)
-                    analysis_result_long = analyze_for_longs(previous_candle, aggregated_candle, ticker)
-
-                    if confidence == 1:
-
-                        if analysis_result_short:
-                            print(f"Short analysis result: {analysis_result_short}")
-                            await send_discord_message(format_message_short(analysis_result_short, size, volume_confirmed))
-                            save_signal(ticker, 'SHORT', analysis_result_short['entry_point'], analysis_result_short['stop_loss'], analysis_result_short['invalidated_price'], None, volume_confirmed, equity_agg.end_timestamp, confidence)
-
-                        if analysis_result_long:
-                            print(f"Long analysis result: {analysis_result_long}")
-                            await send_discord_message(format_message_long(analysis_result_long, size, volume_confirmed))
-                            save_signal(ticker, 'LONG', analysis_result_long['entry_point'], analysis_result_long['stop_loss'], analysis_result_long['invalidated_price'], None, volume_confirmed, equity_agg.end_timestamp, confidence)
-
-                if ticker not in last_data_points:
-                    last_data_points[ticker] = {}
-                last_data_points[ticker][size] = aggregated_candle
-
-        await check_and_update_signals(bot, equity_agg)
-
-def predict_trade_signal_with_model(candle):
-    features = pd.DataFrame([[
-        candle['o'],
-        candle['h'],
-        candle['l'],
-        candle['c'],
-        candle['v']
-    ]], columns=['open', 'high', 'low', 'close', 'volume'])
-    
-    prediction = model.predict(features)[0]
-    return prediction
-
-def aggregate_candles(candles):
-    open_price = candles[0].open
-    close_price = candles[-1].close
-    high_price = max(candle.high for candle in candles)
-    low_price = min(candle.low for candle in candles)
-    volume = sum(candle.volume for candle in candles)
-    timestamp = candles[-1].end_timestamp
-
-    aggregated_candle = {
-        'o': open_price,
-        'c': close_price,
-        'h': high_price,
-        'l': low_price,
-        'v': volume,
-        't': timestamp
-    }
-
-    return aggregated_candle
-
-def analyze_for_shorts(data_point_1, data_point_2, symbol):
-    is_sender = False
-    recent_candle = data_point_2
-    prev_candle = data_point_1
-    invalidated_price = None
-
-    if recent_candle['h'] > prev_candle['h']:
-        if recent_candle['c'] < recent_candle['o']:
-            if recent_candle['c'] < prev_candle['c']:
-                entry_point = recent_candle['o']
-                invalidated_price = prev_candle['l']
-                is_sender = True
-            if recent_candle['l'] < prev_candle['l']:
-                is_sender = False
-        if recent_candle['c'] > recent_candle['o']:
-            if recent_candle['c'] < prev_candle['c']:
-                entry_point = recent_candle['c']
-                invalidated_price = prev_candle['l']
-                is_sender = True
-            if recent_candle['l'] < prev_candle['l']:
-                is_sender = False
-    if is_sender:
-        return {
-            'ticker': symbol,
-            'entry_point': entry_point,
-            'stop_loss': recent_candle['h'],
-            'invalidated_price': invalidated_price,
-            'timestamp': recent_candle['t']
-        }
-    return None
-
-def analyze_for_longs(data_point_1, data_point_2, symbol):
-    is_sender = False
-    recent_candle = data_point_2
-    prev_candle = data_point_1
-    invalidated_price = None
-
-    if recent_candle['l'] < prev_candle['l']:
-        if recent_candle['o'] < recent_candle['c']:
-            if recent_candle['c'] < prev_candle['o']:
-                entry_point = recent_candle['o']
-                invalidated_price = prev_candle['h']
-                is_sender = True
-            if recent_candle['h'] > prev_candle['h']:
-                is_sender = False
-        if recent_candle['o'] > recent_candle['c']:
-            if recent_candle['c'] > prev_candle['c']:
-                entry_point = recent_candle['c']
-                invalidated_price = prev_candle['h']
-                is_sender = True
-            if recent_candle['h'] > prev_candle['h']:
-                is_sender = False
-    if is_sender:
-        return {
-            'ticker': symbol,
-            'entry_point': entry_point,
-            'stop_loss': recent_candle['l'],
-            'invalidated_price': invalidated_price,
-            'timestamp': recent_candle['t']
-        }
-    return None
+    # Blocks the websocket reader when the pipeline (or a shard) is backed up
+    received = metrics.receive(msgs)
+    if hub is not None:
+        await hub.route(msgs, received)
+    else:
+        await pipeline.put((received, msgs))
 
 async def send_discord_message(message):
-    await bot.get_channel(Secret.signal_channel_id).send(message)
-    save_message(message)
-
-def format_message_short(analysis_result, candle_size, volume):
-    volume_text = "[VC]" if volume else ""
-    utc_dt = datetime.fromtimestamp(analysis_result['timestamp'] / 1000, timezone('UTC'))
-    central_dt = utc_dt.astimezone(timezone('US/Eastern'))
-    timestamp = central_dt.strftime('%Y-%m-%d %H:%M:%S')
-    return f"SHORT Alert: {analysis_result['ticker']}, Entry: {analysis_result['entry_point']}, Stop: {analysis_result['stop_loss']} | {timestamp}"
-
-def format_message_long(analysis_result, candle_size, volume):
-    volume_text = "[VC]" if volume else ""
-    utc_dt = datetime.fromtimestamp(analysis_result['timestamp'] / 1000, timezone('UTC'))
-    central_dt = utc_dt.astimezone(timezone('US/Eastern'))
-    timestamp = central_dt.strftime('%Y-%m-%d %H:%M:%S')
-    return f"LONG Alert: {analysis_result['ticker']}, Entry: {analysis_result['entry_point']}, Stop: {analysis_result['stop_loss']} | {timestamp}"
-
-@bot.event
+    await dispatcher.send(message)
+
 async def on_ready():
     print(f'Logged in as {bot.user.name}')
     asyncio.create_task(start_client())
 
+def report_startup():
+    startup_marks.append(('discord login', time.perf_counter()))
+    steps = ", ".join(f"{name} {(at - startup_marks[i][1]) * 1000:.0f}ms" for i, (name, at) in enumerate(startup_marks[1:]))
+    print(f"Startup {(startup_marks[-1][1] - startup_marks[0][1]) * 1000:.0f}ms: {steps}")
+    try:
+        import resource
+        print(f"Max resident memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}MB")
+    except ImportError:
+        pass
+
 async def start_client():
     print(f"Starting WebSocket client at {datetime.now().time()}")
+    if startup_marks[-1][0] != 'discord login':
+        report_startup()
 
     await client.connect(handle_msg)
 
+# Build the bot. This is not done at import: sharded workers are spawned
+# processes that re-import this module (as __mp_main__), and they must not
+# load the model, open clients or start executors of their own.
+def setup():
+    global model, predictor, bot, client, candles, recovery, inference_executor, db, scheduler, dispatcher, processor, pipeline, state, hub
+    # Load the trained model
+    model = inference.load_model(MODEL_PATH)
+    predictor = BatchPredictor(model)
+    startup_marks.append(('model', time.perf_counter()))
+
+    intents = discord.Intents.default()
+    intents.messages = True
+    bot = commands.Bot(command_prefix='!', intents=intents)
+    bot.event(on_ready)
+
+    client = WebSocketClient(API_KEY)
+    client.subscribe(*[f"AM.{ticker}" for ticker in TICKERS])
+    candles = CandleEngine(CANDLE_SIZES)
+    recovery = GapRecovery(make_source(BAR_SOURCE, API_KEY))
+    inference_executor = make_executor(INFERENCE_EXECUTOR, INFERENCE_WORKERS,
+                                       initializer=inference.load_model if INFERENCE_EXECUTOR == 'process' else None,
+                                       initargs=(MODEL_PATH,) if INFERENCE_EXECUTOR == 'process' else ())
+    db = async_database.create_backend(DB_BACKEND, SQLITE_PATH) if DB_BACKEND != 'pyodbc' else None
+    writer.backend = db
+
+    # In sharded mode the workers hold the signals, so they send the trade
+    # updates and expire unfilled signals themselves
+    warm_up_jobs = [db.fill if db is not None else fill_database_pool]
+    end_of_day_jobs = []
+    if not SHARDS:
+        warm_up_jobs.append(warm_model)
+        if EXPIRE_UNFILLED:
+            end_of_day_jobs.append(expire_unfilled_signals)
+    warm_up_jobs += [prime_clock, freeze_heap]
+    end_of_day_jobs += [writer.flush_pending, compact_heap]
+    scheduler = SessionScheduler(send_trade_update if not SHARDS else None, warm_up_jobs, end_of_day_jobs, UPDATE_INTERVAL)
+
+    dispatcher = Dispatcher(bot.get_channel, Secret.signal_channel_id)
+    processor = BarProcessor(candles, recovery, predictor, send_discord_message, executor=inference_executor, bot=bot, min_confidence=MIN_CONFIDENCE, scheduler=scheduler)
+    signal_stage = Stage('signals', processor.signal_batch, maxsize=PIPELINE_QUEUE_SIZE)
+    score_stage = Stage('score', processor.score_batch, workers=INFERENCE_WORKERS, maxsize=PIPELINE_QUEUE_SIZE, downstream=signal_stage)
+    aggregate_stage = Stage('aggregate', processor.aggregate_batch, maxsize=PIPELINE_QUEUE_SIZE, downstream=score_stage)
+    pipeline = Pipeline([aggregate_stage, score_stage, signal_stage],
+                        gauges={'notify': dispatcher.snapshot, 'persist': writer.snapshot, 'recovery': recovery.snapshot})
+    state = BotState(processor, STATE_DIR, SNAPSHOT_INTERVAL) if STATE_DIR and not SHARDS else None
+    processor.state = state
+    if state is not None:
+        writer.on_saved = state.saved
+        set_recorder(state.record_update)
+        scheduler.end_of_day.append(state.request_rotation)
+    set_message_sink(send_discord_message)
+    hub = ShardHub(SHARDS, send_discord_message, writer, {
+        'model_path': MODEL_PATH,
+        'candle_sizes': CANDLE_SIZES,
+        'bar_source': BAR_SOURCE,
+        'api_key': API_KEY,
+        'min_confidence': MIN_CONFIDENCE,
+        'queue_size': PIPELINE_QUEUE_SIZE,
+        'metrics_interval': METRICS_INTERVAL,
+        'database': {'backend': DB_BACKEND, 'path': SQLITE_PATH},
+        'update_interval': UPDATE_INTERVAL,
+        'expire_unfilled': EXPIRE_UNFILLED,
+        'state_dir': STATE_DIR,
+    }) if SHARDS else None
+    if hub is not None:
+        metrics.gauge('shards', hub.snapshot)
+        metrics.gauge('notify', dispatcher.snapshot)
+        metrics.gauge('persist', writer.snapshot)
+    else:
+        metrics.gauge('pipeline', pipeline.snapshot)
+
+
+async def run_bot():
+    writer.start()
+    dispatcher.start()
+    if hub is not None:
+        hub.start()
+    else:
+        book.load(rows=await db.fetch_open_signals() if db is not None else None)
+        startup_marks.append(('signal book', time.perf_counter()))
+        if state is not None:
+            state.restore()
+            startup_marks.append(('restore', time.perf_counter()))
+        pipeline.start()
+    scheduler.start()
+    metrics_task = asyncio.create_task(metrics.run(METRICS_INTERVAL, METRICS_PORT))
+    async with bot:
+        try:
+            await bot.start(Secret.token)
+        finally:
+            metrics_task.cancel()
+            await scheduler.stop()
+            if hub is not None:
+                await hub.stop()
+            else:
+                await pipeline.stop()
+            if inference_executor is not None:
+                inference_executor.shutdown(wait=True)
+            await dispatcher.drain()
+            await writer.drain()
+            # After the writer, so the signals it just saved are logged as such
+            if state is not None:
+                await state.close()
+            if db is not None:
+                await db.close()
+
 if __name__ == "__main__":
-    bot.run(Secret.token)
+    setup()
+    asyncio.run(run_bot())
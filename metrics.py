@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import json
+import threading
+import time
+from contextvars import ContextVar
+
+# Histogram bucket upper bounds in seconds: 10us doubling up to ~22 minutes
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(28))
+PERCENTILES = (50, 90, 99)
+DUMP_INTERVAL = 60
+METRICS_HOST = '127.0.0.1'
+
+# perf_counter() time at which the websocket batch being processed arrived.
+# Set per batch by the signal stage so alerts raised for it can be timed.
+received_at = ContextVar('received_at', default=None)
+
+
+# Fixed-bucket latency histogram. observe() is a bisect and a few adds under
+# a lock, cheap enough for every bar; percentiles are read off the bucket
+# bounds, so they are accurate to within a factor of two.
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = self.count * q / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        snapshot = {'count': self.count, 'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0}
+        for q in PERCENTILES:
+            snapshot[f'p{q}_ms'] = round(self.percentile(q) * 1000, 3)
+        snapshot['max_ms'] = round(self.max * 1000, 3)
+        return snapshot
+
+
+class Counter:
+    __slots__ = ('value', 'rolled_value', 'rolled_at', 'rate', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self.rolled_value = 0
+        self.rolled_at = time.monotonic()
+        self.rate = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self.value += n
+
+    # Per-second rate since the previous roll
+    def roll(self, now):
+        elapsed = now - self.rolled_at
+        if elapsed > 0:
+            self.rate = (self.value - self.rolled_value) / elapsed
+        self.rolled_value = self.value
+        self.rolled_at = now
+
+    def snapshot(self):
+        return {'total': self.value, 'per_second': round(self.rate, 3)}
+
+
+# Process-wide registry of latency histograms, counters and gauges (callables
+# returning a dict, such as a pipeline snapshot)
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    # Record the time since a perf_counter() start
+    def since(self, name, started):
+        self.histogram(name).observe(time.perf_counter() - started)
+
+    def count(self, name, n=1):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters.setdefault(name, Counter())
+        counter.add(n)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    # Forget recorded latencies and counts (gauges stay registered)
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.started = time.time()
+
+    # Count a websocket batch and how long after each bar closed it arrived.
+    # Returns the receipt time the rest of the pipeline measures from.
+    def receive(self, msgs):
+        received = time.perf_counter()
+        now_ms = time.time() * 1000
+        self.count('bars', len(msgs))
+        feed_delay = self.histogram('feed_delay')
+        for msg in msgs:
+            feed_delay.observe(max(now_ms - msg.end_timestamp, 0) / 1000)
+        return received
+
+    def roll(self):
+        now = time.monotonic()
+        for counter in self.counters.values():
+            counter.roll(now)
+
+    def snapshot(self):
+        snapshot = {
+            'uptime': round(time.time() - self.started, 1),
+            'latency': {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+            'counters': {name: counter.snapshot() for name, counter in sorted(self.counters.items())},
+        }
+        for name, gauge in self.gauges.items():
+            try:
+                snapshot[name] = gauge()
+            except Exception as e:
+                snapshot[name] = {'error': repr(e)}
+        return snapshot
+
+    def dump(self):
+        for name, histogram in sorted(self.histograms.items()):
+            print(f"[metrics] {name}: " + ", ".join(f"{key}={value}" for key, value in histogram.snapshot().items()))
+        for name, counter in sorted(self.counters.items()):
+            print(f"[metrics] {name}: " + ", ".join(f"{key}={value}" for key, value in counter.snapshot().items()))
+
+    # Roll counter rates every interval and either print the metrics or hand
+    # the snapshot to sink. With a port, also serve the snapshot as JSON over
+    # HTTP on METRICS_HOST (any path).
+    async def run(self, interval=DUMP_INTERVAL, port=0, sink=None):
+        server = None
+        if port:
+            server = await asyncio.start_server(self._serve, METRICS_HOST, port)
+            print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.roll()
+                if sink is not None:
+                    sink(self.snapshot())
+                else:
+                    self.dump()
+        finally:
+            if server is not None:
+                server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            await reader.readline()
+            body = json.dumps(self.snapshot(), default=str).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
@@ -1,15 +1,21 @@
 import pyodbc
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-from sklearn.model_selection import train_test_split, cross_val_score
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import classification_report, accuracy_score
-from sklearn.impute import SimpleImputer
-from imblearn.over_sampling import SMOTE
 from secret import Secret
+import candle_cache
 import joblib
+from backtest import aggregate
+from features import FEATURE_NAMES, history_features
 
-model = joblib.load('trained_model.pkl')
+# Loaded on first use so importing this module for training doesn't need it
+model = None
+
+def load_model(path='trained_model.pkl'):
+    global model
+    if model is None:
+        model = joblib.load(path)
+    return model
 
 # Database connection
 connection_string = f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={Secret.server};DATABASE={Secret.database};UID={Secret.username};PWD={Secret.password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
@@ -22,44 +28,143 @@ def fetch_trade_signals():
     query = """
     SELECT [id], [symbol], [created_at], [total_profit]
     FROM [trade_signals]
-    WHERE volume_confirmed = 0 AND confidence = 1
+    WHERE volume_confirmed = 0
     """
     with create_connection() as conn:
         df = pd.read_sql(query, conn)
     return df
 
-# Fetch candlestick data
-def fetch_candlestick_data():
+CANDLE_WINDOW = 6
+CANDLE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+CHUNK_SIZE = 500000
+# Train from the incremental local cache instead of pulling both tables
+USE_CACHE = True
+
+# Fetch candlestick data. With chunksize, yields DataFrames ordered by symbol
+# and timestamp so the table never has to be held in memory at once.
+def fetch_candlestick_data(chunksize=None):
     query = """
     SELECT [symbol], [timestamp], [open], [high], [low], [close], [volume]
     FROM [candlestick_data]
     """
+    if chunksize:
+        return _fetch_candlestick_chunks(query + " ORDER BY [symbol], [timestamp]", chunksize)
     with create_connection() as conn:
         df = pd.read_sql(query, conn)
     return df
 
-# Merge data and prepare it for model training
-def merge_data(trade_signals, candlestick_data):
-    trade_signals['created_at'] = pd.to_datetime(trade_signals['created_at'])
-    candlestick_data['timestamp'] = pd.to_datetime(candlestick_data['timestamp'])
-
-    merged_data = []
-
-    for _, trade in trade_signals.iterrows():
-        relevant_candles = candlestick_data[(candlestick_data['symbol'] == trade['symbol']) &
-                                            (candlestick_data['timestamp'] < trade['created_at'])].tail(6)
-        if len(relevant_candles) == 6:
-            for _, candle in relevant_candles.iterrows():
-                merged_data.append({
-                    'open': candle['open'],
-                    'high': candle['high'],
-                    'low': candle['low'],
-                    'close': candle['close'],
-                    'volume': candle['volume'],
-                    'total_profit': trade['total_profit']
-                })
-    
-    return pd.DataFrame(merged_data)
+def _fetch_candlestick_chunks(query, chunksize):
+    with create_connection() as conn:
+        for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+            yield chunk
+
+def window_columns(window=CANDLE_WINDOW):
+    return [f'{column}_{step}' for step in range(1, window + 1) for column in CANDLE_COLUMNS]
+
+# Trade signals for training from the local cache (see candle_cache), in the
+# same shape as fetch_trade_signals
+def cached_trade_signals():
+    signals = candle_cache.load_signals()
+    signals = signals[signals['volume_confirmed'] == 0]
+    return signals[['id', 'symbol', 'created_at', 'total_profit']].reset_index(drop=True)
+
+# Rolling features (see features.FeatureStore) of each symbol's clock-aligned
+# `window`-minute candles, computed the way the live bot computes them at each
+# candle close. One row per candle: symbol, close time and the features.
+# candles must be sorted by symbol and timestamp.
+def rolling_features(candles, window=CANDLE_WINDOW):
+    symbols = candles['symbol'].to_numpy()
+    timestamps = candles['timestamp'].to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    values = candles[CANDLE_COLUMNS].to_numpy(dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+    parts = []
+    for start, end in zip(starts, np.r_[starts[1:], len(symbols)]):
+        aggregated = aggregate(timestamps[start:end], *values[start:end].T, window)[:6]
+        parts.append((np.full(len(aggregated[0]), symbols[start], dtype=object),) + aggregated)
+    keys, o, h, l, c, v, t = (np.concatenate(columns) for columns in zip(*parts))
+    rolling = pd.DataFrame(history_features(keys, o, h, l, c, v, t), columns=list(FEATURE_NAMES))
+    rolling.insert(0, 'symbol', keys)
+    rolling.insert(1, 'timestamp', pd.to_datetime(t, unit='ms'))
+    return rolling
+
+# Merge data and prepare it for model training. Each trade is joined as-of
+# its created_at to the `window` candles of its symbol that precede it, giving
+# one row per trade: the candles as open_1..volume_N (1 = oldest), the
+# aggregated candle they form as open/high/low/close/volume (what the live
+# model is fed), the rolling features as of the last `window`-minute candle
+# closed by then (a live signal is created at that candle's close), and
+# total_profit. Trades without a full window are dropped.
+def merge_data(trade_signals, candlestick_data, window=CANDLE_WINDOW):
+    columns = ['id', 'symbol', 'created_at'] + window_columns(window) + CANDLE_COLUMNS + list(FEATURE_NAMES) + ['total_profit']
+    if trade_signals.empty or candlestick_data.empty:
+        return pd.DataFrame(columns=columns)
+
+    trades = trade_signals.assign(created_at=pd.to_datetime(trade_signals['created_at']))
+    candles = candlestick_data.assign(timestamp=pd.to_datetime(candlestick_data['timestamp']))
+    candles = candles.sort_values(['symbol', 'timestamp'], kind='stable').reset_index(drop=True)
+    candles['_row'] = np.arange(len(candles))
+    first_row = candles.groupby('symbol')['_row'].min()
+
+    # Last candle strictly before each trade, per symbol
+    matched = pd.merge_asof(
+        trades.sort_values('created_at'),
+        candles[['symbol', 'timestamp', '_row']].sort_values('timestamp'),
+        left_on='created_at', right_on='timestamp', by='symbol',
+        allow_exact_matches=False
+    )
+    last = matched['_row'].to_numpy(dtype=np.float64)
+    start = matched['symbol'].map(first_row).to_numpy(dtype=np.float64)
+    valid = ~np.isnan(last) & (last - start + 1 >= window)
+    matched = matched[valid].reset_index(drop=True)
+    last = last[valid].astype(np.int64)
+
+    rows = last[:, None] - (window - 1) + np.arange(window)
+    values = candles[CANDLE_COLUMNS].to_numpy(dtype=np.float64)[rows]
+
+    merged = pd.DataFrame(values.reshape(len(matched), window * len(CANDLE_COLUMNS)), columns=window_columns(window))
+    merged.insert(0, 'id', matched['id'].to_numpy())
+    merged.insert(1, 'symbol', matched['symbol'].to_numpy())
+    merged.insert(2, 'created_at', matched['created_at'].to_numpy())
+    merged['open'] = values[:, 0, 0]
+    merged['high'] = values[:, :, 1].max(axis=1)
+    merged['low'] = values[:, :, 2].min(axis=1)
+    merged['close'] = values[:, -1, 3]
+    merged['volume'] = values[:, :, 4].sum(axis=1)
+
+    as_of = pd.merge_asof(
+        merged[['symbol', 'created_at']].reset_index().sort_values('created_at'),
+        rolling_features(candles, window).sort_values('timestamp'),
+        left_on='created_at', right_on='timestamp', by='symbol'
+    ).set_index('index').sort_index()
+    for name in FEATURE_NAMES:
+        merged[name] = as_of[name].to_numpy()
+    merged['total_profit'] = matched['total_profit'].to_numpy()
+    return merged
+
+# Same as merge_data over candle chunks ordered by symbol and timestamp (as
+# yielded by fetch_candlestick_data(chunksize=...)). Only the symbol that may
+# continue into the next chunk is carried over between chunks.
+def merge_data_streamed(trade_signals, candle_chunks, window=CANDLE_WINDOW):
+    merged = []
+    carry = None
+    for chunk in candle_chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        last_symbol = chunk['symbol'].iloc[-1]
+        continues = (chunk['symbol'] == last_symbol).to_numpy()
+        complete = chunk[~continues]
+        carry = chunk[continues]
+        if not complete.empty:
+            trades = trade_signals[trade_signals['symbol'].isin(complete['symbol'].unique())]
+            merged.append(merge_data(trades, complete, window))
+    if carry is not None and not carry.empty:
+        trades = trade_signals[trade_signals['symbol'] == carry['symbol'].iloc[0]]
+        merged.append(merge_data(trades, carry, window))
+    if not merged:
+        return merge_data(trade_signals.iloc[0:0], pd.DataFrame(), window)
+    return pd.concat(merged, ignore_index=True)
 
 # Prepare data for training
 def prepare_data(df):
@@ -79,14 +184,24 @@ def predict_trade_signal(candle):
         candle['v']
     ]], columns=['open', 'high', 'low', 'close', 'volume'])
     
-    prediction = model.predict(features)[0]
+    prediction = load_model().predict(features)[0]
     return prediction
 
 if __name__ == "__main__":
+    from sklearn.model_selection import train_test_split, cross_val_score
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import classification_report, accuracy_score
+    from sklearn.impute import SimpleImputer
+    from imblearn.over_sampling import SMOTE
+
     # Fetch and merge data
-    trade_signals = fetch_trade_signals()
-    candlestick_data = fetch_candlestick_data()
-    merged_data = merge_data(trade_signals, candlestick_data)
+    if USE_CACHE:
+        candle_cache.sync()
+        trade_signals = cached_trade_signals()
+        merged_data = merge_data_streamed(trade_signals, candle_cache.iter_candles())
+    else:
+        trade_signals = fetch_trade_signals()
+        merged_data = merge_data_streamed(trade_signals, fetch_candlestick_data(chunksize=CHUNK_SIZE))
 
     # Handle missing values
     features = merged_data[['open', 'high', 'low', 'close', 'volume']]
@@ -0,0 +1,136 @@
+import json
+import os
+import sys
+import numpy as np
+
+FORMAT_VERSION = 1
+ARRAYS = ('roots', 'left', 'right', 'feature', 'threshold', 'proba', 'classes')
+
+
+def compact_path(model_path):
+    return os.path.splitext(model_path)[0] + '.forest'
+
+
+# Random forest flattened into a handful of NumPy arrays. Node arrays hold
+# every tree back to back (child indices are global), roots[t] is the first
+# node of tree t and proba holds each node's class distribution. Scoring walks
+# all trees for all rows at once, one tree level per step, with no sklearn.
+class CompactForest:
+    def __init__(self, roots, left, right, feature, threshold, proba, classes, max_depth, n_features):
+        self.roots = roots
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.proba = proba
+        self.classes_ = classes
+        self.max_depth = max_depth
+        self.n_features_in_ = n_features
+
+    def leaves(self, X):
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            left = self.left[nodes]
+            internal = left >= 0
+            if not internal.any():
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(internal, np.where(go_left, left, self.right[nodes]), nodes)
+        return nodes
+
+    def predict_proba(self, X):
+        return self.proba[self.leaves(X)].mean(axis=1)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def flatten(model):
+    roots, left, right, feature, threshold, proba = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n = tree.node_count
+        is_leaf = tree.children_left < 0
+        roots.append(offset)
+        left.append(np.where(is_leaf, -1, tree.children_left + offset))
+        right.append(np.where(is_leaf, -1, tree.children_right + offset))
+        # Leaves get feature 0 so indexing stays in bounds; they are never followed
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        value = tree.value[:, 0, :].astype(np.float64)
+        totals = value.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1
+        proba.append(value / totals)
+        max_depth = max(max_depth, tree.max_depth)
+        offset += n
+    return CompactForest(
+        np.asarray(roots, dtype=np.int64),
+        np.concatenate(left).astype(np.int64),
+        np.concatenate(right).astype(np.int64),
+        np.concatenate(feature).astype(np.int64),
+        np.concatenate(threshold).astype(np.float64),
+        np.concatenate(proba),
+        np.asarray(model.classes_),
+        int(max_depth),
+        int(model.n_features_in_)
+    )
+
+
+# Size and mtime of the pickle an export was made from, recorded in its
+# meta.json so loaders can tell whether the export is still current
+def source_stamp(model_path):
+    stat = os.stat(model_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Whether the export at path was made from the current model_path pickle (or
+# there is no pickle to compare with)
+def is_current(path, model_path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not os.path.exists(model_path):
+        return True
+    return meta.get('source') == source_stamp(model_path)
+
+
+def save_forest(forest, path, source=None):
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        array = forest.classes_ if name == 'classes' else getattr(forest, name)
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'format': FORMAT_VERSION, 'max_depth': forest.max_depth, 'n_features': forest.n_features_in_,
+                   'trees': len(forest.roots), 'nodes': len(forest.left), 'source': source}, f)
+
+
+# Arrays are memory-mapped, so loading costs a few page mappings rather than
+# unpickling every tree
+def load_forest(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format'] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported compact model format {meta['format']} in {path}")
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS if name != 'classes'}
+    classes = np.load(os.path.join(path, 'classes.npy'), allow_pickle=True)
+    return CompactForest(classes=classes, max_depth=meta['max_depth'], n_features=meta['n_features'], **arrays)
+
+
+def export_model(model_path, path=None):
+    import joblib
+    path = path or compact_path(model_path)
+    source = source_stamp(model_path)
+    save_forest(flatten(joblib.load(model_path)), path, source)
+    return path
+
+
+if __name__ == "__main__":
+    for model_path in sys.argv[1:] or ['VERY_GOOD_MODEL.pkl']:
+        print(f"Exported {model_path} to {export_model(model_path)}")
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from collections import deque
+import aiohttp
+import discord
+from write_queue import writer
+from metrics import metrics, received_at
+
+# Discord allows 5 messages per 5 seconds per channel
+RATE_LIMIT = 5
+RATE_PERIOD = 5.0
+# Alerts queued within this window of each other go out as one message
+COALESCE_WINDOW = 0.25
+MAX_MESSAGE_LENGTH = 2000
+MAX_PENDING = 5000
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+
+class TokenBucket:
+    def __init__(self, rate=RATE_LIMIT, period=RATE_PERIOD):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+            self._refill()
+        self.tokens -= 1
+
+
+# Join queued lines into as few messages as fit under Discord's length limit
+def pack_lines(lines, max_length=MAX_MESSAGE_LENGTH):
+    messages, current, length = [], [], 0
+    for line in lines:
+        line = line[:max_length]
+        added = len(line) + (1 if current else 0)
+        if current and length + added > max_length:
+            messages.append(current)
+            current, length = [], 0
+            added = len(line)
+        current.append(line)
+        length += added
+    if current:
+        messages.append(current)
+    return messages
+
+
+# Outbound Discord queue. send() never waits on Discord: alerts are queued and
+# a background task coalesces everything raised by the same bar into one
+# multi-line message, paces sends with a per-channel token bucket, retries
+# failures with backoff and hands the signal_messages rows to the write queue.
+class Dispatcher:
+    def __init__(self, get_channel, channel_id, coalesce_window=COALESCE_WINDOW):
+        self.get_channel = get_channel
+        self.channel_id = channel_id
+        self.coalesce_window = coalesce_window
+        self.pending = deque()
+        self.buckets = {}
+        self.sent = 0
+        self.dropped = 0
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, message, channel_id=None):
+        if len(self.pending) >= MAX_PENDING:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append((channel_id or self.channel_id, message, time.monotonic(), received_at.get()))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def snapshot(self):
+        lag = time.monotonic() - self.pending[0][2] if self.pending else 0.0
+        return {'depth': len(self.pending), 'lag': round(lag, 4), 'sent': self.sent, 'dropped': self.dropped}
+
+    async def _run(self):
+        while not (self._closing and not self.pending):
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Give the rest of the bar's alerts a moment to arrive
+            if not self._closing:
+                await asyncio.sleep(self.coalesce_window)
+            await self._send_pending()
+
+    async def _send_pending(self):
+        by_channel = {}
+        while self.pending:
+            channel_id, message, _, received = self.pending.popleft()
+            by_channel.setdefault(channel_id, []).append((message, received))
+        for channel_id, entries in by_channel.items():
+            receipts = iter([received for _, received in entries])
+            for chunk in pack_lines([message for message, _ in entries]):
+                await self._deliver(channel_id, chunk, [next(receipts) for _ in chunk])
+
+    # receipts holds, per line, the perf_counter() time the bar behind it
+    # arrived (or None), for the tick-to-alert histogram
+    async def _deliver(self, channel_id, lines, receipts=()):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.buckets[channel_id] = TokenBucket()
+        content = '\n'.join(lines)
+        for attempt in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                channel = self.get_channel(channel_id)
+                if channel is None:
+                    raise LookupError(f"channel {channel_id} is not available")
+                started = time.perf_counter()
+                await channel.send(content)
+                metrics.since('discord_send', started)
+                break
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+                if attempt == MAX_RETRIES:
+                    print(f"Dropping Discord message after {MAX_RETRIES} retries: {e}")
+                    self.dropped += len(lines)
+                    return
+                retry_after = getattr(e, 'retry_after', None) or RETRY_BACKOFF * 2 ** attempt
+                print(f"Discord send failed ({e}), retrying in {retry_after:.1f}s")
+                await asyncio.sleep(retry_after)
+        self.sent += len(lines)
+        sent_at = time.perf_counter()
+        for received in receipts:
+            if received is not None:
+                metrics.observe('tick_to_alert', sent_at - received)
+        metrics.count('alerts', len(lines))
+        for line in lines:
+            writer.save_message(line)
+
+    # Send everything still queued, then stop
+    async def drain(self):
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
@@ -0,0 +1,161 @@
+import ast
+import numpy as np
+
+CANDLE_FIELDS = ('o', 'h', 'l', 'c', 'v', 't')
+FUNCTIONS = {
+    'where': np.where,
+    'maximum': np.maximum,
+    'minimum': np.minimum,
+    'abs': np.abs,
+}
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.BitAnd, ast.BitOr, ast.UnaryOp, ast.USub, ast.Not, ast.Invert, ast.Compare, ast.Eq, ast.NotEq,
+    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Attribute, ast.Name, ast.Load, ast.Constant, ast.Call,
+)
+
+
+# Rewrites a rule expression for element-wise evaluation over arrays:
+# and/or/not become &/|/~ and chained comparisons are split into pairs
+class Vectorize(ast.NodeTransformer):
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = ast.BinOp(left=result, op=op, right=value)
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left, result = node.left, None
+        for op, right in zip(node.ops, node.comparators):
+            pair = ast.Compare(left=left, ops=[op], comparators=[right])
+            result = pair if result is None else ast.BinOp(left=result, op=ast.BitAnd(), right=pair)
+            left = right
+        return result
+
+
+def check_expression(tree, source):
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"{type(node).__name__} is not allowed in rule expression {source!r}")
+        if isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id in ('prev', 'cur') and node.attr in CANDLE_FIELDS):
+                raise ValueError(f"Only prev.<field> and cur.<field> ({', '.join(CANDLE_FIELDS)}) may be used in {source!r}")
+        if isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS) or node.keywords:
+                raise ValueError(f"Only {', '.join(FUNCTIONS)} may be called in {source!r}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Only numeric constants are allowed in {source!r}")
+
+
+def compile_expression(source, name):
+    tree = ast.parse(source, mode='eval')
+    check_expression(tree, source)
+    tree = ast.fix_missing_locations(Vectorize().visit(tree))
+    return compile(tree, f'<rule {name}>', 'eval')
+
+
+def names_used(source):
+    return {node.id for node in ast.walk(ast.parse(source, mode='eval')) if isinstance(node, ast.Name)}
+
+
+# A candle pattern over the previous and current candle of one symbol and
+# timeframe. `when` selects the pairs that signal; entry, stop and
+# invalidated give the signal's prices. Expressions are written as scalar
+# Python over prev.<field> / cur.<field>, `size` (the candle size in minutes),
+# any rolling feature passed to evaluate(), and where/maximum/minimum/abs.
+# sizes optionally limits the rule to some candle sizes.
+class Rule:
+    def __init__(self, name, signal_type, when, entry, stop, invalidated, sizes=None):
+        # check_and_update_signals only knows how to manage these two
+        if signal_type not in ('LONG', 'SHORT'):
+            raise ValueError(f"Rule {name}: signal_type must be LONG or SHORT, not {signal_type!r}")
+        self.name = name
+        self.signal_type = signal_type
+        self.sources = {'when': when, 'entry': entry, 'stop': stop, 'invalidated': invalidated}
+        self.code = {part: compile_expression(source, f'{name}.{part}') for part, source in self.sources.items()}
+        self.features = set().union(*(names_used(source) for source in self.sources.values())) - set(FUNCTIONS) - {'prev', 'cur', 'size'}
+        self.sizes = tuple(sizes) if sizes else None
+
+    def __repr__(self):
+        return f"Rule({self.name}, {self.signal_type})"
+
+
+class Candles:
+    __slots__ = CANDLE_FIELDS
+
+    def __init__(self, fields):
+        for field in CANDLE_FIELDS:
+            setattr(self, field, fields.get(field))
+
+
+# The live analyze_for_shorts / analyze_for_longs checks as rules
+BUILTIN_RULES = [
+    Rule('short_reversal', 'SHORT',
+         when='cur.h > prev.h and cur.c != cur.o and cur.c < prev.c and not cur.l < prev.l',
+         entry='where(cur.c < cur.o, cur.o, cur.c)',
+         stop='cur.h',
+         invalidated='prev.l'),
+    Rule('long_reversal', 'LONG',
+         when='cur.l < prev.l and ((cur.o < cur.c and cur.c < prev.o) or (cur.o > cur.c and cur.c > prev.c)) and not cur.h > prev.h',
+         entry='where(cur.o < cur.c, cur.o, cur.c)',
+         stop='cur.l',
+         invalidated='prev.h'),
+]
+
+
+# Rules compiled once and evaluated as whole-array expressions over every
+# candle pair closed at a bar (all symbols and timeframes in one pass)
+class RuleSet:
+    def __init__(self, rules=BUILTIN_RULES):
+        self.rules = list(rules)
+        self.features = set().union(*(rule.features for rule in self.rules)) if self.rules else set()
+
+    # Per rule: (rule, mask, entry, stop, invalidated) arrays. prev and cur map
+    # candle fields to equal-length arrays; size is an array or scalar.
+    def masks(self, prev, cur, size=0, features=None):
+        n = len(cur['c'])
+        namespace = dict(FUNCTIONS, prev=Candles(prev), cur=Candles(cur), size=size)
+        if features:
+            namespace.update(features)
+        missing = self.features - namespace.keys()
+        if missing:
+            raise KeyError(f"Rules need features that were not supplied: {', '.join(sorted(missing))}")
+        results = []
+        for rule in self.rules:
+            values = {part: np.broadcast_to(eval(code, {'__builtins__': {}}, namespace), n)
+                      for part, code in rule.code.items()}
+            mask = values['when'].astype(bool)
+            if rule.sizes is not None:
+                mask = mask & np.isin(size, rule.sizes)
+            results.append((rule, mask, values['entry'], values['stop'], values['invalidated']))
+        return results
+
+    # Matching (index, rule, entry, stop, invalidated) in candle order and,
+    # for one candle, in rule order
+    def evaluate(self, prev, cur, size=0, features=None):
+        matches = []
+        for order, (rule, mask, entry, stop, invalidated) in enumerate(self.masks(prev, cur, size, features)):
+            for index in np.flatnonzero(mask):
+                matches.append((int(index), order, rule, float(entry[index]), float(stop[index]), float(invalidated[index])))
+        matches.sort(key=lambda match: (match[0], match[1]))
+        return [(index, rule, entry, stop, invalidated) for index, _, rule, entry, stop, invalidated in matches]
+
+
+# Field arrays from a list of candle dicts (the shape CandleEngine returns)
+def candle_arrays(candles):
+    return {field: np.fromiter((candle[field] for candle in candles), dtype=np.float64, count=len(candles))
+            for field in CANDLE_FIELDS}
+
+
+default_rules = RuleSet()
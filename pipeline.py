@@ -0,0 +1,180 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+QUEUE_SIZE = 1000
+REPORT_INTERVAL = 60
+
+
+def make_executor(kind, workers, initializer=None, initargs=()):
+    if kind == 'process':
+        return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    return None
+
+
+class StageStats:
+    __slots__ = ('processed', 'errors', 'wait_total', 'wait_max', 'service_total', 'service_max', 'last_lag')
+
+    def __init__(self):
+        self.processed = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self.service_max = 0.0
+        self.last_lag = 0.0
+
+    def record(self, wait, service):
+        self.processed += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.service_total += service
+        self.service_max = max(self.service_max, service)
+        self.last_lag = wait + service
+
+
+# One step of the pipeline. Items wait in a bounded queue, so a slow stage
+# pushes back on whoever feeds it. Sync handlers run on the stage's executor
+# (if any) and async handlers on the event loop. A non-None return value goes
+# to the downstream stage. With more than one worker, results are still passed
+# downstream in the order items arrived.
+class Stage:
+    def __init__(self, name, handler, workers=1, maxsize=QUEUE_SIZE, executor=None, downstream=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.executor = executor
+        self.downstream = downstream
+        self.stats = StageStats()
+        self.queue = None
+        self._tasks = []
+        self._sequence = 0
+        self._next_out = 0
+        self._finished = {}
+
+    def start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def put(self, item):
+        sequence = self._sequence
+        self._sequence += 1
+        await self.queue.put((time.monotonic(), sequence, item))
+
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    # Age of the item that has been waiting longest
+    def lag(self):
+        if self.queue is None or self.queue.empty():
+            return 0.0
+        enqueued_at = self.queue._queue[0][0]
+        return time.monotonic() - enqueued_at
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            enqueued_at, sequence, item = await self.queue.get()
+            started = time.monotonic()
+            result = None
+            try:
+                if asyncio.iscoroutinefunction(self.handler):
+                    result = await self.handler(item)
+                elif self.executor is not None:
+                    result = await loop.run_in_executor(self.executor, self.handler, item)
+                else:
+                    result = self.handler(item)
+            except Exception as e:
+                self.stats.errors += 1
+                print(f"Pipeline stage {self.name} failed: {e!r}")
+            finally:
+                self.stats.record(started - enqueued_at, time.monotonic() - started)
+            try:
+                await self._forward(sequence, result)
+            finally:
+                self.queue.task_done()
+
+    async def _forward(self, sequence, result):
+        if self.workers == 1:
+            self._next_out = sequence + 1
+            if result is not None and self.downstream is not None:
+                await self.downstream.put(result)
+            return
+        self._finished[sequence] = result
+        while self._next_out in self._finished:
+            result = self._finished.pop(self._next_out)
+            self._next_out += 1
+            if result is not None and self.downstream is not None:
+                await self.downstream.put(result)
+
+    async def join(self):
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def snapshot(self):
+        stats = self.stats
+        processed = stats.processed or 1
+        return {
+            'depth': self.depth(),
+            'lag': round(self.lag(), 4),
+            'processed': stats.processed,
+            'errors': stats.errors,
+            'wait_avg': round(stats.wait_total / processed, 4),
+            'wait_max': round(stats.wait_max, 4),
+            'service_avg': round(stats.service_total / processed, 4),
+            'service_max': round(stats.service_max, 4),
+        }
+
+
+class Pipeline:
+    def __init__(self, stages, gauges=None):
+        self.stages = stages
+        self.gauges = gauges or {}
+        self._reporter = None
+
+    @property
+    def head(self):
+        return self.stages[0]
+
+    def start(self, report_interval=REPORT_INTERVAL):
+        for stage in self.stages:
+            stage.start()
+        if report_interval:
+            self._reporter = asyncio.create_task(self._report(report_interval))
+
+    async def put(self, item):
+        await self.head.put(item)
+
+    # Let queued work finish in stage order, then stop the workers
+    async def stop(self):
+        if self._reporter is not None:
+            self._reporter.cancel()
+        for stage in self.stages:
+            await stage.join()
+        for stage in self.stages:
+            await stage.stop()
+
+    # Queue depth and lag per stage, plus any extra gauges (such as the
+    # database write queue) registered as name -> callable
+    def snapshot(self):
+        snapshot = {stage.name: stage.snapshot() for stage in self.stages}
+        for name, gauge in self.gauges.items():
+            snapshot[name] = gauge()
+        return snapshot
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            for name, values in self.snapshot().items():
+                print(f"[pipeline] {name}: " + ", ".join(f"{key}={value}" for key, value in values.items()))
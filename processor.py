@@ -0,0 +1,176 @@
+import asyncio
+import time
+import numpy as np
+import inference
+from features import FeatureStore, feature_columns
+from patterns import candle_arrays, default_rules
+from signal_book import save_signal
+from check_signals import check_and_update_signals
+from clock import clock
+from metrics import metrics, received_at
+
+
+class CandleBatch:
+    __slots__ = ('msgs', 'received_at', 'closed', 'keys', 'rows', 'scores')
+
+    def __init__(self, msgs, received_at=None):
+        self.msgs = msgs
+        self.received_at = received_at
+        self.closed = []
+        self.keys = []
+        self.rows = []
+        self.scores = None
+
+
+# The per-bar work behind the aggregate -> score -> signals pipeline stages,
+# for one set of tickers. main.py runs a single processor; in sharded mode
+# every worker process runs its own over the tickers it owns.
+class BarProcessor:
+    def __init__(self, candles, recovery, predictor, publish, executor=None, bot=None, min_confidence=0.0, rules=None, features=None, scheduler=None):
+        self.candles = candles
+        self.features = FeatureStore() if features is None else features
+        self.recovery = recovery
+        self.predictor = predictor
+        self.publish = publish
+        self.executor = executor
+        self.bot = bot
+        self.min_confidence = min_confidence
+        self.rules = rules or default_rules
+        self.scheduler = scheduler
+        # Latest close per ticker, for the scheduler's trade updates
+        self.prices = {}
+        # event_log.BotState recording bars and signals and taking snapshots,
+        # if any (set by whoever creates it)
+        self.state = None
+
+    # Pipeline stage 1: fill any gaps, then fold every bar in the batch so all
+    # candles closing this minute can be scored together. Recovered bars join the
+    # batch ahead of the live bar, and the signal stage replays them in time order.
+    # Closed candles are keyed in the predictor by their position in
+    # batch.closed, as a backfilled batch can close several candles of one
+    # ticker and size. Items are (receipt perf_counter time, websocket messages).
+    async def aggregate_batch(self, item):
+        received, msgs = item
+        bars = await self.recovery.expand_batch(msgs)
+        started = time.perf_counter()
+        batch = CandleBatch(bars, received)
+        if self.state is not None:
+            self.state.record_bars(bars)
+        for bar_index, ticker, size, aggregated_candle, previous_candle, end_timestamp, features in self.fold(bars):
+            print(f"Aggregated candle for size {size}: {aggregated_candle}")
+            if previous_candle is not None:
+                self.predictor.add(len(batch.closed), aggregated_candle, features)
+                batch.closed.append((bar_index, ticker, size, aggregated_candle, previous_candle, end_timestamp, features))
+        batch.keys, batch.rows = self.predictor.take()
+        if self.state is not None:
+            self.state.after_batch()
+        metrics.since('aggregate', started)
+        return batch
+
+    # Fold bars into the candles, and every candle they close into the rolling
+    # features with one update call. Returns (index of the closing bar in bars,
+    # ticker, size, candle, previous_candle, end_timestamp, features) per
+    # closed candle.
+    def fold(self, bars):
+        completed = []
+        for bar_index, equity_agg in enumerate(bars):
+            ticker = equity_agg.symbol
+            for size, aggregated_candle, previous_candle in self.candles.update(ticker, equity_agg.open, equity_agg.high, equity_agg.low, equity_agg.close, equity_agg.volume, equity_agg.start_timestamp, equity_agg.end_timestamp):
+                completed.append((bar_index, ticker, size, aggregated_candle, previous_candle, equity_agg.end_timestamp))
+        if not completed:
+            return []
+        candles = candle_arrays([candle for _, _, _, candle, _, _ in completed])
+        rolling = self.features.update([(ticker, size) for _, ticker, size, _, _, _ in completed],
+                                       candles['o'], candles['h'], candles['l'], candles['c'], candles['v'], candles['t'])
+        return [closed + (features,) for closed, features in zip(completed, rolling)]
+
+    # Pipeline stage 2: score the closed candles off the event loop
+    async def score_batch(self, batch):
+        if batch.rows:
+            started = time.perf_counter()
+            predictions, confidences = await asyncio.get_running_loop().run_in_executor(self.executor, inference.score_rows, batch.rows)
+            batch.scores = dict(zip(batch.keys, zip(predictions, confidences)))
+            metrics.since('predict', started)
+        return batch
+
+    # Pipeline stage 3: walk the batch's bars in time order. Each bar first
+    # turns the candles it closed into signals, then moves the open signals
+    # forward, so a signal is checked from the bar that closed its candle on
+    # (as backtest.simulate does) and never against an earlier bar.
+    # Database writes go to the write queue, alerts to publish. The scheduler,
+    # if any, then sees the batch's last bar end.
+    async def signal_batch(self, batch):
+        received_at.set(batch.received_at)
+        candidates = []
+        for index, (bar_index, ticker, size, aggregated_candle, previous_candle, end_timestamp, features) in enumerate(batch.closed):
+            prediction, confidence = batch.scores[index]
+            print(f"Trade signal prediction: {prediction}, confidence: {confidence:.4f}")
+            if confidence >= self.min_confidence:
+                candidates.append((ticker, size, aggregated_candle, previous_candle, end_timestamp, round(confidence, 4), features, bar_index))
+        matches = self.analyze(candidates) if candidates else {}
+
+        for bar_index in sorted(range(len(batch.msgs)), key=lambda index: batch.msgs[index].end_timestamp):
+            equity_agg = batch.msgs[bar_index]
+            for match in matches.get(bar_index, ()):
+                await self.emit(*match)
+            started = time.perf_counter()
+            await check_and_update_signals(self.bot, equity_agg, clock.at(equity_agg.end_timestamp))
+            metrics.since('check_signals', started)
+            self.prices[equity_agg.symbol] = equity_agg.close
+        if batch.received_at is not None:
+            metrics.since('bar_to_processed', batch.received_at)
+        if self.scheduler is not None and batch.msgs:
+            await self.scheduler.bar(self.prices, max(equity_agg.end_timestamp for equity_agg in batch.msgs))
+
+    # Evaluate every pattern rule over all the candidate candles of the batch
+    # in one pass. Returns {closing bar index: [(candidate, rule, entry, stop,
+    # invalidated)]}, per candle in rule order.
+    def analyze(self, candidates):
+        started = time.perf_counter()
+        matches = self.rules.evaluate(candle_arrays([candidate[3] for candidate in candidates]),
+                                      candle_arrays([candidate[2] for candidate in candidates]),
+                                      np.array([candidate[1] for candidate in candidates]),
+                                      feature_columns(np.array([candidate[6] for candidate in candidates])))
+        metrics.since('analyze', started)
+        by_bar = {}
+        for index, rule, entry_point, stop_loss, invalidated_price in matches:
+            candidate = candidates[index]
+            by_bar.setdefault(candidate[7], []).append((candidate, rule, entry_point, stop_loss, invalidated_price))
+        return by_bar
+
+    # Alert and save one rule match
+    async def emit(self, candidate, rule, entry_point, stop_loss, invalidated_price):
+        ticker, size, aggregated_candle, previous_candle, end_timestamp, confidence, _, _ = candidate
+        volume_confirmed = aggregated_candle['v'] > previous_candle['v']
+        analysis_result = {
+            'ticker': ticker,
+            'entry_point': entry_point,
+            'stop_loss': stop_loss,
+            'invalidated_price': invalidated_price,
+            'timestamp': aggregated_candle['t']
+        }
+        print(f"{rule.name} analysis result: {analysis_result}")
+        await self.publish(format_message(rule.signal_type, analysis_result, size, volume_confirmed))
+        started = time.perf_counter()
+        signal = save_signal(ticker, rule.signal_type, entry_point, stop_loss, invalidated_price, None, volume_confirmed, end_timestamp, confidence)
+        metrics.since('save_signal', started)
+        if self.state is not None and signal is not None:
+            self.state.record_signal(signal, rule.name, ticker, size, rule.signal_type, entry_point, stop_loss, invalidated_price, volume_confirmed, end_timestamp, confidence)
+        metrics.count('signals')
+
+
+def format_message_short(analysis_result, candle_size, volume):
+    volume_text = "[VC]" if volume else ""
+    timestamp = clock.at(analysis_result['timestamp']).text
+    return f"SHORT Alert: {analysis_result['ticker']}, Entry: {analysis_result['entry_point']}, Stop: {analysis_result['stop_loss']} | {timestamp}"
+
+def format_message_long(analysis_result, candle_size, volume):
+    volume_text = "[VC]" if volume else ""
+    timestamp = clock.at(analysis_result['timestamp']).text
+    return f"LONG Alert: {analysis_result['ticker']}, Entry: {analysis_result['entry_point']}, Stop: {analysis_result['stop_loss']} | {timestamp}"
+
+
+def format_message(signal_type, analysis_result, candle_size, volume):
+    if signal_type == 'SHORT':
+        return format_message_short(analysis_result, candle_size, volume)
+    return format_message_long(analysis_result, candle_size, volume)
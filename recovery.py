@@ -0,0 +1,170 @@
+import asyncio
+import csv
+import time
+from metrics import metrics
+
+MINUTE = 60000
+# Gaps longer than this (e.g. overnight) are not backfilled
+MAX_BACKFILL_MINUTES = 390
+# The feed delivering no bar at all for this many minutes counts as an outage
+STALE_MINUTES = 2
+# Backfill requests in flight at once
+BACKFILL_CONCURRENCY = 8
+
+
+# Minute bar with the attributes the pipeline reads from polygon's EquityAgg
+class Bar:
+    __slots__ = ('symbol', 'open', 'high', 'low', 'close', 'volume', 'start_timestamp', 'end_timestamp', 'recovered')
+
+    def __init__(self, symbol, open, high, low, close, volume, start_timestamp, end_timestamp=None, recovered=False):
+        self.symbol = symbol
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = end_timestamp if end_timestamp is not None else start_timestamp + MINUTE
+        self.recovered = recovered
+
+    def __repr__(self):
+        return f"Bar({self.symbol} {self.start_timestamp} o={self.open} h={self.high} l={self.low} c={self.close} v={self.volume})"
+
+
+# Bar sources return the minute bars for a symbol with start_timestamp in
+# [start, end), oldest first. fetch() is blocking and runs on an executor.
+class NullBarSource:
+    def fetch(self, symbol, start, end):
+        return []
+
+
+class PolygonRestSource:
+    def __init__(self, api_key):
+        from polygon import RESTClient
+        self.client = RESTClient(api_key)
+
+    def fetch(self, symbol, start, end):
+        bars = []
+        for agg in self.client.list_aggs(symbol, 1, 'minute', start, end - 1, limit=50000):
+            if start <= agg.timestamp < end:
+                bars.append(Bar(symbol, agg.open, agg.high, agg.low, agg.close, agg.volume, agg.timestamp, recovered=True))
+        bars.sort(key=lambda bar: bar.start_timestamp)
+        return bars
+
+
+# Bars from a CSV file with symbol,timestamp,open,high,low,close,volume
+# columns (timestamp = bar start in epoch ms), for replays and tests
+class FileBarSource:
+    def __init__(self, path):
+        self.bars = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                bar = Bar(row['symbol'], float(row['open']), float(row['high']), float(row['low']),
+                          float(row['close']), float(row['volume']), int(row['timestamp']), recovered=True)
+                self.bars.setdefault(bar.symbol, []).append(bar)
+        for bars in self.bars.values():
+            bars.sort(key=lambda bar: bar.start_timestamp)
+
+    def fetch(self, symbol, start, end):
+        return [bar for bar in self.bars.get(symbol, []) if start <= bar.start_timestamp < end]
+
+
+# 'polygon' for the REST API, otherwise the path of a CSV for FileBarSource
+def make_source(name, api_key=None):
+    if name == 'polygon':
+        return PolygonRestSource(api_key)
+    return FileBarSource(name)
+
+
+# Tracks the last minute seen per ticker. Duplicate or out-of-order bars are
+# dropped. A ticker skipping minutes is normal for thin names, so missing
+# minutes are only fetched from the bar source when they overlap a feed
+# outage: the feed as a whole delivering no bar for stale_minutes or more
+# (a websocket disconnect, or the downtime before a restart). The batch's
+# gaps are fetched concurrently, at most concurrency at a time, and returned
+# ahead of the bar that revealed them, so aggregation and signal checks see
+# every minute exactly once and in order.
+class GapRecovery:
+    def __init__(self, source=None, max_minutes=MAX_BACKFILL_MINUTES, executor=None, stale_minutes=STALE_MINUTES, concurrency=BACKFILL_CONCURRENCY):
+        self.source = source or NullBarSource()
+        self.max_minutes = max_minutes
+        self.executor = executor
+        self.stale_minutes = stale_minutes
+        self.limit = asyncio.Semaphore(concurrency)
+        self.last_start = {}
+        # Newest bar start the feed delivered, and (last start before, first
+        # start after) of the recent outages
+        self.feed_last = None
+        self.outages = []
+        self.gaps = 0
+        self.recovered = 0
+        self.duplicates = 0
+
+    async def expand_batch(self, bars):
+        if self.feed_last is None and self.last_start:
+            self.feed_last = max(self.last_start.values())
+        live = []
+        for bar in bars:
+            last = self.last_start.get(bar.symbol)
+            if last is not None and bar.start_timestamp <= last:
+                self.duplicates += 1
+                continue
+            live.append((bar, last))
+            self.last_start[bar.symbol] = bar.start_timestamp
+        if not live:
+            return []
+        self.watch(min(bar.start_timestamp for bar, _ in live), max(bar.start_timestamp for bar, _ in live))
+
+        gaps = []
+        for index, (bar, last) in enumerate(live):
+            if last is None or bar.start_timestamp - last <= MINUTE:
+                continue
+            missing = (bar.start_timestamp - last) // MINUTE - 1
+            if missing <= self.max_minutes and self.in_outage(last, bar.start_timestamp):
+                gaps.append((index, bar.symbol, last + MINUTE, bar.start_timestamp, missing))
+        recovered = {}
+        if gaps:
+            self.gaps += len(gaps)
+            fetched = await asyncio.gather(*(self.backfill(symbol, start, end) for _, symbol, start, end, _ in gaps))
+            for (index, symbol, _, _, missing), backfilled in zip(gaps, fetched):
+                print(f"Recovered {len(backfilled)} of {missing} missing minutes for {symbol}")
+                recovered[index] = backfilled
+
+        expanded = []
+        for index, (bar, _) in enumerate(live):
+            expanded.extend(recovered.get(index, ()))
+            expanded.append(bar)
+        return expanded
+
+    # Record an outage if the feed went quiet before this batch, and forget
+    # outages too old for any gap to still be backfilled
+    def watch(self, first, newest):
+        previous = self.feed_last
+        if previous is not None and first - previous > self.stale_minutes * MINUTE:
+            print(f"Bar feed stale for {(first - previous) // MINUTE - 1} minutes")
+            self.outages.append((previous, first))
+        if previous is None or newest > previous:
+            self.feed_last = newest
+        horizon = self.feed_last - (self.max_minutes + 1) * MINUTE
+        self.outages = [outage for outage in self.outages if outage[1] > horizon]
+
+    # Whether a minute strictly between last and start fell in an outage
+    def in_outage(self, last, start):
+        return any(max(last, before) + MINUTE < min(start, after) for before, after in self.outages)
+
+    async def backfill(self, symbol, start, end):
+        loop = asyncio.get_running_loop()
+        async with self.limit:
+            started = time.perf_counter()
+            try:
+                bars = await loop.run_in_executor(self.executor, self.source.fetch, symbol, start, end)
+            except Exception as e:
+                print(f"Backfill for {symbol} failed: {e!r}")
+                return []
+            finally:
+                metrics.since('backfill', started)
+        self.recovered += len(bars)
+        return list(bars)
+
+    def snapshot(self):
+        return {'gaps': self.gaps, 'recovered': self.recovered, 'duplicates': self.duplicates, 'outages': len(self.outages)}
@@ -0,0 +1,144 @@
+import asyncio
+import gc
+import inspect
+import time
+from datetime import datetime, timedelta
+from clock import MINUTE, clock
+from metrics import metrics
+
+# Regular US equity session, as minutes after midnight Eastern. Bars are
+# in session when they end after the open and no later than the close.
+MARKET_OPEN = 9 * 60 + 30
+MARKET_CLOSE = 16 * 60
+TRADING_DAYS = (0, 1, 2, 3, 4)
+# Warm-up jobs run this many minutes before the open, end-of-day jobs this
+# many minutes after the close
+WARM_UP_LEAD = 20
+END_OF_DAY_DELAY = 5
+# Open-trade P/L summaries go out on the first bar of each interval of this
+# many minutes (aligned to the hour) inside the session
+UPDATE_INTERVAL = 6
+
+
+def in_session(bar_time):
+    eastern = bar_time.eastern
+    minute = eastern.hour * 60 + eastern.minute
+    return eastern.weekday() in TRADING_DAYS and MARKET_OPEN < minute <= MARKET_CLOSE
+
+
+# Keeps work that isn't per bar out of the trading window.
+#
+# update(prices, bar_time) is the periodic trade summary. It is driven by the
+# bar stream: the signal stage calls bar() after each batch, so summaries
+# line up with bar boundaries and use the prices the bot has just processed.
+#
+# warm_up and end_of_day are lists of jobs run on the wall clock, WARM_UP_LEAD
+# minutes before the open and END_OF_DAY_DELAY minutes after the close of
+# every trading day. Coroutine functions are awaited on the event loop; plain
+# functions run on the default executor so pre- and after-market bars keep
+# flowing while they block. A failing job is reported and the rest still run.
+class SessionScheduler:
+    def __init__(self, update=None, warm_up=(), end_of_day=(), interval=UPDATE_INTERVAL):
+        self.update = update
+        self.warm_up = list(warm_up)
+        self.end_of_day = list(end_of_day)
+        self.interval = interval * MINUTE
+        self._slot = None
+        self._last_run = 0
+        self._task = None
+
+    async def bar(self, prices, end_timestamp):
+        if self.update is None:
+            return
+        slot = end_timestamp // self.interval
+        previous = self._slot
+        if previous is not None and slot <= previous:
+            return
+        self._slot = slot
+        if previous is None:
+            return
+        bar_time = clock.at(end_timestamp)
+        if not in_session(bar_time):
+            return
+        started = time.perf_counter()
+        await self.update(prices, bar_time)
+        metrics.since('trade_update', started)
+
+    def start(self):
+        if self._task is None and (self.warm_up or self.end_of_day):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    # (epoch ms, name, jobs) of the first warm-up or end-of-day run after
+    # epoch ms after, or None if there are no jobs
+    def next_run(self, after):
+        day = clock.at(after).eastern.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+        runs = [(MARKET_OPEN - WARM_UP_LEAD, 'warm-up', self.warm_up),
+                (MARKET_CLOSE + END_OF_DAY_DELAY, 'end of day', self.end_of_day)]
+        for days in range(8):
+            date = day + timedelta(days=days)
+            if date.weekday() not in TRADING_DAYS:
+                continue
+            for minute, name, jobs in runs:
+                at = clock.local_ms(date + timedelta(minutes=minute))
+                if jobs and at > after:
+                    return at, name, jobs
+        return None
+
+    async def _run(self):
+        while True:
+            now = clock.now().ms
+            upcoming = self.next_run(max(now, self._last_run))
+            if upcoming is None:
+                return
+            at, name, jobs = upcoming
+            await asyncio.sleep(max(at - now, 0) / 1000)
+            self._last_run = at
+            await run_jobs(name, jobs)
+
+
+async def run_jobs(name, jobs):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    for job in jobs:
+        job_started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(job):
+                await job()
+            else:
+                await loop.run_in_executor(None, job)
+        except Exception as e:
+            print(f"[scheduler] {name} job {job.__name__} failed: {e}")
+            continue
+        print(f"[scheduler] {name} job {job.__name__}: {(time.perf_counter() - job_started) * 1000:.0f}ms")
+    print(f"[scheduler] {name} done at {datetime.now().time()} in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+
+# Convert and format today's session bar times ahead of the open
+def prime_clock():
+    day = clock.now().eastern.replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    clock.prime(clock.local_ms(day + timedelta(minutes=MARKET_OPEN)), clock.local_ms(day + timedelta(minutes=MARKET_CLOSE)))
+
+
+# Collect once before the open and move everything alive (the model, the
+# signal book, caches) to the permanent generation, so collections during the
+# session only scan what the session allocates
+def freeze_heap():
+    gc.collect()
+    gc.freeze()
+
+
+# Undo freeze_heap after the close and collect what the day left behind
+def compact_heap():
+    gc.unfreeze()
+    clock.cache.clear()
+    gc.collect()
@@ -0,0 +1,341 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import database
+from metrics import metrics, received_at
+from write_queue import resolve_id
+
+# Points per shard on the hash ring; more points even out the split
+VIRTUAL_NODES = 64
+# Bar batches a worker may have waiting before routing blocks
+INBOX_SIZE = 1000
+# Most outbox items handled per wakeup of the collector
+COLLECT_BATCH = 500
+STOP_TIMEOUT = 30
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+# Consistent hash of tickers onto shards. Stable across processes and
+# restarts, and changing the shard count only moves about 1/n of the tickers.
+class HashRing:
+    def __init__(self, shards, replicas=VIRTUAL_NODES):
+        points = sorted((ring_hash(f'{shard}:{replica}'), shard) for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, symbol):
+        index = bisect.bisect(self.hashes, ring_hash(symbol)) % len(self.hashes)
+        return self.shards[index]
+
+
+def drain_queue(source, timeout=0.5, limit=COLLECT_BATCH):
+    try:
+        items = [source.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(items) < limit:
+        try:
+            items.append(source.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+
+# Worker-side stand-in for write_queue.writer. Writes are forwarded to the
+# persistence process; a new signal is referred to by a per-worker token
+# until the parent sends back its database id.
+class RemoteWriter:
+    def __init__(self, shard, outbox):
+        self.shard = shard
+        self.outbox = outbox
+        self.unsaved = {}
+        self.tokens = {}
+        self._tokens = count()
+        # Called with each signal once the parent reports its insert committed
+        self.on_saved = None
+
+    def _send(self, kind, payload):
+        self.outbox.put((self.shard, kind, payload))
+
+    def _ref(self, signal):
+        signal_id = resolve_id(signal)
+        if signal_id is not None:
+            return signal_id
+        token = self.tokens.get(id(signal))
+        return None if token is None else ('token', token)
+
+    def save_signal(self, symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence, target=None):
+        args = (symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence)
+        if database.signal_params(*args) is None:
+            return False
+        token = None
+        if target is not None:
+            token = next(self._tokens)
+            self.unsaved[token] = target
+            self.tokens[id(target)] = token
+        self._send('save_signal', (args, token))
+        return True
+
+    def update_signal_stop_loss(self, signal_id, new_stop_loss, timestamp):
+        self._send('update_signal_stop_loss', (self._ref(signal_id), (new_stop_loss, timestamp), {}))
+
+    def update_signal(self, signal_id, total_profit, is_open, invalidated, timestamp, entry_point=None):
+        self._send('update_signal', (self._ref(signal_id), (total_profit, is_open, invalidated, timestamp), {'entry_point': entry_point}))
+
+    def save_message(self, message):
+        self._send('save_message', message)
+
+    def assign_id(self, token, signal_id):
+        signal = self.unsaved.pop(token, None)
+        if signal is None:
+            return
+        del self.tokens[id(signal)]
+        signal.id = signal_id
+        if self.on_saved is not None:
+            self.on_saved(signal)
+        # Writes sent before this point still use the token; the ack follows them
+        self._send('ack', token)
+
+
+# Parent-side target for a worker's new signal. write_ops sets .id once the
+# insert's batch has committed, which also hands the id back to the owning
+# worker over its control queue. That queue is unbounded, so the database
+# write thread never blocks on a worker that is behind on bars.
+class ShardSignal:
+    __slots__ = ('control', 'token', '_id')
+
+    def __init__(self, control, token):
+        self.control = control
+        self.token = token
+        self._id = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+        self.control.put(('id', self.token, value))
+
+
+def bar_tuple(equity_agg):
+    return (equity_agg.symbol, equity_agg.open, equity_agg.high, equity_agg.low, equity_agg.close,
+            equity_agg.volume, equity_agg.start_timestamp, equity_agg.end_timestamp)
+
+
+# Runs the symbol universe across worker processes. Bars are routed to the
+# worker that owns their ticker; each worker keeps its tickers' candles, open
+# signals and model, and sends alerts and database writes back here, where a
+# single dispatcher and write queue handle them for every shard.
+class ShardHub:
+    def __init__(self, shards, send, writer, config):
+        self.ring = HashRing(shards)
+        self.send = send
+        self.writer = writer
+        self.config = config
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+        self.inboxes = [self.context.Queue(INBOX_SIZE) for _ in range(shards)]
+        self.controls = [self.context.Queue() for _ in range(shards)]
+        self.processes = []
+        self.refs = {}
+        self.routed = [0] * shards
+        self.shard_metrics = {}
+        self._collector = None
+        self._reader = ThreadPoolExecutor(1, thread_name_prefix='shard-outbox')
+        self._stopped = set()
+        self._all_stopped = None
+
+    def start(self):
+        self._all_stopped = asyncio.Event()
+        for shard, (inbox, control) in enumerate(zip(self.inboxes, self.controls)):
+            process = self.context.Process(target=run_worker, args=(shard, len(self.inboxes), inbox, control, self.outbox, self.config),
+                                           name=f'shard-{shard}', daemon=True)
+            process.start()
+            self.processes.append(process)
+        self._collector = asyncio.create_task(self._collect())
+
+    # Split a websocket batch by owning shard. Batches are handed over in
+    # arrival order, so every worker still sees its bars in order. received is
+    # the batch's perf_counter() receipt time from metrics.receive.
+    async def route(self, msgs, received=None):
+        batches = {}
+        for equity_agg in msgs:
+            batches.setdefault(self.ring.shard(equity_agg.symbol), []).append(bar_tuple(equity_agg))
+        for shard, bars in batches.items():
+            self.routed[shard] += len(bars)
+            await self._put(self.inboxes[shard], ('bars', bars, received))
+
+    async def _put(self, inbox, item):
+        try:
+            inbox.put_nowait(item)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, inbox.put, item)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for shard, kind, payload in await loop.run_in_executor(self._reader, drain_queue, self.outbox):
+                await self._handle(shard, kind, payload)
+
+    def _resolve(self, shard, ref):
+        if isinstance(ref, tuple):
+            return self.refs.get((shard, ref[1]))
+        return ref
+
+    async def _handle(self, shard, kind, payload):
+        if kind == 'message':
+            message, received = payload
+            received_at.set(received)
+            await self.send(message)
+        elif kind == 'save_signal':
+            args, token = payload
+            target = None
+            if token is not None:
+                target = self.refs[(shard, token)] = ShardSignal(self.controls[shard], token)
+            self.writer.save_signal(*args, target=target)
+        elif kind in ('update_signal', 'update_signal_stop_loss'):
+            ref, args, kwargs = payload
+            getattr(self.writer, kind)(self._resolve(shard, ref), *args, **kwargs)
+        elif kind == 'save_message':
+            self.writer.save_message(payload)
+        elif kind == 'flush':
+            # A stopping worker waits for the ids of its last signals
+            await self.writer.flush_pending()
+            self.controls[shard].put(('flushed',))
+        elif kind == 'ack':
+            self.refs.pop((shard, payload), None)
+        elif kind == 'metrics':
+            self.shard_metrics[shard] = payload
+        elif kind == 'stopped':
+            self._stopped.add(shard)
+            if len(self._stopped) == len(self.inboxes):
+                self._all_stopped.set()
+
+    # Bars routed, liveness and the latest metrics each worker reported
+    def snapshot(self):
+        return {f'shard{shard}': {'routed': routed, 'alive': process.is_alive(), 'metrics': self.shard_metrics.get(shard)}
+                for shard, (routed, process) in enumerate(zip(self.routed, self.processes))}
+
+    # Let every worker finish its queued bars and flush its messages, then
+    # stop the processes
+    async def stop(self):
+        for inbox in self.inboxes:
+            await self._put(inbox, ('stop',))
+        try:
+            await asyncio.wait_for(self._all_stopped.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Shards {sorted(set(range(len(self.inboxes))) - self._stopped)} did not stop in time")
+        self._collector.cancel()
+        # Anything the workers sent after the collector's last pass
+        for shard, kind, payload in drain_queue(self.outbox, timeout=0):
+            await self._handle(shard, kind, payload)
+        for inbox, control in zip(self.inboxes, self.controls):
+            # Ids for late inserts may still be put on the control queues;
+            # don't block exit on them
+            inbox.cancel_join_thread()
+            control.cancel_join_thread()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._reader.shutdown(wait=False)
+
+
+def run_worker(shard, shards, inbox, control, outbox, config):
+    asyncio.run(worker_main(shard, shards, inbox, control, outbox, config))
+
+
+# One shard: the same aggregate -> score -> signals pipeline as the single
+# process bot, over the tickers the ring assigns to this shard
+async def worker_main(shard, shards, inbox, control, outbox, config):
+    import inference
+    import check_signals
+    import signal_book
+    from candle_engine import CandleEngine
+    from inference import BatchPredictor
+    from pipeline import Pipeline, Stage
+    from processor import BarProcessor
+    from recovery import Bar, GapRecovery, make_source
+    from scheduler import SessionScheduler, compact_heap, freeze_heap, prime_clock
+    from event_log import BotState
+
+    ring = HashRing(shards)
+    writer = RemoteWriter(shard, outbox)
+    signal_book.set_writer(writer)
+
+    async def publish(message):
+        outbox.put((shard, 'message', (message, received_at.get())))
+    check_signals.set_message_sink(publish)
+
+    rows = None
+    db_config = config.get('database') or {}
+    if db_config.get('backend', 'pyodbc') != 'pyodbc':
+        from async_database import create_backend
+        db = create_backend(db_config['backend'], db_config['path'], size=1)
+        rows = await db.fetch_open_signals()
+        await db.close()
+    signal_book.book.load(keep=lambda signal: ring.shard(signal.symbol) == shard, rows=rows)
+    model = inference.load_model(config['model_path'])
+    recovery = GapRecovery(make_source(config['bar_source'], config['api_key']))
+    end_of_day = [check_signals.expire_unfilled_signals] if config['expire_unfilled'] else []
+    scheduler = SessionScheduler(check_signals.send_trade_update, [prime_clock, freeze_heap], end_of_day + [compact_heap],
+                                 config['update_interval'])
+    processor = BarProcessor(CandleEngine(config['candle_sizes']), recovery, BatchPredictor(model), publish,
+                             min_confidence=config['min_confidence'], scheduler=scheduler)
+    if config['state_dir']:
+        processor.state = BotState(processor, os.path.join(config['state_dir'], f'shard-{shard}'))
+        writer.on_saved = processor.state.saved
+        signal_book.set_recorder(processor.state.record_update)
+        processor.state.restore()
+        scheduler.end_of_day.append(processor.state.request_rotation)
+    queue_size = config['queue_size']
+    signal_stage = Stage('signals', processor.signal_batch, maxsize=queue_size)
+    score_stage = Stage('score', processor.score_batch, maxsize=queue_size, downstream=signal_stage)
+    aggregate_stage = Stage('aggregate', processor.aggregate_batch, maxsize=queue_size, downstream=score_stage)
+    pipeline = Pipeline([aggregate_stage, score_stage, signal_stage], gauges={'recovery': recovery.snapshot})
+    pipeline.start()
+    scheduler.start()
+    metrics.gauge('pipeline', pipeline.snapshot)
+    reporter = asyncio.create_task(metrics.run(config['metrics_interval'], sink=lambda snapshot: outbox.put((shard, 'metrics', snapshot))))
+    print(f"Shard {shard}/{shards} ready")
+
+    loop = asyncio.get_running_loop()
+    reader = ThreadPoolExecutor(2, thread_name_prefix=f'shard-{shard}-reader')
+
+    # Ids of saved signals, until the parent answers the flush sent at stop
+    async def read_control():
+        while True:
+            item = await loop.run_in_executor(reader, control.get)
+            if item[0] == 'id':
+                writer.assign_id(item[1], item[2])
+            elif item[0] == 'flushed':
+                return
+    control_task = asyncio.create_task(read_control())
+
+    while True:
+        item = await loop.run_in_executor(reader, inbox.get)
+        if item[0] == 'bars':
+            await pipeline.put((item[2], [Bar(*bar) for bar in item[1]]))
+        elif item[0] == 'stop':
+            break
+    await pipeline.stop()
+    await scheduler.stop()
+    # Have the parent write out this shard's last signals, so their ids come
+    # back (and the event log records them as saved) before the state closes
+    outbox.put((shard, 'flush', None))
+    await control_task
+    if processor.state is not None:
+        await processor.state.close()
+    reporter.cancel()
+    reader.shutdown(wait=False)
+    outbox.put((shard, 'stopped', None))
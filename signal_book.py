@@ -0,0 +1,215 @@
+import bisect
+from itertools import count
+import database
+from write_queue import writer
+
+# Bars are widened by this much before the index lookup so float rounding in
+# "close - entry >= risk" style checks can never hide a candidate.
+LEVEL_EPSILON = 1e-6
+
+SIGNAL_FIELDS = (
+    'id', 'symbol', 'signal_type', 'entry_point', 'stop_loss', 'invalidated_price',
+    'take_profit', 'sentiment', 'is_open', 'invalidated', 'volume_confirmed',
+    'total_profit', 'created_at', 'updated_at', 'confidence'
+)
+
+
+class Signal:
+    __slots__ = SIGNAL_FIELDS + ('key',)
+
+    def __init__(self, **fields):
+        for name in SIGNAL_FIELDS:
+            setattr(self, name, fields.get(name))
+        self.key = None
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{name: getattr(row, name) for name in SIGNAL_FIELDS})
+
+    def __repr__(self):
+        return f"Signal(id={self.id}, {self.signal_type} {self.symbol}, entry={self.entry_point}, stop={self.stop_loss}, open={self.is_open})"
+
+
+# Price levels at which check_and_update_signals can act on a signal.
+# "below" levels fire when the bar's low trades at or under them, "above"
+# levels when the bar's high trades at or over them.
+def trigger_levels(signal):
+    below, above = [], []
+    if signal.is_open:
+        risk = abs(signal.entry_point - signal.stop_loss)
+        if signal.signal_type == 'LONG':
+            below.append(signal.stop_loss)
+            above.extend((signal.take_profit, signal.entry_point + risk))
+        elif signal.signal_type == 'SHORT':
+            above.append(signal.stop_loss)
+            below.extend((signal.take_profit, signal.entry_point - risk))
+    else:
+        if signal.signal_type == 'LONG':
+            above.extend((signal.invalidated_price, signal.entry_point))
+        elif signal.signal_type == 'SHORT':
+            below.extend((signal.invalidated_price, signal.entry_point))
+    return ([level for level in below if level is not None],
+            [level for level in above if level is not None])
+
+
+class SymbolLevels:
+    __slots__ = ('below', 'above')
+
+    def __init__(self):
+        self.below = []
+        self.above = []
+
+
+class SignalBook:
+    def __init__(self):
+        self.signals = {}
+        self.levels = {}
+        self._registered = {}
+        self._keys = count()
+
+    # keep optionally filters the loaded signals (e.g. to one shard's tickers).
+    # rows, if given, are open signal rows already fetched (by an async backend).
+    def load(self, keep=None, rows=None):
+        self.clear()
+        for row in database.fetch_open_signals() if rows is None else rows:
+            signal = Signal.from_row(row)
+            if keep is None or keep(signal):
+                self.add(signal)
+        print(f"Loaded {len(self.signals)} open signals into the signal book")
+
+    def clear(self):
+        self.signals.clear()
+        self.levels.clear()
+        self._registered.clear()
+
+    def __len__(self):
+        return len(self.signals)
+
+    def __iter__(self):
+        return iter(sorted(self.signals.values(), key=lambda signal: signal.key))
+
+    def add(self, signal):
+        if signal.key is None:
+            signal.key = next(self._keys)
+        self.signals[signal.key] = signal
+        self._index(signal)
+        return signal
+
+    def remove(self, signal):
+        self._unindex(signal)
+        self.signals.pop(signal.key, None)
+
+    def reindex(self, signal):
+        self._unindex(signal)
+        if signal.invalidated:
+            self.signals.pop(signal.key, None)
+        else:
+            self._index(signal)
+
+    # Signals whose levels were crossed by a bar spanning low..high, in the
+    # order they were opened (the same order the old full scan used).
+    def candidates(self, symbol, low, high):
+        levels = self.levels.get(symbol)
+        if levels is None:
+            return []
+        keys = set()
+        start = bisect.bisect_left(levels.below, (low - LEVEL_EPSILON, -1))
+        keys.update(key for _, key in levels.below[start:])
+        end = bisect.bisect_right(levels.above, (high + LEVEL_EPSILON, float('inf')))
+        keys.update(key for _, key in levels.above[:end])
+        return [self.signals[key] for key in sorted(keys)]
+
+    def _index(self, signal):
+        below, above = trigger_levels(signal)
+        levels = self.levels.get(signal.symbol)
+        if levels is None:
+            levels = self.levels[signal.symbol] = SymbolLevels()
+        entries = ([(level, signal.key) for level in below], [(level, signal.key) for level in above])
+        for entry in entries[0]:
+            bisect.insort(levels.below, entry)
+        for entry in entries[1]:
+            bisect.insort(levels.above, entry)
+        self._registered[signal.key] = (signal.symbol, entries)
+
+    def _unindex(self, signal):
+        registered = self._registered.pop(signal.key, None)
+        if registered is None:
+            return
+        symbol, (below, above) = registered
+        levels = self.levels[symbol]
+        for entry in below:
+            levels.below.pop(bisect.bisect_left(levels.below, entry))
+        for entry in above:
+            levels.above.pop(bisect.bisect_left(levels.above, entry))
+        if not levels.below and not levels.above:
+            del self.levels[symbol]
+
+
+book = SignalBook()
+
+
+# Called as recorder(signal, timestamp) after every state change;
+# event_log.BotState logs the changes of signals not saved yet
+recorder = None
+
+
+# Anything with the WriteQueue interface; sharded workers swap in a writer
+# that forwards to the persistence process
+def set_writer(new_writer):
+    global writer
+    writer = new_writer
+
+
+def set_recorder(new_recorder):
+    global recorder
+    recorder = new_recorder
+
+
+# Queue a new signal for persistence and add it to the resident book. Its id
+# is filled in when the write queue flushes the insert.
+def save_signal(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence):
+    try:
+        created_at = database.to_eastern(timestamp)
+    except (OSError, OverflowError, ValueError):
+        print(f"Invalid timestamp: {timestamp}")
+        return None
+    signal = Signal(
+        symbol=symbol,
+        signal_type=signal_type,
+        entry_point=float(entry_point),
+        stop_loss=float(stop_loss),
+        invalidated_price=float(invalidated_price),
+        take_profit=float(database.calculate_take_profit(signal_type, entry_point, stop_loss)),
+        sentiment=sentiment,
+        is_open=False,
+        invalidated=False,
+        volume_confirmed=bool(volume_confirmed),
+        total_profit=None,
+        created_at=created_at,
+        updated_at=created_at,
+        confidence=str(confidence)
+    )
+    if not writer.save_signal(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence, target=signal):
+        return None
+    return book.add(signal)
+
+
+# Persist a state change and mirror it in the book
+def update_signal(signal, total_profit, is_open, invalidated, timestamp, entry_point=None):
+    writer.update_signal(signal, total_profit, is_open, invalidated, timestamp, entry_point=entry_point)
+    signal.total_profit = total_profit
+    signal.is_open = bool(is_open)
+    signal.invalidated = bool(invalidated)
+    if entry_point is not None:
+        signal.entry_point = entry_point
+    book.reindex(signal)
+    if recorder is not None:
+        recorder(signal, timestamp)
+
+
+def update_signal_stop_loss(signal, new_stop_loss, timestamp):
+    writer.update_signal_stop_loss(signal, new_stop_loss, timestamp)
+    signal.stop_loss = new_stop_loss
+    book.reindex(signal)
+    if recorder is not None:
+        recorder(signal, timestamp)
@@ -0,0 +1,83 @@
+import re
+from collections import namedtuple
+from datetime import datetime
+
+# Running database.py's T-SQL against SQLite, for the aiosqlite backend and
+# the benchmark stand-ins
+
+SQLITE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS trade_signals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        symbol TEXT NOT NULL,
+        signal_type TEXT NOT NULL,
+        entry_point REAL NOT NULL,
+        stop_loss REAL NOT NULL,
+        invalidated_price REAL,
+        take_profit REAL,
+        sentiment REAL,
+        is_open INTEGER DEFAULT 0,
+        invalidated INTEGER DEFAULT 0,
+        volume_confirmed INTEGER DEFAULT 0,
+        total_profit REAL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        confidence TEXT
+    );
+    CREATE INDEX IF NOT EXISTS IX_trade_signals_open
+        ON trade_signals (invalidated, is_open, symbol) WHERE invalidated = 0;
+    CREATE TABLE IF NOT EXISTS signal_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+OUTPUT_CLAUSE = re.compile(r'OUTPUT\s+(.*?)\s+VALUES\s+(.*)', re.S)
+UPDATE_FROM_VALUES = re.compile(
+    r'UPDATE t SET\s+(.*?)\s+FROM trade_signals AS t\s+JOIN \((VALUES .*?)\) AS v \((.*?)\)\s+ON t\.id = v\.id', re.S)
+_translated = {}
+
+
+# T-SQL as database.py writes it -> SQLite:
+# - schema statements (CREATE TABLE, the IF NOT EXISTS migrations) are
+#   replaced by SQLITE_SCHEMA, returned as None
+# - "OUTPUT INSERTED.x ... VALUES" becomes "VALUES ... RETURNING x"
+# - database.update_signals_sql's UPDATE ... FROM ... JOIN (VALUES ...) becomes
+#   a VALUES CTE and UPDATE ... FROM
+def translate(sql):
+    if sql in _translated:
+        return _translated[sql]
+    translated = sql
+    update = UPDATE_FROM_VALUES.search(sql)
+    output = OUTPUT_CLAUSE.search(sql)
+    if 'CREATE TABLE' in sql or sql.lstrip().startswith('IF NOT EXISTS'):
+        translated = None
+    elif update:
+        assignments, values, columns = update.groups()
+        translated = f'WITH v ({columns}) AS ({values}) UPDATE trade_signals AS t SET {assignments} FROM v WHERE t.id = v.id'
+    elif output:
+        columns = output.group(1).replace('INSERTED.', '')
+        translated = sql[:output.start()] + 'VALUES ' + output.group(2).rstrip() + ' RETURNING ' + columns
+    _translated[sql] = translated
+    return translated
+
+
+def adapt(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+_row_types = {}
+
+
+# pyodbc rows support both indexing and attribute access (signal_book reads
+# columns by name); SQLite rows get the same through namedtuples
+def row_factory(cursor, row):
+    names = tuple(column[0] for column in cursor.description)
+    row_type = _row_types.get(names)
+    if row_type is None:
+        row_type = _row_types[names] = namedtuple('Row', names)
+    return row_type(*row)
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Smallest useful run of the benchmark harness: 10 symbols, no open signals,
+# 5 minutes of bars and a tiny model
+SMOKE_ARGS = ['--symbols', '10', '--open-signals', '0', '--minutes', '5', '--trees', '5', '--depth', '3',
+              '--predict-sizes', '1', '--predict-repeats', '1']
+
+
+# Keeps benchmarks/run.py working end to end, so a change to the pipeline or
+# its stand-ins can't silently break the harness
+class BenchmarkSmokeTest(unittest.TestCase):
+    def test_run_writes_results(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, 'results.json')
+            subprocess.run([sys.executable, '-m', 'benchmarks.run', *SMOKE_ARGS, '--output', output],
+                           cwd=ROOT, check=True, capture_output=True, timeout=600)
+            with open(output) as f:
+                results = json.load(f)
+        run, = results['pipeline']
+        self.assertEqual((run['symbols'], run['open_signals'], run['bars']), (10, 0, 50))
+        self.assertGreater(run['bars_per_second'], 0)
+        self.assertIn('bar_to_processed', run['latency'])
+        self.assertIn('predict_1', results['micro'])
+
+    def test_run_pipeline_restores_message_sink(self):
+        from benchmarks import run
+        from benchmarks.synthetic import BarGenerator, sample_features, synthetic_forest
+        import check_signals
+        import inference
+
+        async def sink(message):
+            pass
+        check_signals.set_message_sink(sink)
+        inference.model = synthetic_forest(sample_features(seed=1), 5, 3, 1)
+        args = types.SimpleNamespace(db_latency=0.0, discord_latency=0.0, rate_limited=False, queue_size=100, seed=1)
+        with tempfile.TemporaryDirectory() as workdir:
+            batches = list(BarGenerator(5, 1).batches(3))
+            asyncio.run(run.run_pipeline(batches, 0, args, os.path.join(workdir, 'bench.db')))
+        self.assertIs(check_signals.message_sink, sink)
+
+
+if __name__ == "__main__":
+    unittest.main()
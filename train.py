@@ -0,0 +1,250 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.metrics import accuracy_score, classification_report
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from imblearn.over_sampling import SMOTE
+import candle_cache
+from features import FEATURE_NAMES
+from model_export import compact_path, flatten, save_forest, source_stamp
+from ml_layer import CANDLE_COLUMNS, cached_trade_signals, merge_data_streamed
+
+MODEL_PATH = 'trained_model.pkl'
+DATASET_CACHE_DIR = os.path.join(candle_cache.CACHE_DIR, 'training')
+# The candle values followed by its rolling features, as inference builds rows
+FEATURES = CANDLE_COLUMNS + list(FEATURE_NAMES)
+CV_FOLDS = 5
+RANDOM_STATE = 42
+# Hyperparameter candidates scored by cross-validation; the first one is the
+# model ml_layer has always trained
+PARAM_GRID = [
+    {'n_estimators': 100},
+    {'n_estimators': 200, 'min_samples_leaf': 2},
+    {'n_estimators': 200, 'max_depth': 12},
+    {'n_estimators': 300, 'max_features': None, 'min_samples_leaf': 5},
+]
+# Trees added per incremental retrain
+INCREMENTAL_TREES = 25
+
+
+@contextmanager
+def timed(timings, name):
+    started = time.perf_counter()
+    yield
+    timings[name] = round(time.perf_counter() - started, 3)
+
+
+def load_training_rows(start=None, end=None, sync=True):
+    if sync:
+        candle_cache.sync()
+    signals = cached_trade_signals()
+    created_at = pd.to_datetime(signals['created_at'])
+    if start:
+        signals = signals[created_at >= pd.Timestamp(start)]
+    if end:
+        signals = signals[created_at < pd.Timestamp(end) + pd.Timedelta(days=1)]
+    return merge_data_streamed(signals, candle_cache.iter_candles(end=end))
+
+
+def data_range(rows):
+    if rows.empty:
+        return None
+    created_at = pd.to_datetime(rows['created_at'])
+    return {'start': created_at.min().isoformat(), 'end': created_at.max().isoformat()}
+
+
+# Hash of everything the prepared dataset depends on
+def dataset_key(rows, start, end):
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'start': start, 'end': end, 'features': FEATURES, 'seed': RANDOM_STATE}).encode())
+    digest.update(pd.util.hash_pandas_object(rows[['id'] + FEATURES + ['total_profit']], index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+# Impute, label, resample and split, exactly as ml_layer's training always has.
+# The result is cached by dataset_key so repeated runs over the same data
+# skip straight to model fitting.
+def prepare_dataset(rows, key):
+    path = os.path.join(DATASET_CACHE_DIR, f'{key}.npz')
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}, True
+
+    features = rows[FEATURES]
+    imputer = SimpleImputer(strategy='mean')
+    X = imputer.fit_transform(features)
+    y = (rows['total_profit'].fillna(0).to_numpy() > 0).astype(np.int64)
+
+    X_res, y_res = SMOTE(random_state=RANDOM_STATE).fit_resample(X, y)
+    X_train, X_test, y_train, y_test = train_test_split(X_res, y_res, test_size=0.2, random_state=RANDOM_STATE)
+    dataset = {
+        'X_train': X_train, 'X_test': X_test, 'y_train': y_train, 'y_test': y_test,
+        'imputer_statistics': imputer.statistics_
+    }
+    os.makedirs(DATASET_CACHE_DIR, exist_ok=True)
+    np.savez(path + '.tmp.npz', **dataset)
+    os.replace(path + '.tmp.npz', path)
+    return dataset, False
+
+
+def _score_fold(candidate, params, X, y, train_index, test_index):
+    model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=1, **params)
+    model.fit(X[train_index], y[train_index])
+    return candidate, accuracy_score(y[test_index], model.predict(X[test_index]))
+
+
+# Cross-validate every candidate, running all (candidate, fold) fits in parallel
+def search(X, y, grid=PARAM_GRID, folds=CV_FOLDS, n_jobs=-1):
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=RANDOM_STATE).split(X, y))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_score_fold)(candidate, params, X, y, train_index, test_index)
+        for candidate, params in enumerate(grid)
+        for train_index, test_index in splits
+    )
+    scores = [[] for _ in grid]
+    for candidate, score in results:
+        scores[candidate].append(score)
+    return [{'params': params, 'scores': candidate_scores, 'mean': float(np.mean(candidate_scores))}
+            for params, candidate_scores in zip(grid, scores)]
+
+
+def artifact_paths(version, model_path=MODEL_PATH):
+    base, ext = os.path.splitext(model_path)
+    return f'{base}-{version}{ext}', f'{base}-{version}.json'
+
+
+# Write the model as a versioned artifact with its metadata next to
+# model_path, then point model_path (and its compact export) at the new model
+def save_artifact(model, metadata, model_path=MODEL_PATH):
+    version = datetime.now().strftime('%Y%m%d-%H%M%S')
+    versioned_model, versioned_metadata = artifact_paths(version, model_path)
+    metadata = dict(metadata, version=version, model_file=os.path.basename(versioned_model))
+    joblib.dump(model, versioned_model)
+    with open(versioned_metadata, 'w') as f:
+        json.dump(metadata, f, indent=2, default=str)
+    joblib.dump(model, model_path + '.tmp')
+    os.replace(model_path + '.tmp', model_path)
+    save_forest(flatten(model), compact_path(model_path), source_stamp(model_path))
+    with open(os.path.splitext(model_path)[0] + '.json', 'w') as f:
+        json.dump(metadata, f, indent=2, default=str)
+    print(f"Model {version} saved to {versioned_model} and {model_path}")
+    return version
+
+
+def latest_metadata(model_path=MODEL_PATH):
+    try:
+        with open(os.path.splitext(model_path)[0] + '.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def train_full(start=None, end=None, n_jobs=-1, sync=True):
+    timings = {}
+    with timed(timings, 'load'):
+        rows = load_training_rows(start, end, sync)
+    print(f"{len(rows)} training rows")
+    with timed(timings, 'prepare'):
+        key = dataset_key(rows, start, end)
+        dataset, cached = prepare_dataset(rows, key)
+    X_train, y_train = dataset['X_train'], dataset['y_train']
+
+    with timed(timings, 'search'):
+        results = search(X_train, y_train, n_jobs=n_jobs)
+    for result in results:
+        print(f"{result['params']}: {result['mean']:.4f} {np.round(result['scores'], 4).tolist()}")
+    best = max(results, key=lambda result: result['mean'])
+
+    with timed(timings, 'fit'):
+        model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=n_jobs, **best['params'])
+        model.fit(X_train, y_train)
+    with timed(timings, 'evaluate'):
+        y_pred = model.predict(dataset['X_test'])
+        accuracy = accuracy_score(dataset['y_test'], y_pred)
+    print("Accuracy:", accuracy)
+    print(classification_report(dataset['y_test'], y_pred))
+
+    save_artifact(model, {
+        'mode': 'full',
+        'features': FEATURES,
+        'params': best['params'],
+        'data_range': data_range(rows),
+        'rows': len(rows),
+        'dataset_key': key,
+        'dataset_cached': cached,
+        'cv_results': results,
+        'test_accuracy': accuracy,
+        'imputer_statistics': dataset['imputer_statistics'].tolist(),
+        'timings': timings,
+    })
+    return model
+
+
+# Grow the current forest with INCREMENTAL_TREES trees fitted on the signals
+# that closed after the current model's data range
+def train_incremental(n_jobs=-1, sync=True, model_path=MODEL_PATH):
+    metadata = latest_metadata(model_path)
+    if metadata is None or not metadata.get('data_range'):
+        print("No model metadata to extend; running a full training")
+        return train_full(n_jobs=n_jobs, sync=sync)
+    if metadata.get('features') != FEATURES:
+        print("Current model was trained on different features; running a full training")
+        return train_full(n_jobs=n_jobs, sync=sync)
+
+    timings = {}
+    with timed(timings, 'load'):
+        since = pd.Timestamp(metadata['data_range']['end'])
+        rows = load_training_rows(since.strftime('%Y-%m-%d'), None, sync)
+        rows = rows[(pd.to_datetime(rows['created_at']) > since) & rows['total_profit'].notna()]
+    if rows.empty:
+        print("No newly closed signals since the last model")
+        return None
+
+    X = SimpleImputer(strategy='mean').fit_transform(rows[FEATURES])
+    y = (rows['total_profit'].to_numpy() > 0).astype(np.int64)
+    if len(np.unique(y)) < 2:
+        print("Newly closed signals are all one class; waiting for more before extending the model")
+        return None
+    with timed(timings, 'fit'):
+        model = joblib.load(model_path)
+        model.set_params(warm_start=True, n_jobs=n_jobs, n_estimators=model.n_estimators + INCREMENTAL_TREES)
+        model.fit(X, y)
+
+    previous_range = metadata['data_range']
+    new_range = data_range(rows)
+    save_artifact(model, {
+        'mode': 'incremental',
+        'parent': metadata.get('version'),
+        'features': FEATURES,
+        'params': model.get_params(),
+        'data_range': {'start': previous_range['start'], 'end': new_range['end']},
+        'new_data_range': new_range,
+        'rows': len(rows),
+        'timings': timings,
+    }, model_path)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the trade signal model")
+    parser.add_argument('--start', help="First signal date to train on (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Last signal date to train on (YYYY-MM-DD)")
+    parser.add_argument('--incremental', action='store_true', help="Add trees for signals closed since the last model")
+    parser.add_argument('--jobs', type=int, default=-1, help="Parallel workers (default: all cores)")
+    parser.add_argument('--no-sync', action='store_true', help="Train from the local cache without syncing it first")
+    args = parser.parse_args()
+
+    if args.incremental:
+        train_incremental(n_jobs=args.jobs, sync=not args.no_sync)
+    else:
+        train_full(args.start, args.end, n_jobs=args.jobs, sync=not args.no_sync)
@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+from collections import deque
+import database
+from metrics import metrics
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 0.5
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+
+class WriteOp:
+    __slots__ = ('sql', 'params', 'target', 'queued_at')
+
+    def __init__(self, sql, params, target=None):
+        self.sql = sql
+        self.params = params
+        self.target = target
+        self.queued_at = time.monotonic()
+
+
+# signal_id arguments may be a plain id or an object (such as a
+# signal_book.Signal) whose id is filled in once its queued save_signal has committed.
+def resolve_id(signal_id):
+    return getattr(signal_id, 'id', signal_id)
+
+
+# Write-behind queue for the database calls made on the hot path. Calls return
+# immediately; a background task flushes them in batches on a pooled
+# connection from the default executor once BATCH_SIZE ops are waiting or
+# FLUSH_INTERVAL seconds have passed. With an async backend (see
+# async_database) batches are awaited on the event loop instead. on_saved, if
+# set, is called on the loop with the target of every insert that committed.
+class WriteQueue:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, backend=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backend = backend
+        self.pending = deque()
+        self._loop = None
+        self._loop_thread = None
+        self._wakeup = None
+        self._flush_lock = None
+        self._task = None
+        self._closing = False
+        self._failures = 0
+        self.on_saved = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Queue depth and the age of the oldest unwritten op, in seconds
+    def snapshot(self):
+        pending = self.pending
+        lag = time.monotonic() - pending[0].queued_at if pending else 0.0
+        return {'depth': len(pending), 'lag': round(lag, 4), 'failures': self._failures}
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def _put(self, op):
+        self.pending.append(op)
+        if self._wakeup is not None and len(self.pending) >= self.batch_size:
+            if threading.get_ident() == self._loop_thread:
+                self._wakeup.set()
+            else:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def save_signal(self, symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence, target=None):
+        params = database.signal_params(symbol, signal_type, entry_point, stop_loss, invalidated_price, sentiment, volume_confirmed, timestamp, confidence)
+        if params is None:
+            return False
+        self._put(WriteOp(database.INSERT_SIGNAL_SQL, params, target))
+        return True
+
+    def update_signal_stop_loss(self, signal_id, new_stop_loss, timestamp):
+        params = database.stop_loss_params(signal_id, new_stop_loss, timestamp)
+        if params is not None:
+            self._put(WriteOp(database.UPDATE_STOP_LOSS_SQL, params))
+
+    def update_signal(self, signal_id, total_profit, is_open, invalidated, timestamp, entry_point=None):
+        sql, params = database.update_params(signal_id, total_profit, is_open, invalidated, timestamp, entry_point)
+        self._put(WriteOp(sql, params))
+
+    def save_message(self, message):
+        self._put(WriteOp(database.INSERT_MESSAGE_SQL, (message,)))
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.pending and not await self.flush():
+                await asyncio.sleep(min(RETRY_BACKOFF * 2 ** self._failures, 30))
+
+    async def flush(self):
+        async with self._flush_lock:
+            ops = [self.pending.popleft() for _ in range(min(len(self.pending), self.batch_size))]
+            if not ops:
+                return True
+            try:
+                if self.backend is not None:
+                    await self.backend.write_ops(ops)
+                else:
+                    await self._loop.run_in_executor(None, write_ops, ops)
+            except Exception as e:
+                self._failures += 1
+                if self._failures > MAX_RETRIES:
+                    print(f"Dropping {len(ops)} queued database writes after {MAX_RETRIES} retries: {e}")
+                    self._failures = 0
+                else:
+                    print(f"Database write batch failed ({e}), retrying {len(ops)} writes")
+                    self.pending.extendleft(reversed(ops))
+                return False
+            self._failures = 0
+            if self.on_saved is not None:
+                for op in ops:
+                    if op.target is not None:
+                        self.on_saved(op.target)
+            return True
+
+    # Write out everything queued so far and keep running; False if a batch
+    # failed (it stays queued for the background task's retries)
+    async def flush_pending(self):
+        while self.pending:
+            if not await self.flush():
+                return False
+        return True
+
+    # Stop the background task and write out everything still queued
+    async def drain(self):
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        while self.pending:
+            if not await self.flush():
+                await asyncio.sleep(RETRY_BACKOFF)
+
+
+# Write one batch on a pooled connection and commit once. New signals are
+# inserted first so the updates and messages behind them can use their ids;
+# all the batch's signal updates then go out as one set-based statement.
+# Targets only get their ids once the commit succeeded, so a failed batch
+# never leaves them (or a shard worker) holding a rolled-back id.
+def write_ops(ops):
+    database.ensure_schema()
+    started = time.perf_counter()
+    inserts = [op for op in ops if op.sql is database.INSERT_SIGNAL_SQL]
+    round_trips = 1  # the commit
+    assigned = {}
+    with database.connection() as conn:
+        cursor = conn.cursor()
+        if inserts:
+            round_trips += -(-len(inserts) // database.INSERT_CHUNK_SIZE)
+            ids = database.insert_signals(cursor, [op.params for op in inserts])
+            for op, signal_id in zip(inserts, ids):
+                if op.target is not None:
+                    assigned[id(op.target)] = (op.target, signal_id)
+
+        updates, messages = follow_up_statements(ops, assigned)
+        round_trips += database.update_signals(cursor, updates)
+        round_trips += database.executemany_runs(cursor, messages)
+        conn.commit()
+    assign_ids(assigned)
+    metrics.since('db_write', started)
+    metrics.count('db_round_trips', round_trips)
+    metrics.count('db_writes', len(ops))
+
+
+# The (sql, params) statements of a batch that follow its inserts, as
+# (updates, messages): updates in queue order with their signal ids resolved,
+# from assigned ({id(target): (target, signal_id)} of the batch's own
+# uncommitted inserts) first
+def follow_up_statements(ops, assigned=None):
+    updates, messages = [], []
+    for op in ops:
+        if op.sql is database.INSERT_MESSAGE_SQL:
+            messages.append((op.sql, op.params))
+        elif op.sql is not database.INSERT_SIGNAL_SQL:
+            target = op.params[-1]
+            saved = assigned.get(id(target)) if assigned else None
+            signal_id = saved[1] if saved is not None else resolve_id(target)
+            if signal_id is None:
+                print(f"Skipping update for a signal that was never saved: {op.params}")
+                continue
+            updates.append((op.sql, op.params[:-1] + (signal_id,)))
+    return updates, messages
+
+
+# Hand a committed batch's inserted ids to their targets
+def assign_ids(assigned):
+    for target, signal_id in assigned.values():
+        target.id = signal_id
+
+
+writer = WriteQueue()